@@ -627,23 +627,21 @@ def merge_ner_datasets(args):
     min_dups = args.min_dups
     assert dataset_files and len(dataset_files) >= 2
 
-    ner_datasets = [NerDataset(f"{i}") for i in range(len(dataset_files))]
-    for dataset, filename in zip(ner_datasets, dataset_files):
+    filenames = []
+    for filename in dataset_files:
         if not os.path.exists(filename):
             local_id = filename
             guess_filename = f"{args.output_dir}/{local_id}/{args.dataset_name}_reviews_{local_id}.json"
             if not os.path.exists(guess_filename):
                 raise Exception(f"NerDataset {filename} does not exists.")
             filename = guess_filename
-        #  dataset.load_from_file(filename)
         logger.info(f"{filename}")
-        dataset.load(reviews_data_generator, filename)
-
-    from theta.modeling import merge_ner_datasets as do_merge_ner_datasets
-    merged_dataset = do_merge_ner_datasets(ner_datasets, min_dups=min_dups)
+        filenames.append(filename)
 
+    # 流式读取各文件，所有实体编码为整数数组后统一计数
+    from theta.nlp.data.entity_merge import merge_tagged_files
     merged_dataset_file = args.dataset_file
-    merged_dataset.save(merged_dataset_file, format='json')
+    merge_tagged_files(filenames, merged_dataset_file, min_dups=min_dups)
     logger.info(f"Saved {merged_dataset_file}")
 
 
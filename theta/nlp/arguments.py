@@ -104,6 +104,14 @@ class DataArguments(BaseArguments):
         default=None,
         metadata={"help": "Cache dir"},
     )
+    cache_format: str = field(
+        default='dill',
+        metadata={
+            "help":
+            "Format of cached datasets. ['dill', 'mmap']. "
+            "'mmap' stores tensors as contiguous arrays opened with mmap."
+        },
+    )
 
     #  split_ratio: Optional[Union[float, List, Tuple]] = field(
     split_ratios: Optional[float] = field(
@@ -124,6 +132,72 @@ class DataArguments(BaseArguments):
         metadata={
             "help": "Preseve no enity segmented sentences for training."
         })
+    # NER: 合并滑动窗口预测结果时，解决不同窗口间相互重叠的实体
+    resolve_overlap_entities: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Resolve overlapping entities predicted by different sliding windows. "
+            "Keep the entity predicted by more windows, then the longer one."
+        })
+    # NER: 长文本滑动窗口切分方式
+    segment_mode: str = field(
+        default='char',
+        metadata={
+            "help":
+            "How NER documents are split into sliding windows. ['char', 'token']. "
+            "'token' tokenizes each document once and cuts token-level windows."
+        })
+    segment_stride: int = field(
+        default=None,
+        metadata={
+            "help":
+            "Stride of token-level windows in tokens. Default is (max_length - 2) / 2."
+        })
+    segment_by_sentence: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "End token-level windows at sentence boundaries when possible. "
+            "A window ending at a sentence boundary does not overlap the next one."
+        })
+    # 批量编码：合并多条样本调用fast tokenizer，并可使用多进程
+    encode_batch_size: int = field(
+        default=0,
+        metadata={
+            "help":
+            "Encode samples in batches of this size with the fast tokenizer. "
+            "0 means encoding samples one by one."
+        })
+    encode_num_workers: int = field(
+        default=1,
+        metadata={
+            "help":
+            "Number of processes used for batched encoding. "
+            "Only used when encode_batch_size > 0."
+        })
+    # tokenize结果缓存：按(文本, tokenizer, 编码参数)的hash缓存，跨运行、跨fold复用
+    use_token_cache: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Cache tokenizer outputs keyed by hash of text, tokenizer and encoding settings."
+        })
+    token_cache_dir: str = field(
+        default=None,
+        metadata={
+            "help":
+            "Directory of the on-disk token cache. Default is {cache_dir}/token_cache."
+        })
+    token_cache_entries: int = field(
+        default=100000,
+        metadata={"help": "Max number of entries of the in-process LRU."})
+    token_cache_max_mb: int = field(
+        default=1024,
+        metadata={
+            "help":
+            "Max size of the on-disk token cache in MB. Oldest segments are evicted first."
+        })
 
     def __post_init__(self):
         pass
@@ -190,10 +264,25 @@ class ModelArguments(BaseArguments):
         default=None,
         metadata={"help": "Contrastive learning alpha parameter."},
     )
+    cl_forward_mode: str = field(
+        default="fused",
+        metadata={
+            "help":
+            "How contrastive learning gets two dropout samples: 'fused' (one forward on the doubled batch), "
+            "'checkpoint' (second copy recomputed in backward to save memory), 'loop' (two forwards)."
+        },
+    )
     noise_lambda: float = field(
         default=0.0,
         metadata={"help": "Noise tune lambda parameter."},
     )
+    quantized: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Load the dynamic int8 quantized model (checkpoint_int8) for eval and predict."
+        },
+    )
 
     def __post_init__(self):
         pass
@@ -260,6 +349,18 @@ class TrainingArguments(BaseArguments):  #HfTrainingArguments):
 
     do_submit: bool = field(default=False,
                             metadata={"help": "Whether to run submit."})
+    do_quantize: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether to quantize the checkpoint with dynamic int8 quantization and compare it with fp32 on the dev set."
+        })
+    do_teacher_logits: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether to run the kd teachers once over the training set and save their logits for distillation."
+        })
 
     # -------------------- training --------------------
     max_epochs: int = field(
@@ -302,6 +403,70 @@ class TrainingArguments(BaseArguments):  #HfTrainingArguments):
         default=8,
         metadata={"help": "Batch size per GPU/TPU core/CPU for testing."},
     )
+    group_by_length: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether or not to group samples of roughly the same length together when batching. "
+            "Use with padding='longest' so that each batch is padded only to its longest sample."
+        },
+    )
+    weight_averaging: Optional[str] = field(
+        default=None,
+        metadata={
+            "help":
+            "Average the weights in memory during training. ['swa', 'ema']"
+        },
+    )
+    weight_averaging_start: int = field(
+        default=0,
+        metadata={
+            "help": "The global step from which the weights are averaged."
+        },
+    )
+    weight_averaging_steps: int = field(
+        default=1,
+        metadata={"help": "Update the averaged weights every X steps."},
+    )
+    ema_decay: float = field(
+        default=0.999,
+        metadata={"help": "Decay of the ema weight averaging."},
+    )
+    auto_batch_size: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether to probe forward/backward before training and use the largest per_device_train_batch_size "
+            "that fits memory_budget_mb."
+        },
+    )
+    memory_budget_mb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help":
+            "Memory budget of auto_batch_size in MB. Default: 90% of the GPU memory."
+        },
+    )
+    max_auto_batch_size: int = field(
+        default=256,
+        metadata={"help": "The largest batch size probed by auto_batch_size."},
+    )
+    auto_activation_checkpointing: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether auto_batch_size may enable activation checkpointing on the transformer encoder "
+            "when it fits a larger batch size."
+        },
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether or not to pack several short training samples into one max_length sequence, "
+            "with a block-diagonal attention mask so that the samples do not attend to each other."
+        },
+    )
 
     warmup_method: str = field(
         default='by_epoch',
@@ -405,6 +570,40 @@ class TrainingArguments(BaseArguments):  #HfTrainingArguments):
         },
     )
 
+    # -------------------- knowledge distillation --------------------
+    enable_kd: bool = field(
+        default=False,
+        metadata={
+            "help":
+            "Whether to train the model against the precomputed teacher logits."
+        },
+    )
+    kd_teacher_paths: Optional[str] = field(
+        default=None,
+        metadata={
+            "help":
+            "Comma separated checkpoint paths of the teachers, averaged when more than one."
+        },
+    )
+    kd_logits_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help":
+            "Where the teacher logits are saved. Default: {cache_dir}/train_teacher_logits.mmap"
+        },
+    )
+    kd_alpha: float = field(
+        default=0.5,
+        metadata={
+            "help":
+            "Weight of the distillation loss, loss = (1 - kd_alpha) * loss + kd_alpha * kd_loss."
+        },
+    )
+    kd_temperature: float = field(
+        default=2.0,
+        metadata={"help": "Softmax temperature of the distillation loss."},
+    )
+
     #  run_name: Optional[str] = field(
     #      default=None,
     #      metadata={
@@ -441,14 +640,6 @@ class TrainingArguments(BaseArguments):  #HfTrainingArguments):
     #      metadata={"help": "Whether or not to replace AdamW by Adafactor."},
     #  )
     #
-    #  group_by_length: bool = field(
-    #      default=False,
-    #      metadata={
-    #          "help":
-    #          "Whether or not to group samples of roughly the same length together when batching."
-    #      },
-    #  )
-    #
     #  logging_steps: int = field(
     #      default=500,
     #      metadata={"help": "Log every X updates steps."},
@@ -644,6 +835,8 @@ class TaskArguments():
         training_args.do_eval = False
         training_args.do_predict = False
         training_args.do_submit = False
+        training_args.do_quantize = False
+        training_args.do_teacher_logits = False
 
         task_args = TaskArguments(data_args=data_args,
                                   model_args=model_args,
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+列式数据集缓存
+
+每个字段保存为一个连续数组(.npy)加一个offsets索引，加载时使用mmap打开，
+不需要反序列化整个数据集，DataLoader的多个worker共享同一份page cache。
+
+目录结构:
+    {cache_path}/meta.pkl               字段描述、Dataset类、样本数
+    {cache_path}/extras.pkl             sids, seg_spans等非逐样本属性
+    {cache_path}/{key}.data.npy         字段数据(拼接后的一维数组)
+    {cache_path}/{key}.offsets.npy      第i个样本为data[offsets[i]:offsets[i+1]]
+    {cache_path}/{key}.present.npy      第i个样本该字段是否为None
+"""
+
+import os
+import pickle
+import shutil
+
+try:
+    import dill
+except:
+    import pickle as dill
+import numpy as np
+import torch
+from loguru import logger
+from tqdm import tqdm
+
+# 字段类型
+COLUMN_TENSOR = 'tensor'  # torch.Tensor
+COLUMN_INT_LIST = 'int_list'  # List[int]，如char2token, token2char
+COLUMN_OBJECT = 'object'  # 其它python对象(tokens, tags)，逐样本pickle
+
+# 不随样本变化、需要随缓存保存的Dataset属性
+EXTRA_ATTRS = ['sids', 'seg_spans']
+
+
+def _column_kind(value):
+    if isinstance(value, torch.Tensor):
+        return COLUMN_TENSOR
+    if isinstance(value, list) and value and all(
+            isinstance(x, (int, np.integer)) for x in value):
+        return COLUMN_INT_LIST
+    return COLUMN_OBJECT
+
+
+def _infer_columns(dataset):
+    """
+    由每个字段第一个非None的值推断字段类型，字段全为None时按object处理。
+    """
+    columns = {}
+    for sample in dataset:
+        for key, value in sample.items():
+            if value is None:
+                columns.setdefault(key, None)
+                continue
+            if columns.get(key, None) is not None:
+                continue
+            column = {'kind': _column_kind(value)}
+            if column['kind'] == COLUMN_TENSOR:
+                column['dtype'] = str(value.numpy().dtype)
+                column['shape'] = list(value.shape[1:])
+                column['ndim'] = value.dim()
+            columns[key] = column
+        if columns and all(c is not None for c in columns.values()):
+            break
+    return {
+        key: column if column is not None else {'kind': COLUMN_OBJECT}
+        for key, column in columns.items()
+    }
+
+
+def save_columnar_dataset(dataset, cache_path):
+    """
+    将BaseDataset按列写入cache_path目录
+    """
+    columns = _infer_columns(dataset)
+    num_samples = len(dataset)
+
+    tmp_path = f"{cache_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    chunks = {key: [] for key in columns}
+    lengths = {key: np.zeros(num_samples, dtype=np.int64) for key in columns}
+    present = {key: np.zeros(num_samples, dtype=np.bool_) for key in columns}
+    for i, sample in enumerate(tqdm(dataset, desc="Caching")):
+        for key, column in columns.items():
+            value = sample.get(key, None)
+            if value is None:
+                continue
+            present[key][i] = True
+            kind = column['kind']
+            if kind == COLUMN_TENSOR:
+                value = value.numpy().reshape(-1)
+            elif kind == COLUMN_INT_LIST:
+                value = np.asarray(value, dtype=np.int64)
+            else:
+                value = np.frombuffer(pickle.dumps(value,
+                                                   pickle.HIGHEST_PROTOCOL),
+                                      dtype=np.uint8)
+            chunks[key].append(value)
+            lengths[key][i] = len(value)
+
+    for key, column in columns.items():
+        kind = column['kind']
+        if kind == COLUMN_TENSOR:
+            dtype = np.dtype(column['dtype'])
+        elif kind == COLUMN_INT_LIST:
+            dtype = np.int64
+        else:
+            dtype = np.uint8
+        if chunks[key]:
+            data = np.concatenate(chunks[key]).astype(dtype, copy=False)
+        else:
+            data = np.zeros(0, dtype=dtype)
+        offsets = np.zeros(num_samples + 1, dtype=np.int64)
+        np.cumsum(lengths[key], out=offsets[1:])
+
+        np.save(os.path.join(tmp_path, f"{key}.data.npy"), data)
+        np.save(os.path.join(tmp_path, f"{key}.offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, f"{key}.present.npy"), present[key])
+        chunks[key] = None
+
+    meta = {
+        'num_samples': num_samples,
+        'columns': columns,
+        'dataset_cls': type(dataset),
+    }
+    dill.dump(meta, open(os.path.join(tmp_path, "meta.pkl"), 'wb'))
+    extras = {
+        attr: getattr(dataset, attr)
+        for attr in EXTRA_ATTRS if hasattr(dataset, attr)
+    }
+    dill.dump(extras, open(os.path.join(tmp_path, "extras.pkl"), 'wb'))
+
+    # 写完整后再替换，避免中断留下不完整的缓存
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+class ColumnarDataset(object):
+    """
+    mmap方式读取save_columnar_dataset()写入的缓存，
+    __getitem__返回与原Dataset相同结构的样本字典。
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        meta = dill.load(open(os.path.join(cache_path, "meta.pkl"), 'rb'))
+        self.num_samples = meta['num_samples']
+        self.columns = meta['columns']
+        self.dataset_cls = meta['dataset_cls']
+        self.collate_fn = self.dataset_cls.collate_fn
+
+        self._arrays = None
+        self._extras = None
+
+    def _open(self):
+        arrays = {}
+        for key in self.columns:
+            arrays[key] = tuple(
+                np.load(os.path.join(self.cache_path, f"{key}.{name}.npy"),
+                        mmap_mode='r')
+                for name in ['data', 'offsets', 'present'])
+        return arrays
+
+    @property
+    def arrays(self):
+        # 延迟打开，fork出的DataLoader worker各自映射同一文件
+        if self._arrays is None:
+            self._arrays = self._open()
+        return self._arrays
+
+    def _load_extras(self):
+        if self._extras is None:
+            self._extras = dill.load(
+                open(os.path.join(self.cache_path, "extras.pkl"), 'rb'))
+        return self._extras
+
+    @property
+    def sids(self):
+        return self._load_extras().get('sids', [])
+
+    @property
+    def seg_spans(self):
+        return self._load_extras().get('seg_spans', [])
+
+    def get_column(self, key, idx):
+        data, offsets, present = self.arrays[key]
+        if not present[idx]:
+            return None
+        value = data[offsets[idx]:offsets[idx + 1]]
+        column = self.columns[key]
+        kind = column['kind']
+        if kind == COLUMN_TENSOR:
+            value = np.array(value).reshape([-1] + column['shape'])
+            if column['ndim'] == 0:
+                value = value.reshape(())
+            return torch.from_numpy(value)
+        elif kind == COLUMN_INT_LIST:
+            return value.tolist()
+        else:
+            return pickle.loads(value.tobytes())
+
+    def column_lengths(self, key):
+        """
+        每个样本该字段的元素个数
+        """
+        _, offsets, _ = self.arrays[key]
+        return np.diff(offsets)
+
+    def get_lengths(self):
+        """
+        各样本的有效token数(attention_mask之和)，不需要逐条读取样本
+        """
+        data, offsets, _ = self.arrays['attention_mask']
+        cumsum = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(data, out=cumsum[1:])
+        return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.num_samples
+        if idx < 0 or idx >= self.num_samples:
+            raise IndexError(f"index {idx} out of range")
+        return {key: self.get_column(key, idx) for key in self.columns}
+
+    def __iter__(self):
+        for i in range(self.num_samples):
+            yield self[i]
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        # 多进程(spawn)传递时不序列化已打开的mmap和extras
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        state['_extras'] = None
+        return state
+
+
+def load_columnar_dataset(cache_path):
+    dataset = ColumnarDataset(cache_path)
+    logger.info(
+        f"Load columnar dataset {len(dataset)} lines from {cache_path}")
+    return dataset
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+多来源NER标注合并
+
+每个实体编码为整数元组 (doc, category, start, end)，所有文档的实体拼接成一个数组，
+用np.unique一次统计每个实体被多少个来源标注，按min_dups筛选，
+不再对每个文档排序、deepcopy、两两比较。同一来源中重复的实体只计一次。
+
+    python -m theta --merge_ner_datasets a.jsonl b.jsonl c.jsonl \
+        --min_dups 2 --dataset_file merged.jsonl
+
+文件按chunk_size条文档分块流式读取、合并、写出，内存占用与文件大小无关。
+"""
+
+import json
+from itertools import chain, islice
+from operator import itemgetter
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+from .jsonl_records import iter_jsonl
+
+# (doc, category, start, end)
+ENTITY_COLUMNS = 4
+
+
+def encode_tags(tags_list, category2id):
+    """
+    tags_list: 每个文档的tag列表 [[{'category', 'start', 'mention'}, ...], ...]
+    category2id: 类别 -> id，遇到新类别时添加
+    返回 (num_tags, 4)的int64数组，每行为(doc, category, start, end)
+    """
+    return _encode_tags(tags_list, category2id)[0]
+
+
+def _encode_tags(tags_list, category2id):
+    """
+    返回 (entities, flat_tags)，flat_tags[i]为entities第i行对应的tag
+    """
+    lens = np.fromiter(map(len, tags_list),
+                       dtype=np.int64,
+                       count=len(tags_list))
+    flat_tags = list(chain.from_iterable(tags_list))
+    num_tags = len(flat_tags)
+    entities = np.empty((num_tags, ENTITY_COLUMNS), dtype=np.int64)
+    if num_tags == 0:
+        return entities, flat_tags
+
+    categories = list(map(itemgetter('category'), flat_tags))
+    for c in sorted(set(categories) - category2id.keys()):
+        category2id[c] = len(category2id)
+    entities[:, 0] = np.repeat(np.arange(len(tags_list)), lens)
+    entities[:, 1] = np.fromiter(map(category2id.__getitem__, categories),
+                                 dtype=np.int64,
+                                 count=num_tags)
+    entities[:, 2] = np.fromiter(map(itemgetter('start'), flat_tags),
+                                 dtype=np.int64,
+                                 count=num_tags)
+    entities[:, 3] = entities[:, 2] + np.fromiter(
+        map(len, map(itemgetter('mention'), flat_tags)),
+        dtype=np.int64,
+        count=num_tags) - 1
+    return entities, flat_tags
+
+
+def _lex_keys(rows, reserve_bits=0):
+    """
+    每行一个int64键，键的大小顺序与行的字典序一致，低reserve_bits位留空。
+    各列的取值范围能装入一个int64时按位拼接，否则使用np.unique的排名。
+    """
+    mins = rows.min(0)
+    bits = [int(x).bit_length() for x in rows.max(0) - mins]
+    if sum(bits) + reserve_bits <= 62:
+        keys = np.zeros(len(rows), dtype=np.int64)
+        for j, b in enumerate(bits):
+            keys = (keys << b) | (rows[:, j] - mins[j])
+        return keys << reserve_bits
+    ranks = np.unique(rows, axis=0, return_inverse=True)[1].reshape(-1)
+    return ranks.astype(np.int64) << reserve_bits
+
+
+def count_entities(entities_list):
+    """
+    entities_list: 各来源encode_tags()的结果
+    返回 (entities, counts, first)
+        entities: 去重后的实体数组，按(doc, category, start, end)排序
+        counts: 每个实体被多少个来源标注
+        first: 每个实体第一次出现在拼接后数组中的行号
+    """
+    num_sources = len(entities_list)
+    sizes = np.array([len(x) for x in entities_list], dtype=np.int64)
+    all_entities = np.concatenate(
+        [np.empty((0, ENTITY_COLUMNS), dtype=np.int64)] + entities_list)
+    if len(all_entities) == 0:
+        return all_entities, np.zeros(0, dtype=np.int64), np.zeros(
+            0, dtype=np.int64)
+
+    # 低位为来源编号，同一来源中重复的实体只计一次
+    source_bits = max(num_sources - 1, 1).bit_length()
+    keys = _lex_keys(all_entities, reserve_bits=source_bits) | np.repeat(
+        np.arange(num_sources), sizes)
+    keys, rows = np.unique(keys, return_index=True)
+    # 键已排序，每个实体的第一条即来源编号最小的那一次标注
+    _, starts, counts = np.unique(keys >> source_bits,
+                                  return_index=True,
+                                  return_counts=True)
+    first = rows[starts]
+    return all_entities[first], counts, first
+
+
+def merge_tags_lists(tags_lists, min_dups=2):
+    """
+    tags_lists: 各来源的标注 [[doc_tags, ...], ...]，各来源的文档一一对应
+    返回合并后每个文档的tag列表，只保留至少min_dups个来源标注的实体，
+    文档内按(start, end)排序，tag沿用编号最小的来源中的tag
+    """
+    if len(tags_lists) == 0:
+        return []
+    num_docs = len(tags_lists[0])
+    assert all(len(x) == num_docs for x in tags_lists), \
+        "All sources must have the same number of documents."
+    if len(tags_lists) == 1:
+        return [list(tags) for tags in tags_lists[0]]
+
+    category2id = {}
+    entities_list = []
+    flat_tags = []
+    for x in tags_lists:
+        entities, source_tags = _encode_tags(x, category2id)
+        entities_list.append(entities)
+        flat_tags.extend(source_tags)
+    entities, counts, first = count_entities(entities_list)
+
+    keep = counts >= min_dups
+    entities, first = entities[keep], first[keep]
+    order = np.lexsort((first, entities[:, 3], entities[:, 2], entities[:,
+                                                                        0]))
+    merged = [[] for _ in range(num_docs)]
+    for doc, row in zip(entities[order, 0].tolist(), first[order].tolist()):
+        merged[doc].append(dict(flat_tags[row]))
+    return merged
+
+
+def iter_tagged_file(data_file):
+    """
+    逐条返回 (idx, text, tags)
+    jsonl文件({'idx', 'text', 'tags'}每行一条)流式读取；
+    json文件为数组或{guid: {'text', 'tags'}}时整体载入
+    """
+    if _is_jsonl(data_file):
+        for data in iter_jsonl(data_file):
+            yield data['idx'], data['text'], data['tags']
+        return
+
+    json_data = json.load(open(data_file, 'r'))
+    if isinstance(json_data, dict):
+        for guid, items in json_data.items():
+            yield guid, items['text'], items['tags']
+    else:
+        for data in json_data:
+            yield data['idx'], data['text'], data['tags']
+
+
+def _is_jsonl(data_file):
+    with open(data_file, 'r') as f:
+        first_line = f.readline()
+    try:
+        data = json.loads(first_line)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and 'text' in data
+
+
+def merge_tagged_files(data_files, output_file, min_dups=2, chunk_size=10000):
+    """
+    合并多个来源对相同文档的标注，结果写入output_file(jsonl)
+    各文件中的文档顺序、idx必须一致
+    返回合并后的实体总数
+    """
+    iterators = [iter_tagged_file(x) for x in data_files]
+    total_docs = 0
+    total_tags = 0
+    with open(output_file, 'w') as wt:
+        pbar = tqdm(desc="Merge ner tags")
+        while True:
+            chunks = [list(islice(it, chunk_size)) for it in iterators]
+            num_docs = len(chunks[0])
+            if any(len(x) != num_docs for x in chunks):
+                raise ValueError(
+                    f"Datasets {data_files} have different number of documents."
+                )
+            if num_docs == 0:
+                break
+            for docs in zip(*chunks):
+                if any(str(x[0]) != str(docs[0][0]) for x in docs):
+                    raise ValueError(
+                        f"Documents are not aligned: {[x[0] for x in docs]}")
+
+            merged = merge_tags_lists(
+                [[tags for _, _, tags in chunk] for chunk in chunks],
+                min_dups=min_dups)
+            for (idx, text, _), tags in zip(chunks[0], merged):
+                wt.write(
+                    f"{json.dumps({'idx': idx, 'text': text, 'tags': tags}, ensure_ascii=False)}\n"
+                )
+                total_tags += len(tags)
+            total_docs += num_docs
+            pbar.update(num_docs)
+        pbar.close()
+    logger.info(
+        f"Merged {total_docs} documents, {total_tags} tags (min_dups: {min_dups}) to {output_file}"
+    )
+    return total_tags
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+流式读取jsonl文件
+
+iter_jsonl()逐行解析并校验，不需要先把整个文件读入内存。
+JsonlRecords只在内存中保存每条记录在文件中的字节偏移，按需从磁盘读取解析，
+shuffle/切片/按下标取子集都只操作偏移数组。
+"""
+
+import json
+import os
+import random
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+
+def iter_jsonl(data_file, check_fn=None, with_offsets=False):
+    """
+    逐行解析jsonl，跳过空行
+    check_fn(data): 校验每条记录，不合法时抛出异常
+    with_offsets: 为True时yield (offset, data)
+    """
+    with open(data_file, 'rb') as f:
+        offset = 0
+        for line_no, line in enumerate(f):
+            line_offset = offset
+            offset += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                if check_fn is not None:
+                    check_fn(data)
+            except Exception as e:
+                raise ValueError(
+                    f"{data_file} line {line_no + 1} is invalid: {e}")
+            if with_offsets:
+                yield line_offset, data
+            else:
+                yield data
+
+
+def build_jsonl_offsets(data_file, check_fn=None, index_file=None):
+    """
+    流式扫描一遍jsonl文件，校验每条记录并返回各记录的字节偏移(np.int64)
+    index_file: 偏移索引缓存文件，比data_file新时直接载入，跳过扫描
+    """
+    if index_file is not None and os.path.exists(index_file):
+        if os.path.getmtime(index_file) >= os.path.getmtime(data_file):
+            logger.info(f"Load jsonl offsets from {index_file}")
+            return np.load(index_file)
+
+    offsets = np.fromiter((offset for offset, _ in tqdm(
+        iter_jsonl(data_file, check_fn=check_fn, with_offsets=True),
+        desc="Indexing jsonl")),
+                          dtype=np.int64)
+
+    if index_file is not None:
+        try:
+            with open(index_file, 'wb') as f:
+                np.save(f, offsets)
+            logger.info(f"Save jsonl offsets to {index_file}")
+        except OSError as e:
+            logger.warning(f"Save jsonl offsets to {index_file} failed: {e}")
+    return offsets
+
+
+class JsonlRecords:
+    """
+    由偏移索引访问的jsonl记录序列，支持len()、下标、切片和迭代
+    """
+
+    def __init__(self, data_file, offsets):
+        self.data_file = data_file
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._fp = None
+        self._fp_pid = None
+
+    @classmethod
+    def from_file(cls, data_file, check_fn=None, index_file=None):
+        offsets = build_jsonl_offsets(data_file,
+                                      check_fn=check_fn,
+                                      index_file=index_file)
+        return cls(data_file, offsets)
+
+    def _file(self):
+        # 多进程(DataLoader workers)中各自打开文件
+        if self._fp is None or self._fp_pid != os.getpid():
+            self._fp = open(self.data_file, 'rb')
+            self._fp_pid = os.getpid()
+        return self._fp
+
+    def _read(self, offset):
+        f = self._file()
+        f.seek(int(offset))
+        return json.loads(f.readline())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(idx)
+        if idx < 0:
+            idx += len(self.offsets)
+        if idx < 0 or idx >= len(self.offsets):
+            raise IndexError(f"index {idx} out of range")
+        return self._read(self.offsets[idx])
+
+    def __iter__(self):
+        # 独立的文件句柄，迭代时仍可按下标访问；偏移递增时seek落在读缓冲区内，相当于顺序读
+        with open(self.data_file, 'rb') as f:
+            for offset in self.offsets:
+                f.seek(int(offset))
+                yield json.loads(f.readline())
+
+    def take(self, indices):
+        """
+        indices: 下标数组或切片，返回共享同一文件的子集
+        """
+        return JsonlRecords(self.data_file, self.offsets[indices])
+
+    def shuffle(self, random_state=None):
+        """
+        与BaseSamples.shuffle()一样使用random模块，相同的随机状态下顺序与非lazy模式一致
+        """
+        if random_state is not None:
+            random.seed(random_state)
+        indices = list(range(len(self.offsets)))
+        random.shuffle(indices)
+        self.offsets = self.offsets[indices]
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fp'] = None
+        state['_fp_pid'] = None
+        return state
+
+    def __del__(self):
+        if self._fp is not None:
+            self._fp.close()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+短文本训练样本打包
+
+多个短样本拼接成一条不超过max_length的序列，每个样本保留自己的[CLS] ... [SEP]，
+position_ids在每个样本开头重置为0，segment_ids标记样本编号(从1开始，0为padding)，
+模型据此构造块对角的attention_mask，样本之间互不可见。
+
+    input_ids:    [CLS] a1 a2 [SEP] [CLS] b1 [SEP] [PAD]
+    position_ids:   0   1  2    3     0   1    2     0
+    segment_ids:    1   1  1    1     2   2    2     0
+
+batch中的segment_starts为(样本数, 2)，每行是样本[CLS]所在的(行, 列)，
+用于句子分类的逐样本pooling；样本级的labels按同样的顺序堆叠为(样本数, ...)。
+"""
+
+import bisect
+
+import numpy as np
+import torch
+from loguru import logger
+
+from .samplers import stack_with_padding
+
+# 按token拼接的字段，其余字段按样本处理
+PACKED_TOKEN_KEYS = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def pack_lengths(lengths, max_length):
+    """
+    Best-Fit Decreasing装箱：样本从长到短放入剩余空间最小且能容纳它的序列
+    返回每条序列中样本下标的列表(按下标排序)
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    packs = []
+    # 按剩余长度排序的(remain, pack_id)
+    remains = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        n = int(lengths[i])
+        k = bisect.bisect_left(remains, (n, -1))
+        if k < len(remains):
+            remain, pack_id = remains.pop(k)
+            packs[pack_id].append(i)
+            remain -= n
+        else:
+            # 超过max_length的样本单独成一条
+            pack_id = len(packs)
+            packs.append([i])
+            remain = max_length - n
+        if remain > 0:
+            bisect.insort(remains, (remain, pack_id))
+    return [sorted(x) for x in packs]
+
+
+def segment_attention_mask(segment_ids):
+    """
+    (batch_size, seq_len)的segment_ids -> (batch_size, seq_len, seq_len)的块对角attention_mask
+    """
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    return (same_segment & (segment_ids[:, None, :] > 0)).to(segment_ids.dtype)
+
+
+class PackedDataset(object):
+    """
+    将dataset中的样本打包成不超过max_length的序列，只用于训练
+    """
+
+    def __init__(self, dataset, max_length, token_keys=PACKED_TOKEN_KEYS):
+        self.dataset = dataset
+        self.max_length = max_length
+        self.token_keys = tuple(token_keys)
+
+        self.lengths = np.asarray(dataset.get_lengths(), dtype=np.int64)
+        self.packs = pack_lengths(self.lengths, max_length)
+
+        num_tokens = int(self.lengths.sum())
+        logger.info(
+            f"Packed {len(self.lengths)} samples into {len(self.packs)} sequences, "
+            f"padding ratio: {1 - num_tokens / max(len(self.lengths) * max_length, 1):.2%} -> "
+            f"{1 - num_tokens / max(len(self.packs) * max_length, 1):.2%}")
+
+    def __getitem__(self, idx):
+        indices = self.packs[idx]
+        samples = [self.dataset[i] for i in indices]
+        lengths = self.lengths[indices].tolist()
+
+        packed = {}
+        for key in self.token_keys:
+            values = [x.get(key, None) for x in samples]
+            if any(v is None for v in values):
+                packed[key] = None
+            else:
+                # 去掉样本自身的padding
+                packed[key] = torch.cat(
+                    [v[:n] for v, n in zip(values, lengths)])
+        packed['position_ids'] = torch.cat(
+            [torch.arange(n, dtype=torch.int64) for n in lengths])
+        packed['segment_ids'] = torch.cat([
+            torch.full((n, ), i + 1, dtype=torch.int64)
+            for i, n in enumerate(lengths)
+        ])
+        packed['segment_starts'] = torch.from_numpy(
+            np.cumsum([0] + lengths[:-1]).astype(np.int64))
+        for key in samples[0].keys():
+            if key not in self.token_keys:
+                packed[key] = [x[key] for x in samples]
+        return packed
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.packs)
+
+    def get_lengths(self):
+        return [int(self.lengths[x].sum()) for x in self.packs]
+
+    def collate_fn(self, batch):
+        stacked_batch = {}
+        for key in self.token_keys + ('position_ids', 'segment_ids'):
+            key_batch = [e[key] for e in batch]
+            if any(x is None for x in key_batch):
+                stacked_batch[key] = None
+            else:
+                stacked_batch[key] = stack_with_padding(key_batch)
+
+        rows = torch.cat([
+            torch.full_like(e['segment_starts'], i)
+            for i, e in enumerate(batch)
+        ])
+        stacked_batch['segment_starts'] = torch.stack(
+            [rows, torch.cat([e['segment_starts'] for e in batch])], dim=1)
+
+        # 样本级字段按样本顺序展开
+        for key in batch[0].keys():
+            if key in stacked_batch:
+                continue
+            key_batch = [x for e in batch for x in e[key]]
+            if any(x is None for x in key_batch):
+                stacked_batch[key] = None
+            elif all(isinstance(x, torch.Tensor) for x in key_batch):
+                stacked_batch[key] = torch.stack(key_batch)
+            else:
+                stacked_batch[key] = key_batch
+        return stacked_batch
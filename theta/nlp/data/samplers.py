@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def stack_with_padding(tensors, padding_value=0):
+    """
+    将长度不同的一维张量补齐到batch内最长的长度后堆叠，
+    长度一致时等价于torch.stack。
+    """
+    max_len = max(x.shape[0] for x in tensors)
+    if all(x.shape[0] == max_len for x in tensors):
+        return torch.stack(tensors)
+    return torch.nn.utils.rnn.pad_sequence(tensors,
+                                           batch_first=True,
+                                           padding_value=padding_value)
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    按长度分组的BatchSampler，长度相近的样本放在同一个batch，
+    配合动态padding减少padding带来的无效计算。
+
+    shuffle=True时(训练)：每个epoch打乱样本后，按batch_size * mega_batch_mult
+    切成大块，块内按长度排序后切分batch，再打乱batch顺序。最长的batch放在最前，
+    尽早暴露显存不足的问题。
+    shuffle=False时(验证、测试)：全部样本按长度排序，顺序固定，
+    可通过restore_order()将按batch顺序得到的结果还原为数据集顺序。
+    """
+
+    def __init__(self,
+                 lengths,
+                 batch_size,
+                 shuffle=False,
+                 mega_batch_mult=50,
+                 drop_last=False,
+                 seed=None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.mega_batch_mult = mega_batch_mult
+        self.drop_last = drop_last
+        self.seed = seed if seed is not None else 0
+        self.epoch = 0
+
+        self.order = None
+        if not self.shuffle:
+            self.order = self._sorted_by_length(np.arange(len(self.lengths)))
+
+    def _sorted_by_length(self, indices):
+        # 稳定排序，长度相同时保持原顺序
+        return indices[np.argsort(-self.lengths[indices], kind='stable')]
+
+    def _generate_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        indices = rng.permutation(len(self.lengths))
+        mega_batch_size = self.batch_size * self.mega_batch_mult
+        mega_batches = [
+            self._sorted_by_length(indices[i:i + mega_batch_size])
+            for i in range(0, len(indices), mega_batch_size)
+        ]
+        batches = [
+            mega_batch[i:i + self.batch_size] for mega_batch in mega_batches
+            for i in range(0, len(mega_batch), self.batch_size)
+        ]
+        if self.drop_last and batches and len(
+                batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if not batches:
+            return batches
+
+        longest = int(np.argmax([self.lengths[b].max() for b in batches]))
+        batches[0], batches[longest] = batches[longest], batches[0]
+        return [batches[0]] + [
+            batches[i] for i in 1 + rng.permutation(len(batches) - 1)
+        ]
+
+    def __iter__(self):
+        if self.shuffle:
+            batches = self._generate_batches()
+            self.order = np.concatenate(batches) if batches else np.zeros(
+                0, dtype=np.int64)
+        else:
+            num_samples = len(self.order)
+            if self.drop_last:
+                num_samples = num_samples // self.batch_size * self.batch_size
+            batches = [
+                self.order[i:i + self.batch_size]
+                for i in range(0, num_samples, self.batch_size)
+            ]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def restore_order(self, items):
+        """
+        items为按本sampler迭代顺序拼接的结果，还原为数据集中的顺序
+        """
+        assert len(items) == len(
+            self.order
+        ), f"len(items): {len(items)} != len(order): {len(self.order)}"
+        positions = np.argsort(self.order)
+        if isinstance(items, np.ndarray):
+            return items[positions]
+        if isinstance(items, torch.Tensor):
+            return items[torch.from_numpy(positions).to(items.device)]
+        return [items[pos] for pos in positions]
@@ -5,9 +5,13 @@ import random, json
 from typing import Callable, List, Tuple, Type, Union
 from copy import deepcopy
 
+import numpy as np
 from loguru import logger
 from tqdm import tqdm
 
+from .entity_merge import merge_tags_lists
+from .jsonl_records import JsonlRecords, iter_jsonl
+
 
 def is_uniform(entities):
     for i, x in enumerate(entities):
@@ -46,20 +50,11 @@ def merge_entities(entities_list, key=None, min_dups=2):
 
 
 def merge_ner_tags(ner_tags_list, min_dups=2):
-    if len(ner_tags_list) == 0:
-        return []
-    from copy import deepcopy
-    merged_tags = deepcopy(ner_tags_list[0])
-    if len(ner_tags_list) > 1:
-        for i, tags_list in enumerate(
-                tqdm(zip(*ner_tags_list), desc="Merge ner tags")):
-            new_tags = merge_entities(
-                tags_list,
-                key=lambda x: x['start'] * 1000 + len(x['mention']),
-                min_dups=min_dups)
-            merged_tags[i] = new_tags
-
-    return merged_tags
+    """
+    ner_tags_list: 各来源的标注 [[doc_tags, ...], ...]
+    保留至少min_dups个来源标注的实体，所有文档一次统计
+    """
+    return merge_tags_lists(ner_tags_list, min_dups=min_dups)
 
 
 class BaseSamples:
@@ -67,11 +62,16 @@ class BaseSamples:
                  data_file: str = None,
                  data_generator: Callable = None,
                  data_list: List = None,
-                 labels_list: List = None):
+                 labels_list: List = None,
+                 lazy_loading: bool = False):
+        """
+        lazy_loading: 从jsonl文件载入时只在内存中保存每条记录的文件偏移，按需读取
+        """
         self.data_list = data_list if data_list is not None else []
         self.labels_list = labels_list if labels_list is not None else []
         self.data_generator = data_generator
         self.data_file = data_file
+        self.lazy_loading = lazy_loading
 
     def __len__(self):
         return len(self.data_list)
@@ -82,7 +82,21 @@ class BaseSamples:
     def _new_instance(self, **kwargs):
         raise NotImplementedError
 
+    def _subset(self, indices):
+        """
+        indices: 下标数组或切片
+        """
+        if isinstance(self.data_list, JsonlRecords):
+            return self.data_list.take(indices)
+        if isinstance(indices, slice):
+            return self.data_list[indices]
+        return [self.data_list[i] for i in indices]
+
     def shuffle(self, random_state: int = None):
+        if isinstance(self.data_list, JsonlRecords):
+            self.data_list.shuffle(random_state)
+            return self
+
         if random_state is not None:
             random.seed(random_state)
         random.shuffle(self.data_list)
@@ -126,6 +140,30 @@ class BaseSamples:
         self.data_list = []
         raise NotImplementedError
 
+    def check_data(self, data):
+        """
+        校验从文件中读取的单条记录，不合法时抛出AssertionError
+        """
+        pass
+
+    def load_samples_from_jsonl(self, data_file):
+        """
+        流式解析jsonl，逐条校验。
+        lazy_loading时只保存偏移索引({data_file}.offsets.npy)，否则载入为list
+        """
+        self.data_file = data_file
+        if self.lazy_loading:
+            self.data_list = JsonlRecords.from_file(
+                data_file,
+                check_fn=self.check_data,
+                index_file=f"{data_file}.offsets.npy")
+        else:
+            self.data_list = [
+                data for data in tqdm(iter_jsonl(data_file,
+                                                 check_fn=self.check_data),
+                                      desc="jsonl")
+            ]
+
     def split(self,
               ratios: Union[float, List, Tuple] = None,
               random_state=None):
@@ -153,27 +191,34 @@ class BaseSamples:
 
         if random_state is not None:
             from sklearn.model_selection import train_test_split
-            train_data_list, eval_data_list = train_test_split(
-                self.data_list,
+
+            # 只划分下标，不复制数据
+            train_indices, eval_indices = train_test_split(
+                np.arange(num_total_samples),
                 train_size=train_rate,
                 random_state=random_state)
-            train_samples = self._new_instance(data_list=train_data_list,
-                                               labels_list=self.labels_list)
-            eval_samples = self._new_instance(data_list=eval_data_list,
-                                              labels_list=self.labels_list)
+            train_samples = self._new_instance(
+                data_list=self._subset(train_indices),
+                labels_list=self.labels_list)
+            eval_samples = self._new_instance(
+                data_list=self._subset(eval_indices),
+                labels_list=self.labels_list)
 
             return train_samples, eval_samples
         else:
             train_samples = self._new_instance(
-                data_list=self.data_list[:num_train_samples],
+                data_list=self._subset(slice(0, num_train_samples)),
                 labels_list=self.labels_list)
             eval_samples = self._new_instance(
-                data_list=self.data_list[num_train_samples:num_train_samples +
-                                         num_eval_samples],
+                data_list=self._subset(
+                    slice(num_train_samples,
+                          num_train_samples + num_eval_samples)),
                 labels_list=self.labels_list)
             if num_test_samples > 0:
                 test_samples = self._new_instance(
-                    data_list=self.data_list[-num_test_samples:],
+                    data_list=self._subset(
+                        slice(num_total_samples - num_test_samples,
+                              num_total_samples)),
                     labels_list=self.labels_list)
                 return train_samples, eval_samples, test_samples
             else:
@@ -233,29 +278,33 @@ class EntitySamples(BaseSamples):
             all_tags.append(data['tags'])
         return all_tags
 
+    def check_data(self, data):
+        assert isinstance(data, dict)
+        assert 'idx' in data, f"data: {data}"
+        assert 'text' in data, f"data: {data}"
+        assert 'tags' in data, f"data: {data}"
+        tags = data['tags']
+        for tag in tags:
+            assert isinstance(tag, dict)
+            assert 'category' in tag, f"data: {data}"
+            assert 'start' in tag, f"data: {data}"
+            assert 'mention' in tag, f"data: {data}"
+
     def load_samples_from_file(self, data_file):
         self.data_file = data_file
         self.data_list = []
-        try:
+
+        with open(data_file, 'r') as f:
+            head = f.read(4096).lstrip()
+
+        if head.startswith('['):
+            # 整个文件是一个json数组
             json_data = json.load(open(data_file, 'r'))
-        except:
-            json_data = []
-            for line in tqdm(open(data_file, 'r').readlines(), desc="jsonl"):
-                data = json.loads(line.strip())
-                json_data.append(data)
-
-        for data in tqdm(json_data, desc="Checking"):
-            assert isinstance(data, dict)
-            assert 'idx' in data, f"data: {data}"
-            assert 'text' in data, f"data: {data}"
-            assert 'tags' in data, f"data: {data}"
-            tags = data['tags']
-            for tag in tags:
-                assert isinstance(tag, dict)
-                assert 'category' in tag, f"data: {data}"
-                assert 'start' in tag, f"data: {data}"
-                assert 'mention' in tag, f"data: {data}"
-        self.data_list = json_data
+            for data in tqdm(json_data, desc="Checking"):
+                self.check_data(data)
+            self.data_list = json_data
+        else:
+            self.load_samples_from_jsonl(data_file)
 
     @classmethod
     def merge_tags(self, samples_list, min_dups=2):
@@ -269,11 +318,10 @@ class EntitySamples(BaseSamples):
         ner_tags_list = [samples.tags for samples in samples_list]
         merged_tags = merge_ner_tags(ner_tags_list, min_dups=min_dups)
 
-        new_data_list = []
-        for data, tags in zip(samples_list[0], merged_tags):
-            new_data = deepcopy(data)
-            new_data['tags'] = tags
-            new_data_list.append(new_data)
+        new_data_list = [
+            dict(data, tags=tags)
+            for data, tags in zip(samples_list[0], merged_tags)
+        ]
         labels_list = deepcopy(samples_list[0].labels_list)
 
         return EntitySamples(data_list=new_data_list, labels_list=labels_list)
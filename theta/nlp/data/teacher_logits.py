@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+知识蒸馏的教师logits缓存
+
+教师模型(或集成)在编码后的训练集上只运行一次，输出按样本顺序写入mmap数组，
+与数据集缓存逐行对齐。学生模型每个epoch直接读取soft targets，不再运行教师。
+
+目录结构:
+    {store_path}/meta.pkl               字段描述、样本数、数据集指纹
+    {store_path}/{key}.data.npy         序列输出: 所有样本有效token拼接后的(总token数, num_labels)
+                                        分类输出: (样本数, num_labels)
+    {store_path}/{key}.offsets.npy      序列输出第i个样本为data[offsets[i]:offsets[i+1]]
+"""
+
+import hashlib
+import os
+import shutil
+
+try:
+    import dill
+except:
+    import pickle as dill
+import numpy as np
+import torch
+from loguru import logger
+
+TEACHER_PREFIX = 'teacher_'
+
+
+def dataset_fingerprint(dataset):
+    """
+    由样本数和各样本有效token数计算的指纹，用于检查教师logits与数据集是否对齐
+    """
+    lengths = np.asarray(dataset.get_lengths(), dtype=np.int64)
+    return hashlib.sha1(lengths.tobytes()).hexdigest()
+
+
+class TeacherLogitsWriter(object):
+    """
+    按数据集顺序逐批写入教师输出，缓冲区按数据集大小预分配，写完后整体替换目录
+    """
+
+    def __init__(self, store_path, lengths, dtype=np.float16):
+        """
+        lengths: 每个样本的有效token数(attention_mask之和)
+        """
+        self.store_path = store_path
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.dtype = np.dtype(dtype)
+        self.columns = {}
+        self.arrays = {}
+        self.size = 0
+
+        self.tmp_path = f"{store_path}.tmp"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def _allocate(self, key, value):
+        # (batch_size, seq_len, num_labels)为序列输出，(batch_size, num_labels)为分类输出
+        is_sequence = value.ndim == 3
+        num_rows = int(self.offsets[-1]) if is_sequence else len(self.lengths)
+        self.columns[key] = {
+            'sequence': is_sequence,
+            'shape': list(value.shape[-1:]),
+        }
+        return np.lib.format.open_memmap(os.path.join(self.tmp_path,
+                                                      f"{key}.data.npy"),
+                                         mode='w+',
+                                         dtype=self.dtype,
+                                         shape=(num_rows, value.shape[-1]))
+
+    def write(self, outputs):
+        """
+        outputs: {key: 张量或数组}，第一维为batch，依次对应数据集中接下来的样本
+        """
+        start = self.size
+        stop = None
+        for key, value in outputs.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().float().cpu().numpy()
+            if stop is None:
+                stop = start + len(value)
+                assert stop <= len(self.lengths), \
+                    f"Wrote {stop} samples, more than {len(self.lengths)}."
+            if key not in self.arrays:
+                self.arrays[key] = self._allocate(key, value)
+            data = self.arrays[key]
+            if self.columns[key]['sequence']:
+                # 只保存有效token，左对齐
+                lengths = self.lengths[start:stop]
+                valid = np.arange(value.shape[1])[None, :] < lengths[:, None]
+                assert (lengths <= value.shape[1]).all(), \
+                    f"Teacher output {key} is shorter than the samples."
+                data[self.offsets[start]:self.offsets[stop]] = value[valid]
+            else:
+                data[start:stop] = value
+        self.size = stop if stop is not None else start
+
+    def close(self, fingerprint=None):
+        assert self.size == len(self.lengths), \
+            f"Only {self.size} of {len(self.lengths)} samples were written."
+        for key, data in self.arrays.items():
+            data.flush()
+            if self.columns[key]['sequence']:
+                np.save(os.path.join(self.tmp_path, f"{key}.offsets.npy"),
+                        self.offsets)
+        self.arrays = {}
+
+        meta = {
+            'num_samples': len(self.lengths),
+            'columns': self.columns,
+            'fingerprint': fingerprint,
+        }
+        dill.dump(meta, open(os.path.join(self.tmp_path, "meta.pkl"), 'wb'))
+
+        # 写完整后再替换，避免中断留下不完整的缓存
+        if os.path.exists(self.store_path):
+            shutil.rmtree(self.store_path)
+        os.rename(self.tmp_path, self.store_path)
+
+
+class TeacherLogitsStore(object):
+    """
+    mmap方式读取TeacherLogitsWriter写入的教师输出
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        meta = dill.load(open(os.path.join(store_path, "meta.pkl"), 'rb'))
+        self.num_samples = meta['num_samples']
+        self.columns = meta['columns']
+        self.fingerprint = meta['fingerprint']
+
+        self._arrays = None
+
+    def _open(self):
+        arrays = {}
+        for key, column in self.columns.items():
+            data = np.load(os.path.join(self.store_path, f"{key}.data.npy"),
+                           mmap_mode='r')
+            offsets = np.load(os.path.join(self.store_path,
+                                           f"{key}.offsets.npy"),
+                              mmap_mode='r') if column['sequence'] else None
+            arrays[key] = (data, offsets)
+        return arrays
+
+    @property
+    def arrays(self):
+        # 延迟打开，fork出的DataLoader worker各自映射同一文件
+        if self._arrays is None:
+            self._arrays = self._open()
+        return self._arrays
+
+    def check_aligned(self, dataset):
+        if len(dataset) != self.num_samples:
+            raise ValueError(
+                f"Teacher logits in {self.store_path} have {self.num_samples} samples, "
+                f"but the dataset has {len(dataset)}.")
+        if self.fingerprint is not None and self.fingerprint != dataset_fingerprint(
+                dataset):
+            raise ValueError(
+                f"Teacher logits in {self.store_path} are not aligned with the dataset, "
+                f"recompute them after the dataset cache changed.")
+
+    def __getitem__(self, idx):
+        """
+        返回 {key: float32张量}，序列输出为(有效token数, num_labels)
+        """
+        outputs = {}
+        for key, (data, offsets) in self.arrays.items():
+            if offsets is not None:
+                value = data[offsets[idx]:offsets[idx + 1]]
+            else:
+                value = data[idx]
+            outputs[key] = torch.from_numpy(np.array(value, dtype=np.float32))
+        return outputs
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+class DistillationDataset(object):
+    """
+    在原数据集的样本中加入教师输出 teacher_{key}，
+    collate_fn在原collate_fn之后把序列输出补齐到batch的序列长度。
+    """
+
+    def __init__(self, dataset, store):
+        store.check_aligned(dataset)
+        self.dataset = dataset
+        self.store = store
+
+    def __getattr__(self, name):
+        # sids, seg_spans, get_lengths等沿用原数据集
+        if name in ('dataset', 'store'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, idx):
+        sample = dict(self.dataset[idx])
+        for key, value in self.store[idx].items():
+            sample[f"{TEACHER_PREFIX}{key}"] = value
+        return sample
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def collate_fn(self, batch):
+        teacher_keys = [
+            f"{TEACHER_PREFIX}{key}" for key in self.store.columns.keys()
+        ]
+        stacked_batch = self.dataset.collate_fn([{
+            k: v
+            for k, v in sample.items() if k not in teacher_keys
+        } for sample in batch])
+        seq_len = stacked_batch['input_ids'].shape[1]
+        for key, column in self.store.columns.items():
+            values = [sample[f"{TEACHER_PREFIX}{key}"] for sample in batch]
+            if column['sequence']:
+                padded = values[0].new_zeros(
+                    (len(values), seq_len, values[0].shape[-1]))
+                for i, value in enumerate(values):
+                    padded[i, :len(value)] = value[:seq_len]
+                stacked_batch[f"{TEACHER_PREFIX}{key}"] = padded
+            else:
+                stacked_batch[f"{TEACHER_PREFIX}{key}"] = torch.stack(values)
+        return stacked_batch
+
+
+def pop_teacher_outputs(batch):
+    """
+    从batch中取出教师输出，返回 {key: 张量}
+    """
+    return {
+        key[len(TEACHER_PREFIX):]: batch.pop(key)
+        for key in [k for k in batch.keys() if k.startswith(TEACHER_PREFIX)]
+    }
+
+
+def load_teacher_logits(store_path):
+    store = TeacherLogitsStore(store_path)
+    logger.info(
+        f"Load teacher logits {len(store)} lines ({', '.join(store.columns)}) from {store_path}"
+    )
+    return store
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+导出GLUE(MyGlueModel)、NER(BertSpanModel)模型为TorchScript和ONNX，
+batch和sequence两个维度为动态维度，并使用CPURuntime在CPU上推理。
+
+    python -m theta.nlp.export \
+        --task ner \
+        --checkpoint_path outputs/latest/checkpoint \
+        --output_dir outputs/latest/export
+
+导出后用不同batch大小、序列长度的输入对比导出模型与eager模型的输出。
+"""
+
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from loguru import logger
+
+INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+OUTPUT_NAMES = {
+    'glue': ['logits'],
+    'ner': ['start_logits', 'end_logits'],
+}
+
+TORCHSCRIPT_FILE = "model.torchscript.pt"
+ONNX_FILE = "model.onnx"
+
+
+class ExportWrapper(nn.Module):
+    """
+    固定输入为(input_ids, attention_mask, token_type_ids)，输出为张量元组
+    """
+
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.model(input_ids=input_ids,
+                             attention_mask=attention_mask,
+                             token_type_ids=token_type_ids)
+        if isinstance(outputs, torch.Tensor):
+            outputs = (outputs, )
+        return tuple(outputs)
+
+
+def load_task_model(task, checkpoint_path, num_labels=None):
+    """
+    载入TaskRunner.save_model()保存的模型，num_labels默认取config中的值
+    """
+    from transformers import AutoConfig
+
+    if num_labels is None:
+        num_labels = AutoConfig.from_pretrained(checkpoint_path).num_labels
+    if task == 'glue':
+        from .tasks.task_glue import MyGlueModel
+        model = MyGlueModel(model_name_or_path=checkpoint_path,
+                            num_labels=num_labels)
+    elif task == 'ner':
+        from .tasks.task_ner import BertSpanModel
+        model = BertSpanModel(model_name_or_path=checkpoint_path,
+                              num_labels=num_labels)
+    else:
+        raise ValueError(f"Unknown task {task}, must be 'glue' or 'ner'.")
+    model.load_from_runner_checkpoint(checkpoint_path)
+    model.eval()
+    return model
+
+
+def generate_dummy_inputs(tokenizer, batch_size=2, seq_length=16):
+    """
+    由tokenizer的词表生成随机输入，第二条样本带padding
+    """
+    vocab_size = len(tokenizer)
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_length))
+    attention_mask = torch.ones(batch_size, seq_length, dtype=torch.long)
+    if batch_size > 1 and seq_length > 2:
+        attention_mask[1, seq_length // 2:] = 0
+        input_ids[1, seq_length // 2:] = tokenizer.pad_token_id or 0
+    token_type_ids = torch.zeros(batch_size, seq_length, dtype=torch.long)
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'token_type_ids': token_type_ids
+    }
+
+
+def export_torchscript(model, output_file, dummy_inputs):
+    wrapper = ExportWrapper(model).eval()
+    example_inputs = tuple(dummy_inputs[k] for k in INPUT_NAMES)
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example_inputs, strict=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(output_file)
+    logger.info(f"Save TorchScript model in {output_file}")
+    return output_file
+
+
+def export_onnx(model, output_file, dummy_inputs, task, opset_version=14):
+    wrapper = ExportWrapper(model).eval()
+    example_inputs = tuple(dummy_inputs[k] for k in INPUT_NAMES)
+    output_names = OUTPUT_NAMES[task]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES}
+    dynamic_axes.update(
+        {name: {
+            0: 'batch',
+            1: 'sequence'
+        }
+         for name in output_names if task == 'ner'})
+    dynamic_axes.update(
+        {name: {
+            0: 'batch'
+        }
+         for name in output_names if task == 'glue'})
+    with torch.no_grad():
+        torch.onnx.export(wrapper,
+                          example_inputs,
+                          output_file,
+                          input_names=INPUT_NAMES,
+                          output_names=output_names,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+    logger.info(f"Save ONNX model in {output_file}")
+    return output_file
+
+
+class CPURuntime:
+    """
+    在CPU上运行导出的模型，根据文件后缀选择ONNX Runtime或TorchScript
+    intra_op_threads: 单个算子内部的并行线程数
+    inter_op_threads: 算子之间的并行线程数
+    """
+
+    def __init__(self, model_file, intra_op_threads=None,
+                 inter_op_threads=None):
+        self.model_file = model_file
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+        if model_file.endswith('.onnx'):
+            self.backend = 'onnx'
+            self.session = self._load_onnx(model_file)
+        else:
+            self.backend = 'torchscript'
+            self.module = self._load_torchscript(model_file)
+
+    def _load_onnx(self, model_file):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "onnxruntime is required to run ONNX models, "
+                "please install it with `pip install onnxruntime`.")
+        options = ort.SessionOptions()
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(model_file,
+                                    sess_options=options,
+                                    providers=['CPUExecutionProvider'])
+
+    def _load_torchscript(self, model_file):
+        if self.intra_op_threads:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError as e:
+                # 进程中已经执行过并行计算后不能再设置
+                logger.warning(f"set_num_interop_threads failed: {e}")
+        module = torch.jit.load(model_file, map_location='cpu')
+        module.eval()
+        return module
+
+    def __call__(self, input_ids, attention_mask, token_type_ids):
+        """
+        输入为numpy数组或张量，返回numpy数组元组
+        """
+        inputs = [input_ids, attention_mask, token_type_ids]
+        if self.backend == 'onnx':
+            feeds = {
+                name: (x.cpu().numpy() if isinstance(x, torch.Tensor) else
+                       np.asarray(x)).astype(np.int64)
+                for name, x in zip(INPUT_NAMES, inputs)
+            }
+            return tuple(self.session.run(None, feeds))
+        else:
+            inputs = [
+                x.cpu() if isinstance(x, torch.Tensor) else torch.as_tensor(
+                    np.asarray(x, dtype=np.int64)) for x in inputs
+            ]
+            with torch.no_grad():
+                outputs = self.module(*inputs)
+            return tuple(x.numpy() for x in outputs)
+
+
+def check_parity(model,
+                 runtime,
+                 tokenizer,
+                 shapes=((1, 8), (3, 17), (8, 64)),
+                 atol=1e-4):
+    """
+    用不同batch大小、序列长度的输入比较runtime与eager模型的输出，
+    返回最大绝对误差，超过atol时抛出AssertionError
+    """
+    wrapper = ExportWrapper(model).eval()
+    max_diff = 0.0
+    for batch_size, seq_length in shapes:
+        inputs = generate_dummy_inputs(tokenizer, batch_size, seq_length)
+        with torch.no_grad():
+            expected = [
+                x.numpy() for x in wrapper(*[inputs[k] for k in INPUT_NAMES])
+            ]
+        actual = runtime(*[inputs[k] for k in INPUT_NAMES])
+        assert len(expected) == len(actual)
+        for e, a in zip(expected, actual):
+            assert e.shape == a.shape, f"shape {a.shape} != {e.shape}"
+            max_diff = max(max_diff, float(np.abs(e - a).max()))
+    logger.info(
+        f"{runtime.backend} parity: max abs diff {max_diff:.2e} (atol {atol})")
+    assert max_diff <= atol, f"{runtime.backend} max abs diff {max_diff} > {atol}"
+    return max_diff
+
+
+def benchmark_runtime(runtime, tokenizer, batch_size=8, seq_length=128,
+                      rounds=20):
+    inputs = generate_dummy_inputs(tokenizer, batch_size, seq_length)
+    inputs = [inputs[k] for k in INPUT_NAMES]
+    runtime(*inputs)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        runtime(*inputs)
+    elapsed = (time.perf_counter() - t0) / rounds * 1000
+    logger.info(
+        f"{runtime.backend}: {elapsed:.2f} ms/batch (batch_size: {batch_size}, seq_length: {seq_length})"
+    )
+    return elapsed
+
+
+def export_model(task,
+                 checkpoint_path,
+                 output_dir,
+                 num_labels=None,
+                 formats=('torchscript', 'onnx'),
+                 opset_version=14,
+                 atol=1e-4):
+    """
+    导出模型并做一致性检查，返回{format: model_file}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_task_model(task, checkpoint_path, num_labels=num_labels)
+    tokenizer = model.tokenizer
+    # 保存config和词表，推理时由output_dir载入tokenizer
+    model.save_model(output_dir)
+
+    dummy_inputs = generate_dummy_inputs(tokenizer)
+    exported = {}
+    for fmt in formats:
+        if fmt == 'torchscript':
+            model_file = export_torchscript(
+                model, os.path.join(output_dir, TORCHSCRIPT_FILE),
+                dummy_inputs)
+        elif fmt == 'onnx':
+            model_file = export_onnx(model,
+                                     os.path.join(output_dir, ONNX_FILE),
+                                     dummy_inputs,
+                                     task,
+                                     opset_version=opset_version)
+        else:
+            raise ValueError(
+                f"Unknown format {fmt}, must be 'torchscript' or 'onnx'.")
+        check_parity(model, CPURuntime(model_file), tokenizer, atol=atol)
+        exported[fmt] = model_file
+    return exported
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--task", choices=['glue', 'ner'], required=True)
+    parser.add_argument("--checkpoint_path",
+                        required=True,
+                        help="Directory saved by TaskRunner.save_model().")
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument(
+        "--num_labels",
+        type=int,
+        default=None,
+        help="Number of model outputs, default is num_labels in config.")
+    parser.add_argument("--formats", default="torchscript,onnx")
+    parser.add_argument("--opset_version", type=int, default=14)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--benchmark", action="store_true")
+    args = parser.parse_args()
+
+    exported = export_model(args.task,
+                            args.checkpoint_path,
+                            args.output_dir,
+                            num_labels=args.num_labels,
+                            formats=[x for x in args.formats.split(',') if x],
+                            opset_version=args.opset_version,
+                            atol=args.atol)
+    if args.benchmark:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.output_dir)
+        for model_file in exported.values():
+            benchmark_runtime(CPURuntime(model_file), tokenizer)
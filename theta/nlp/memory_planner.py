@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+训练前自动选择batch_size
+
+用训练集中的样本补齐到指定长度构造探测batch，以TaskRunner.training_step()做前向+反向，
+batch_size逐次倍增直到超出memory_budget_mb或OOM，可选地在transformer主干上开启
+activation checkpointing再探测一遍，选出训练长度下能放下的最大batch_size。
+
+CUDA上以峰值显存计，CPU上以参数、梯度与反向传播保存的激活值之和估算，
+两者都另加AdamW的优化器状态(参数大小的2倍)。
+"""
+
+import math
+import time
+
+import torch
+from loguru import logger
+
+
+def set_activation_checkpointing(model, enabled=True):
+    """
+    对model中的transformers预训练模型(BertModel等)开启或关闭activation checkpointing
+    返回是否找到支持的模块
+    """
+    from transformers import PreTrainedModel
+
+    found = False
+    for module in model.modules():
+        if not isinstance(module, PreTrainedModel) or not getattr(
+                module, 'supports_gradient_checkpointing', True):
+            continue
+        if hasattr(module, 'gradient_checkpointing_enable'):
+            if enabled:
+                module.gradient_checkpointing_enable()
+            else:
+                module.gradient_checkpointing_disable()
+        else:
+            module.config.gradient_checkpointing = enabled
+        found = True
+    return found
+
+
+def make_probe_batch(dataset, batch_size, seq_len):
+    """
+    取数据集前batch_size个样本(不足时循环)组成batch，
+    序列维与input_ids一致的张量循环填充/截断到seq_len，attention_mask全部为1
+    """
+    samples = [dataset[i % len(dataset)] for i in range(batch_size)]
+    batch = dataset.collate_fn(samples)
+    batch_len = batch['input_ids'].shape[1]
+    index = torch.arange(seq_len) % batch_len
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor) and value.dim(
+        ) >= 2 and value.shape[1] == batch_len:
+            batch[key] = value[:, index]
+    batch['attention_mask'] = torch.ones_like(batch['attention_mask'])
+    return batch
+
+
+def _state_bytes(runner):
+    """
+    参数、梯度、AdamW优化器状态的字节数
+    """
+    param_bytes = 0
+    trainable_bytes = 0
+    for p in runner.parameters():
+        param_bytes += p.numel() * p.element_size()
+        if p.requires_grad:
+            trainable_bytes += p.numel() * p.element_size()
+    return param_bytes, trainable_bytes, 2 * trainable_bytes
+
+
+def probe_training_step(runner, dataset, batch_size, seq_len, device, steps=2):
+    """
+    以batch_size * seq_len的batch运行runner.training_step()和反向传播，
+    返回 {'step_ms', 'memory_mb', 'saved_mb'}，OOM时抛出RuntimeError
+    """
+    from torch.autograd.graph import saved_tensors_hooks
+
+    device = torch.device(device)
+    batch = make_probe_batch(dataset, batch_size, seq_len)
+
+    def train_step(batch, pack_hook=None):
+        batch = {
+            k: v.to(device) if isinstance(v, torch.Tensor) else v
+            for k, v in batch.items()
+        }
+        if pack_hook is not None:
+            with saved_tensors_hooks(pack_hook, lambda x: x):
+                loss = runner.training_step(batch, 0)['loss']
+        else:
+            loss = runner.training_step(batch, 0)['loss']
+        loss.backward()
+        del loss
+        runner.zero_grad(set_to_none=True)
+
+    saved_bytes = [0]
+
+    def pack_hook(x):
+        saved_bytes[0] += x.numel() * x.element_size()
+        return x
+
+    # training_step()中的self.log()需要Trainer，探测时忽略
+    runner.log = lambda *args, **kwargs: None
+    try:
+        train_step(dict(batch), pack_hook=pack_hook)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            train_step(dict(batch))
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_ms = (time.perf_counter() - t0) / steps * 1000
+    finally:
+        del runner.log
+
+    param_bytes, grad_bytes, optimizer_bytes = _state_bytes(runner)
+    if device.type == 'cuda':
+        # 参数与梯度已计入峰值显存
+        memory_bytes = torch.cuda.max_memory_allocated(
+            device) + optimizer_bytes
+    else:
+        memory_bytes = param_bytes + grad_bytes + optimizer_bytes + saved_bytes[
+            0]
+    return {
+        'step_ms': step_ms,
+        'memory_mb': memory_bytes / 2**20,
+        'saved_mb': saved_bytes[0] / 2**20
+    }
+
+
+def _is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def plan_batch_size(runner,
+                    dataset,
+                    memory_budget_mb,
+                    max_length,
+                    max_batch_size=256,
+                    seq_lens=None,
+                    try_checkpointing=False,
+                    device=None,
+                    steps=2):
+    """
+    在seq_lens(默认max_length/4, max_length/2, max_length)上按1, 2, 4, ...探测batch_size，
+    超出memory_budget_mb或OOM时停止。返回
+    {'batch_size', 'max_length', 'activation_checkpointing', 'rows'}，
+    batch_size为max_length下能放下的最大值(相同时取吞吐量高的)，都放不下时为None。
+    runner.model的activation checkpointing设置为选中的配置。
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if seq_lens is None:
+        seq_lens = sorted({max(max_length // 4, 1), max(max_length // 2, 1),
+                           max_length})
+    batch_sizes = [
+        2**i for i in range(int(math.log2(max(max_batch_size, 1))) + 1)
+    ]
+
+    runner.to(device)
+    runner.train()
+    rows = []
+    # 各长度下不开启checkpointing时能放下的最大batch_size
+    largest_fits = {}
+    for checkpointing in ((False, True) if try_checkpointing else (False, )):
+        if checkpointing and not set_activation_checkpointing(
+                runner.model, True):
+            logger.warning(
+                f"{runner.model.__class__.__name__} does not support activation checkpointing."
+            )
+            break
+        for seq_len in seq_lens:
+            for batch_size in batch_sizes:
+                if checkpointing and batch_size < largest_fits.get(
+                        seq_len, 1):
+                    continue
+                row = {
+                    'max_length': seq_len,
+                    'batch_size': batch_size,
+                    'activation_checkpointing': checkpointing
+                }
+                try:
+                    row.update(
+                        probe_training_step(runner,
+                                            dataset,
+                                            batch_size,
+                                            seq_len,
+                                            device,
+                                            steps=steps))
+                except RuntimeError as e:
+                    if not _is_oom(e):
+                        raise
+                    runner.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+                    row.update({
+                        'step_ms': None,
+                        'memory_mb': None,
+                        'saved_mb': None
+                    })
+                row['fits'] = row['memory_mb'] is not None and row[
+                    'memory_mb'] <= memory_budget_mb
+                if row['step_ms'] is not None:
+                    row['samples_per_s'] = batch_size / row['step_ms'] * 1000
+                    row['tokens_per_s'] = row['samples_per_s'] * seq_len
+                rows.append(row)
+                if not row['fits']:
+                    break
+                if not checkpointing:
+                    largest_fits[seq_len] = batch_size
+    set_activation_checkpointing(runner.model, False)
+
+    candidates = [
+        x for x in rows if x['fits'] and x['max_length'] == max_length
+    ]
+    plan = {
+        'batch_size': None,
+        'max_length': max_length,
+        'activation_checkpointing': False,
+        'memory_budget_mb': memory_budget_mb,
+        'rows': rows
+    }
+    if candidates:
+        best = max(candidates,
+                   key=lambda x: (x['batch_size'], x['tokens_per_s']))
+        plan['batch_size'] = best['batch_size']
+        plan['activation_checkpointing'] = best['activation_checkpointing']
+        set_activation_checkpointing(runner.model,
+                                     best['activation_checkpointing'])
+
+    runner.cpu()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return plan
+
+
+def show_memory_plan(plan):
+
+    def fmt(x, width, precision=1):
+        if x is None:
+            return f"{'-':>{width}}"
+        return f"{x:>{width}.{precision}f}"
+
+    logger.info(f"{'max_length':>10}{'batch_size':>11}{'ckpt':>6}"
+                f"{'step_ms':>10}{'samples/s':>11}{'tokens/s':>11}"
+                f"{'memory_mb':>11}{'fits':>6}")
+    for x in plan['rows']:
+        logger.info(f"{x['max_length']:>10}{x['batch_size']:>11}"
+                    f"{'y' if x['activation_checkpointing'] else 'n':>6}"
+                    f"{fmt(x['step_ms'], 10)}"
+                    f"{fmt(x.get('samples_per_s'), 11)}"
+                    f"{fmt(x.get('tokens_per_s'), 11, 0)}"
+                    f"{fmt(x['memory_mb'], 11)}"
+                    f"{'y' if x['fits'] else 'n':>6}")
+    logger.info(
+        f"Memory budget: {plan['memory_budget_mb']:.0f} MB, max_length: {plan['max_length']}, "
+        f"batch_size: {plan['batch_size']}, activation_checkpointing: {plan['activation_checkpointing']}"
+    )
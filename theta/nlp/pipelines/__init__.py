@@ -2,3 +2,4 @@
 # -*- coding: utf-8 -*-
 
 from .pipeline_text_classification import TextClassificationPipeline
+from .pipeline_ner import NerPipeline
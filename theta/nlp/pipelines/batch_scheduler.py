@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+from loguru import logger
+
+
+class MicroBatchScheduler:
+    """
+    合并并发请求的微批调度器
+
+    submit()提交单条数据并返回Future，后台线程取出第一条数据后最多等待max_wait_ms，
+    凑满max_batch_size条、补齐后的token数将超过max_batch_tokens或等待超时，
+    即调用process_fn(items)批量处理，process_fn返回与items一一对应的结果列表。
+    length_fn(item)返回单条数据的token数，max_batch_tokens为None时不限制。
+    """
+
+    def __init__(self,
+                 process_fn,
+                 max_batch_size=32,
+                 max_wait_ms=5.0,
+                 max_batch_tokens=None,
+                 length_fn=None,
+                 stats_window=10000):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_tokens = max_batch_tokens
+        self.length_fn = length_fn if length_fn is not None else len
+
+        self._queue = queue.Queue()
+        # 超出token预算留到下一个batch的请求
+        self._pending = None
+        self._thread = None
+        # stop()之后submit()抛出RuntimeError，与stop()互斥，保证停止标记之后不再入队
+        self._stopped = False
+        self._submit_lock = threading.Lock()
+        # 后台线程已取到停止标记
+        self._stop_seen = False
+
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=stats_window)
+        self.reset_stats()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._stop_seen = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        停止接收新请求，处理完已提交的请求后结束后台线程
+        """
+        with self._submit_lock:
+            self._stopped = True
+            if self._thread is None:
+                return
+            self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def submit(self, item):
+        future = Future()
+        with self._submit_lock:
+            if self._stopped:
+                raise RuntimeError("MicroBatchScheduler is stopped.")
+            self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def submit_many(self, items):
+        return [self.submit(x) for x in items]
+
+    def _fits(self, batch_lengths, length):
+        if len(batch_lengths) >= self.max_batch_size:
+            return False
+        if self.max_batch_tokens is None or not batch_lengths:
+            return True
+        # batch内补齐到最长后的token数
+        max_length = max(max(batch_lengths), length)
+        return max_length * (len(batch_lengths) + 1) <= self.max_batch_tokens
+
+    def _collect_batch(self):
+        if self._pending is not None:
+            first, self._pending = self._pending, None
+        else:
+            first = self._queue.get()
+        if first is None:
+            self._stop_seen = True
+            return []
+        batch = [first]
+        batch_lengths = [self.length_fn(first[0])]
+        deadline = first[2] + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size and not self._stop_seen:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    x = self._queue.get_nowait()
+                else:
+                    x = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if x is None:
+                self._stop_seen = True
+                break
+            length = self.length_fn(x[0])
+            if not self._fits(batch_lengths, length):
+                self._pending = x
+                break
+            batch.append(x)
+            batch_lengths.append(length)
+        return batch
+
+    def _run(self):
+        # 停止标记之前入队的请求都会被处理
+        while not self._stop_seen or self._pending is not None:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        items = [x[0] for x in batch]
+        try:
+            results = self.process_fn(items)
+            assert len(results) == len(
+                items
+            ), f"len(results): {len(results)} != len(items): {len(items)}"
+        except Exception as e:
+            logger.exception(e)
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        now = time.perf_counter()
+        with self._stats_lock:
+            self._num_batches += 1
+            self._num_items += len(batch)
+            self._latencies.extend(now - x[2] for x in batch)
+            if self._first_submit_time is None:
+                self._first_submit_time = min(x[2] for x in batch)
+            self._last_done_time = now
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._latencies.clear()
+            self._num_batches = 0
+            self._num_items = 0
+            self._first_submit_time = None
+            self._last_done_time = None
+
+    def stats(self):
+        """
+        返回吞吐量(条/秒)、平均batch大小和延迟分位数(毫秒)
+        """
+        with self._stats_lock:
+            latencies = np.array(self._latencies) * 1000
+            num_items = self._num_items
+            num_batches = self._num_batches
+            elapsed = (self._last_done_time - self._first_submit_time
+                       ) if self._first_submit_time is not None else 0.0
+        stats = {
+            'num_requests': num_items,
+            'num_batches': num_batches,
+            'queue_size': self._queue.qsize(),
+            'avg_batch_size': num_items / num_batches if num_batches else 0.0,
+            'throughput': num_items / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': 0.0,
+            'p99_ms': 0.0,
+        }
+        if len(latencies) > 0:
+            stats['p50_ms'] = float(np.percentile(latencies, 50))
+            stats['p99_ms'] = float(np.percentile(latencies, 99))
+        return stats
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+NER推理服务
+
+    python -m theta.nlp.pipelines.ner_server \
+        --checkpoint_path outputs/latest/checkpoint \
+        --ner_labels "name,address,company" \
+        --port 8080
+
+    GET  /health
+    GET  /stats                             吞吐量、p50/p99延迟
+    POST /predict  {"text": "..."}          -> {"tags": [...]}
+    POST /predict  {"texts": ["...", ...]}  -> {"results": [[...], ...]}
+
+并发请求中的文本由MicroBatchScheduler合并成batch推理，
+max_wait_ms控制凑batch的最长等待时间。
+"""
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+from ..tokenizers.token_cache import TokenizationCache
+from .batch_scheduler import MicroBatchScheduler
+from .pipeline_ner import NerPipeline
+
+
+class NerRequestHandler(BaseHTTPRequestHandler):
+    # 由create_server()设置
+    scheduler = None
+    request_timeout = 60.0
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(200, self.scheduler.stats())
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except Exception as e:
+            self._send_json(400, {'error': f"Invalid json: {e}"})
+            return
+
+        if not isinstance(data, dict):
+            self._send_json(400, {'error': "Request must be a json object."})
+            return
+
+        if isinstance(data.get('text', None), str):
+            texts = [data['text']]
+        elif isinstance(data.get('texts', None), list) and all(
+                isinstance(x, str) for x in data['texts']):
+            texts = data['texts']
+        else:
+            self._send_json(
+                400, {'error': "Request must contain 'text' or 'texts'."})
+            return
+
+        try:
+            futures = self.scheduler.submit_many(texts)
+            results = [f.result(timeout=self.request_timeout) for f in futures]
+        except Exception as e:
+            logger.exception(e)
+            self._send_json(500, {'error': str(e)})
+            return
+
+        if 'text' in data:
+            self._send_json(200, {'tags': results[0]})
+        else:
+            self._send_json(200, {'results': results})
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def create_server(pipeline,
+                  host='0.0.0.0',
+                  port=8080,
+                  max_batch_size=32,
+                  max_wait_ms=5.0):
+    """
+    返回(server, scheduler)，调用server.serve_forever()启动服务
+    """
+    scheduler = MicroBatchScheduler(pipeline.predict,
+                                    max_batch_size=max_batch_size,
+                                    max_wait_ms=max_wait_ms).start()
+    handler_cls = type('NerRequestHandler', (NerRequestHandler, ),
+                       {'scheduler': scheduler})
+    server = ThreadingHTTPServer((host, port), handler_cls)
+    server.daemon_threads = True
+    return server, scheduler
+
+
+def main(args):
+    ner_labels = [x.strip() for x in args.ner_labels.split(',') if x.strip()]
+    token_cache = None
+    if args.token_cache_entries > 0 or args.token_cache_dir is not None:
+        token_cache = TokenizationCache(args.token_cache_dir,
+                                        max_entries=args.token_cache_entries)
+    pipeline = NerPipeline(args.checkpoint_path,
+                           ner_labels,
+                           max_length=args.max_length,
+                           batch_size=args.max_batch_size,
+                           confidence=args.confidence,
+                           resolve_overlap=args.resolve_overlap,
+                           device=args.device,
+                           token_cache=token_cache)
+    server, scheduler = create_server(pipeline,
+                                      host=args.host,
+                                      port=args.port,
+                                      max_batch_size=args.max_batch_size,
+                                      max_wait_ms=args.max_wait_ms)
+    logger.info(f"NER server listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_path",
+                        required=True,
+                        help="Directory saved by TaskRunner.save_model().")
+    parser.add_argument("--ner_labels",
+                        required=True,
+                        help="Comma separated NER labels in training order.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max_length", type=int, default=256)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--confidence", type=float, default=0.0)
+    parser.add_argument("--resolve_overlap", action="store_true")
+    parser.add_argument("--device", default=None, help="cpu or cuda")
+    parser.add_argument(
+        "--token_cache_entries",
+        type=int,
+        default=0,
+        help="Cache tokenizer outputs of this many segments in memory.")
+    parser.add_argument(
+        "--token_cache_dir",
+        default=None,
+        help="Persist cached tokenizer outputs in this directory.")
+    args = parser.parse_args()
+
+    main(args)
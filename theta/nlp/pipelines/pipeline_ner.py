@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Union
+
+import torch
+import torch.nn.functional as F
+
+from theta.nlp.tasks.task_ner import (BertSpanModel, merge_segment_entities,
+                                      split_text_segments)
+from theta.nlp.tokenizers.alignment import offsets_to_token_spans
+
+
+class NerPipeline:
+    """
+    常驻内存的NER推理流程
+    只载入一次BertSpanModel，进程内完成滑动窗口切分、编码、推理和解码，
+    不经过pl.Trainer和数据集缓存。
+    """
+
+    def __init__(self,
+                 checkpoint_path,
+                 ner_labels,
+                 max_length=256,
+                 batch_size=32,
+                 confidence=0.0,
+                 resolve_overlap=False,
+                 device=None,
+                 token_cache=None):
+        """
+        checkpoint_path: TaskRunner.save_model()保存的目录，
+                         包含config.json、vocab.txt、pl_model.ckpt
+        token_cache: TokenizationCache，重复请求的片段不再tokenize
+        """
+        self.checkpoint_path = checkpoint_path
+        self.ner_labels = ner_labels
+        self.id2label = {i + 1: x for i, x in enumerate(ner_labels)}
+        self.num_labels = len(ner_labels) + 1
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.confidence = confidence
+        self.resolve_overlap = resolve_overlap
+        self.token_cache = token_cache
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+        self.model = self.load_model(checkpoint_path)
+        self.tokenizer = self.model.tokenizer
+
+    def load_model(self, checkpoint_path):
+        model = BertSpanModel(model_name_or_path=checkpoint_path,
+                              num_labels=self.num_labels)
+        model.load_from_runner_checkpoint(checkpoint_path)
+        model.to(self.device)
+        model.eval()
+        return model
+
+    def split_texts(self, texts):
+        """
+        返回 seg_spans: [(guid, s_seg, e_seg), ...], seg_texts: [seg_text, ...]
+        """
+        seg_len = self.max_length - 2
+        seg_stride = int(seg_len / 2)
+        seg_spans = []
+        seg_texts = []
+        for guid, text in enumerate(texts):
+            for s_seg, e_seg, seg_text in split_text_segments(
+                    text, seg_len, seg_stride):
+                seg_spans.append((guid, s_seg, e_seg))
+                seg_texts.append(seg_text)
+        return seg_spans, seg_texts
+
+    def encode(self, seg_texts):
+        """
+        返回padding后的模型输入张量和各片段的offset_mapping
+        """
+        if self.token_cache is None:
+            encodings = self.tokenizer(seg_texts,
+                                       padding=True,
+                                       max_length=self.max_length,
+                                       add_special_tokens=True,
+                                       truncation=True,
+                                       return_offsets_mapping=True,
+                                       return_tensors='pt')
+            offset_mapping = encodings.pop('offset_mapping').tolist()
+            return encodings, offset_mapping
+
+        encodings = self.token_cache.batch_encode(self.tokenizer,
+                                                  seg_texts,
+                                                  max_length=self.max_length,
+                                                  add_special_tokens=True,
+                                                  truncation=True,
+                                                  return_offsets_mapping=True)
+        offset_mapping = encodings.pop('offset_mapping')
+        max_len = max(len(x) for x in offset_mapping)
+        # 与padding=True时的offset_mapping一致，padding位置为(0, 0)
+        offset_mapping = [
+            list(x) + [(0, 0)] * (max_len - len(x)) for x in offset_mapping
+        ]
+        encodings = self.tokenizer.pad(encodings,
+                                       padding=True,
+                                       return_tensors='pt')
+        return encodings, offset_mapping
+
+    @torch.no_grad()
+    def predict_segments(self, seg_texts):
+        """
+        返回每个片段的预测结果 [{category: [(start, end), ...]}, ...]，位置为片段内的字符位置
+        """
+        seg_preds = []
+        for i in range(0, len(seg_texts), self.batch_size):
+            batch_texts = seg_texts[i:i + self.batch_size]
+            encodings, offset_mapping = self.encode(batch_texts)
+            inputs = {k: v.to(self.device) for k, v in encodings.items()}
+            start_logits, end_logits = self.model(**inputs)
+
+            start_probs = F.softmax(start_logits, -1).cpu().numpy()
+            end_probs = F.softmax(end_logits, -1).cpu().numpy()
+            batch_lens = inputs['attention_mask'].sum(-1).cpu().numpy()
+            batch_pred_tags = self.model.decode_ents(
+                start_probs,
+                end_probs,
+                batch_lens=batch_lens,
+                confidence=self.confidence)
+
+            for pred_tags, offsets in zip(batch_pred_tags, offset_mapping):
+                token_spans = offsets_to_token_spans(offsets)
+                for c, tags in pred_tags.items():
+                    pred_tags[c] = [(token_spans[s][0], token_spans[e][1] - 1)
+                                    for s, e in tags]
+                seg_preds.append(pred_tags)
+        return seg_preds
+
+    def predict(self, texts):
+        """
+        texts: [text, ...]
+        返回 [[{'category', 'start', 'mention'}, ...], ...]
+        """
+        seg_spans, seg_texts = self.split_texts(texts)
+        seg_preds = self.predict_segments(seg_texts)
+
+        results = [[] for _ in texts]
+        for guid, ents in merge_segment_entities(
+                seg_spans, seg_preds, resolve_overlap=self.resolve_overlap):
+            text = texts[guid]
+            tags = []
+            for c, s, e in ents:
+                mention = text[s:e + 1]
+                if len(mention) == 0:
+                    continue
+                tags.append({
+                    'category': self.id2label[c],
+                    'start': s,
+                    'mention': mention
+                })
+            results[guid] = sorted(tags, key=lambda x: x['start'])
+        return results
+
+    def __call__(self, text: Union[str, list]):
+        if isinstance(text, str):
+            return self.predict([text])[0]
+        elif isinstance(text, list):
+            return self.predict(text)
+        else:
+            raise TypeError(f"text({type(text)}) type must be str or list.")
@@ -2,45 +2,130 @@
 # -*- coding: utf-8 -*-
 
 from typing import Union
-from tqdm import tqdm
-from loguru import logger
 
-from theta.nlp.data.samples import GlueSamples
-from theta.nlp.tasks import GlueData, GlueModel, GlueTask
+import torch
+
+from theta.nlp.tasks.task_glue import MyGlueModel
+
+from .batch_scheduler import MicroBatchScheduler
 
 
 class TextClassificationPipeline:
-    def __init__(self, checkpoint_path, num_labels, glue_labels):
+    """
+    常驻内存的文本分类推理流程
+
+    模型只在构造时载入一次。并发调用的文本在调用方线程中完成tokenize后进入
+    MicroBatchScheduler，按token预算(max_batch_tokens)和最长等待时间(max_wait_ms)
+    合并成batch推理，submit()返回每条文本的Future。
+    stats()返回吞吐量和p50/p99延迟。
+    """
+
+    def __init__(self,
+                 checkpoint_path,
+                 num_labels=None,
+                 glue_labels=None,
+                 max_length=512,
+                 max_batch_size=64,
+                 max_batch_tokens=8192,
+                 max_wait_ms=5.0,
+                 device=None,
+                 token_cache=None):
+        """
+        checkpoint_path: TaskRunner.save_model()保存的目录，
+                         包含config.json、vocab.txt、pl_model.ckpt
+        token_cache: TokenizationCache，重复请求的文本不再tokenize
+        """
+        assert num_labels is not None or glue_labels is not None
+        if glue_labels is None:
+            glue_labels = [f"{x}" for x in range(num_labels)]
         self.checkpoint_path = checkpoint_path
-        self.num_labels = num_labels
         self.glue_labels = glue_labels
+        self.num_labels = len(glue_labels)
+        self.max_length = max_length
+        self.token_cache = token_cache
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
 
-    def __call__(self,
-                 text: Union[str, list],
-                 max_length=512,
-                 glue_labels=None):
-
-        # -------------------- Data --------------------
-        def data_generator():
-            if isinstance(text, str):
-                yield 0, text, None, None
-            elif isinstance(text, list):
-                texts = text
-                for i, x in enumerate(texts):
-                    yield f"{i}", x, None, None
-            else:
-                raise TypeError(
-                    f"text({type(text)}) type must be str or list.")
-
-        test_samples = GlueSamples(labels_list=glue_labels if glue_labels else
-                                   [f"{x}" for x in range(self.num_labels)],
-                                   data_generator=data_generator)
-        data_args = {
-            'max_length': max_length,
-        }
-        task_data = GlueData(data_args,
-                             train_samples=None,
-                             test_samples=test_samples)
-
-        # -------------------- model --------------------
-        task_model = GlueModel(task_args, self.num_labels)
+        self.model = self.load_model(checkpoint_path)
+        self.tokenizer = self.model.tokenizer
+
+        self.scheduler = MicroBatchScheduler(
+            self.predict_encodings,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_batch_tokens=max_batch_tokens,
+            length_fn=lambda x: len(x['input_ids'])).start()
+
+    def load_model(self, checkpoint_path):
+        model = MyGlueModel(model_name_or_path=checkpoint_path,
+                            num_labels=self.num_labels)
+        model.load_from_runner_checkpoint(checkpoint_path)
+        model.to(self.device)
+        model.eval()
+        return model
+
+    def encode(self, text):
+        """
+        text: text_a 或 (text_a, text_b)
+        """
+        if isinstance(text, (tuple, list)):
+            text_a, text_b = text
+        else:
+            text_a, text_b = text, None
+        if self.token_cache is not None:
+            encodings = self.token_cache.batch_encode(
+                self.tokenizer,
+                [text_a] if text_b is None else [(text_a, text_b)],
+                max_length=self.max_length,
+                add_special_tokens=True,
+                truncation=True)
+            return {k: v[0] for k, v in encodings.items()}
+        return self.tokenizer(text_a,
+                              text_b,
+                              max_length=self.max_length,
+                              add_special_tokens=True,
+                              truncation=True)
+
+    @torch.no_grad()
+    def predict_encodings(self, encodings):
+        batch = self.tokenizer.pad(encodings,
+                                   padding=True,
+                                   return_tensors='pt')
+        inputs = {k: v.to(self.device) for k, v in batch.items()}
+        logits = self.model(**inputs)
+        probs = torch.softmax(logits, -1).cpu().numpy()
+
+        results = []
+        for x in probs:
+            label_id = int(x.argmax())
+            results.append({
+                'label': self.glue_labels[label_id],
+                'probs': x.tolist()
+            })
+        return results
+
+    def submit(self, text):
+        """
+        提交一条文本，返回Future，result()为{'label': label, 'probs': [...]}
+        """
+        return self.scheduler.submit(self.encode(text))
+
+    def __call__(self, text: Union[str, tuple, list], timeout=None):
+        if isinstance(text, (str, tuple)):
+            return self.submit(text).result(timeout=timeout)
+        elif isinstance(text, list):
+            futures = [self.submit(x) for x in text]
+            return [f.result(timeout=timeout) for f in futures]
+        else:
+            raise TypeError(
+                f"text({type(text)}) type must be str, tuple or list.")
+
+    def stats(self):
+        return self.scheduler.stats()
+
+    def reset_stats(self):
+        self.scheduler.reset_stats()
+
+    def close(self):
+        self.scheduler.stop()
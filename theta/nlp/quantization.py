@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+训练后动态int8量化
+
+只量化transformer主干(BertModel等)中的nn.Linear，任务层保持fp32。
+权重离线量化为int8，激活在推理时动态量化，不需要校准数据，量化后的模型只能在CPU上推理。
+"""
+
+import os
+import time
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+MODEL_INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+
+
+def quantize_linear_layers(module, dtype=torch.qint8):
+    """
+    原地将module中的nn.Linear替换为动态量化的Linear
+    """
+    module.to('cpu')
+    torch.quantization.quantize_dynamic(module, {nn.Linear},
+                                        dtype=dtype,
+                                        inplace=True)
+    return module
+
+
+def file_size_mb(file_path):
+    return os.path.getsize(file_path) / (1024 * 1024)
+
+
+@torch.no_grad()
+def benchmark_forward_latency(model, dataloader, num_batches=20, warmup=2):
+    """
+    在CPU上依次推理dataloader中的前num_batches个batch，返回平均每个batch的耗时(毫秒)
+    """
+    model.eval()
+    elapsed = []
+    for i, batch in enumerate(dataloader):
+        if i >= num_batches + warmup:
+            break
+        inputs = {
+            k: v.to('cpu')
+            for k, v in batch.items() if k in MODEL_INPUT_NAMES
+        }
+        t0 = time.perf_counter()
+        model(**inputs)
+        if i >= warmup:
+            elapsed.append(time.perf_counter() - t0)
+    if not elapsed:
+        return 0.0
+    return sum(elapsed) / len(elapsed) * 1000
+
+
+def compare_quantization(fp32_results, int8_results):
+    """
+    fp32_results, int8_results: {name: value}
+    返回 {name: {'fp32': a, 'int8': b, 'delta': b - a}}
+    """
+    report = {}
+    for k, v in fp32_results.items():
+        if k not in int8_results:
+            continue
+        report[k] = {
+            'fp32': float(v),
+            'int8': float(int8_results[k]),
+            'delta': float(int8_results[k]) - float(v)
+        }
+    return report
+
+
+def show_quantization_report(report):
+    logger.info(f"{'':<20}{'fp32':>12}{'int8':>12}{'delta':>12}")
+    for k, x in report.items():
+        logger.info(
+            f"{k:<20}{x['fp32']:>12.4f}{x['int8']:>12.4f}{x['delta']:>+12.4f}"
+        )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+知识蒸馏
+
+1. 教师模型(一个或多个checkpoint的集成)在训练集上推理一次，
+   输出写入与数据集缓存对齐的TeacherLogitsStore；
+2. 学生模型训练时从DistillationDataset的batch中取出teacher_*，
+   loss = (1 - kd_alpha) * loss + kd_alpha * kd_loss，不再运行教师模型。
+
+    python run_task.py --do_teacher_logits --kd_teacher_paths outputs/a/checkpoint,outputs/b/checkpoint
+    python run_task.py --do_train --enable_kd --model_name_or_path small_bert
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from loguru import logger
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from ..data.teacher_logits import TeacherLogitsWriter, dataset_fingerprint
+
+# 教师模型推理用到的输入
+TEACHER_INPUTS = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def distillation_loss(student_logits,
+                      teacher_logits,
+                      temperature=1.0,
+                      mask=None,
+                      multi_label=False):
+    """
+    soft targets的KL散度 KL(p_teacher || p_student) * T^2
+    multi_label时各类别独立，使用sigmoid的二元交叉熵
+    mask: 序列输出时为(batch_size, seq_len)，只在mask为1的位置上平均
+    """
+    teacher_logits = teacher_logits.to(student_logits)
+    T = temperature
+    if multi_label:
+        loss = F.binary_cross_entropy_with_logits(
+            student_logits / T,
+            torch.sigmoid(teacher_logits / T),
+            reduction='none').sum(-1)
+    else:
+        loss = F.kl_div(F.log_softmax(student_logits / T, dim=-1),
+                        F.log_softmax(teacher_logits / T, dim=-1),
+                        reduction='none',
+                        log_target=True).sum(-1)
+    if mask is not None:
+        mask = mask.to(loss.dtype)
+        loss = (loss * mask).sum() / mask.sum().clamp(min=1.0)
+    else:
+        loss = loss.mean()
+    return loss * T * T
+
+
+def teacher_engine(models, weights=None, max_workers=None):
+    """
+    多个教师模型用EnsembleEngine并发推理并加权平均logits
+    """
+    from .ner_models import EnsembleEngine
+    return EnsembleEngine(models, weights=weights, max_workers=max_workers)
+
+
+@torch.no_grad()
+def compute_teacher_logits(teacher,
+                           dataset,
+                           store_path,
+                           output_names,
+                           batch_size=32,
+                           device=None,
+                           input_names=TEACHER_INPUTS,
+                           dtype=np.float16):
+    """
+    按数据集顺序运行教师模型一次，输出写入store_path
+    teacher: EnsembleEngine，或者输入为batch的dict、输出为张量(元组)的callable
+    output_names: 教师输出的名称，如('start_logits', 'end_logits')或('logits', )
+    返回写入的样本数
+    """
+    lengths = dataset.get_lengths()
+    writer = TeacherLogitsWriter(store_path, lengths, dtype=dtype)
+
+    # 必须顺序读取，与数据集的样本一一对应
+    dataloader = DataLoader(dataset,
+                            batch_size=batch_size,
+                            shuffle=False,
+                            collate_fn=dataset.collate_fn)
+    for batch in tqdm(dataloader, desc="Teacher logits"):
+        inputs = {
+            k: v.to(device) if device is not None else v
+            for k, v in batch.items() if k in input_names
+        }
+        outputs = teacher(inputs)
+        if isinstance(outputs, torch.Tensor):
+            outputs = (outputs, )
+        writer.write(dict(zip(output_names, outputs)))
+    writer.close(fingerprint=dataset_fingerprint(dataset))
+
+    logger.info(
+        f"Saved teacher logits ({', '.join(output_names)}) of {len(lengths)} samples to {store_path}"
+    )
+    return len(lengths)
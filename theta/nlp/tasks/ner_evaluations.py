@@ -1,28 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import torch
 from loguru import logger
 import numpy as np
 from collections import defaultdict
-from .ner_decodes import crf_decode, span_decode, mrc_decode
+from .ner_decodes import (batch_crf_decode, batch_mrc_spans, build_tag_lookup,
+                          pad_tags)
 
 
 def calculate_metric(gt, predict):
     """
     计算 tp fp fn
+    按(mention, start)用集合匹配，与逐个比较的结果一致
     """
-    tp, fp, fn = 0, 0, 0
-    for entity_predict in predict:
-        flag = 0
-        for entity_gt in gt:
-            if entity_predict[0] == entity_gt[0] and entity_predict[
-                    1] == entity_gt[1]:
-                flag = 1
-                tp += 1
-                break
-        if flag == 0:
-            fp += 1
-
+    gt_keys = {(x[0], x[1]) for x in gt}
+    tp = sum(1 for x in predict if (x[0], x[1]) in gt_keys)
+    fp = len(predict) - tp
     fn = len(gt) - tp
 
     return np.array([tp, fp, fn])
@@ -35,38 +31,112 @@ def get_p_r_f(tp, fp, fn):
     return np.array([p, r, f1])
 
 
-def crf_evaluation(model, dev_info, device, ent2id):
-    dev_loader, (dev_callback_info, type_weight) = dev_info
-
-    pred_tokens = []
+class EvalCollector:
+    """
+    评估时的模型输出收集器
 
-    for tmp_pred in get_base_out(model, dev_loader, device):
-        pred_tokens.extend(tmp_pred[0])
+    每种输出按数据集大小预分配(num_rows, max_length, ...)的缓冲区，
+    指定mmap_dir时为磁盘上的memmap。每批结果写入对应的行，
+    不再逐批np.append复制整个数组；add()返回本批的行号范围，
+    调用方可以立即解码本批，内存占用不随评估进行而增长。
+    """
 
-    assert len(pred_tokens) == len(dev_callback_info)
+    def __init__(self, num_rows, max_length, mmap_dir=None):
+        self.num_rows = num_rows
+        self.max_length = max_length
+        self.size = 0
+        self.buffers = {}
+        self.mmap_dir = None
+        if mmap_dir is not None:
+            os.makedirs(mmap_dir, exist_ok=True)
+            self.mmap_dir = tempfile.mkdtemp(prefix="eval_", dir=mmap_dir)
+
+    @classmethod
+    def from_dataloader(cls, dataloader, max_length, mmap_dir=None):
+        return cls(len(dataloader.dataset), max_length, mmap_dir=mmap_dir)
+
+    def _allocate(self, name, x):
+        # 1维输出(如长度)每行一个值，其余输出的第2维为序列长度
+        shape = (self.num_rows, ) if x.ndim == 1 else (
+            self.num_rows, self.max_length) + x.shape[2:]
+        if self.mmap_dir is None:
+            return np.zeros(shape, dtype=x.dtype)
+        return np.lib.format.open_memmap(os.path.join(self.mmap_dir,
+                                                      f"{name}.npy"),
+                                         mode='w+',
+                                         dtype=x.dtype,
+                                         shape=shape)
+
+    def add(self, **outputs):
+        """
+        写入一批输出，返回本批的行号范围 (start, stop)
+        """
+        start = self.size
+        stop = None
+        for name, x in outputs.items():
+            if torch.is_tensor(x):
+                x = x.detach().cpu().numpy()
+            x = np.asarray(x)
+            if stop is None:
+                stop = start + len(x)
+                assert stop <= self.num_rows, \
+                    f"Collected {stop} rows, more than {self.num_rows}."
+            if name not in self.buffers:
+                self.buffers[name] = self._allocate(name, x)
+            buffer = self.buffers[name]
+            if x.ndim == 1:
+                buffer[start:stop] = x
+            else:
+                width = min(x.shape[1], self.max_length)
+                buffer[start:stop, :width] = x[:, :width]
+                buffer[start:stop, width:] = 0
+        self.size = stop if stop is not None else start
+        return start, self.size
+
+    def __getitem__(self, name):
+        return self.buffers[name][:self.size]
+
+    def close(self):
+        self.buffers = {}
+        if self.mmap_dir is not None:
+            shutil.rmtree(self.mmap_dir, ignore_errors=True)
+            self.mmap_dir = None
+
+
+def crf_evaluation(model, dev_info, device, ent2id, mmap_dir=None):
+    dev_loader, (dev_callback_info, type_weight) = dev_info
 
     id2ent = {ent2id[key]: key for key in ent2id.keys()}
+    tag_lookup = build_tag_lookup(id2ent)
 
     role_metric = np.zeros([13, 3])
 
     mirco_metrics = np.zeros(3)
 
-    for tmp_tokens, tmp_callback in zip(pred_tokens, dev_callback_info):
-
-        text, gt_entities = tmp_callback
+    collector = EvalCollector.from_dataloader(
+        dev_loader,
+        max(len(text) for text, _ in dev_callback_info) + 2,
+        mmap_dir=mmap_dir)
 
-        tmp_metric = np.zeros([13, 3])
-
-        pred_entities = crf_decode(tmp_tokens, text, id2ent)
+    for tmp_pred in get_base_out(model, dev_loader, device):
+        tags, lengths = pad_tags(tmp_pred[0])
+        start, stop = collector.add(tags=tags, lengths=lengths)
 
-        for idx, _type in enumerate(ENTITY_TYPES):
-            if _type not in pred_entities:
-                pred_entities[_type] = []
+        # 逐批解码
+        batch_pred_entities = batch_crf_decode(
+            (collector['tags'][start:stop], collector['lengths'][start:stop]),
+            [text for text, _ in dev_callback_info[start:stop]],
+            id2ent,
+            tag_lookup=tag_lookup)
 
-            tmp_metric[idx] += calculate_metric(gt_entities[_type],
-                                                pred_entities[_type])
+        for pred_entities, (text, gt_entities) in zip(
+                batch_pred_entities, dev_callback_info[start:stop]):
+            for idx, _type in enumerate(ENTITY_TYPES):
+                role_metric[idx] += calculate_metric(
+                    gt_entities[_type], pred_entities.get(_type, []))
 
-        role_metric += tmp_metric
+    assert collector.size == len(dev_callback_info)
+    collector.close()
 
     for idx, _type in enumerate(ENTITY_TYPES):
         temp_metric = get_p_r_f(role_metric[idx][0], role_metric[idx][1],
@@ -80,49 +150,47 @@ def crf_evaluation(model, dev_info, device, ent2id):
     return metric_str, mirco_metrics[2]
 
 
-def span_evaluation(model, dev_info, device, ent2id):
+def span_evaluation(model, dev_info, device, ent2id, mmap_dir=None):
     dev_loader, (dev_callback_info, type_weight) = dev_info
 
-    start_logits, end_logits = None, None
-
     model.eval()
 
-    for tmp_pred in get_base_out(model, dev_loader, device):
-        tmp_start_logits = tmp_pred[0].cpu().numpy()
-        tmp_end_logits = tmp_pred[1].cpu().numpy()
-
-        if start_logits is None:
-            start_logits = tmp_start_logits
-            end_logits = tmp_end_logits
-        else:
-            start_logits = np.append(start_logits, tmp_start_logits, axis=0)
-            end_logits = np.append(end_logits, tmp_end_logits, axis=0)
-
-    assert len(start_logits) == len(end_logits) == len(dev_callback_info)
-
     role_metric = np.zeros([13, 3])
 
     mirco_metrics = np.zeros(3)
 
     id2ent = {ent2id[key]: key for key in ent2id.keys()}
 
-    for tmp_start_logits, tmp_end_logits, tmp_callback \
-            in zip(start_logits, end_logits, dev_callback_info):
+    collector = EvalCollector.from_dataloader(
+        dev_loader,
+        max(len(text) for text, _ in dev_callback_info) + 2,
+        mmap_dir=mmap_dir)
 
-        text, gt_entities = tmp_callback
-
-        tmp_start_logits = tmp_start_logits[1:1 + len(text)]
-        tmp_end_logits = tmp_end_logits[1:1 + len(text)]
-
-        pred_entities = span_decode(tmp_start_logits, tmp_end_logits, text,
-                                    id2ent)
-
-        for idx, _type in enumerate(ENTITY_TYPES):
-            if _type not in pred_entities:
-                pred_entities[_type] = []
-
-            role_metric[idx] += calculate_metric(gt_entities[_type],
-                                                 pred_entities[_type])
+    for tmp_pred in get_base_out(model, dev_loader, device):
+        start, stop = collector.add(start_logits=tmp_pred[0],
+                                    end_logits=tmp_pred[1])
+
+        # 逐批解码，与span_decode()一致
+        callback_info = dev_callback_info[start:stop]
+        start_preds = np.argmax(collector['start_logits'][start:stop, 1:], -1)
+        end_preds = np.argmax(collector['end_logits'][start:stop, 1:], -1)
+        batch_pred_entities = [defaultdict(list) for _ in callback_info]
+        for row, s, e in zip(*[
+                x.tolist() for x in batch_mrc_spans(
+                    start_preds, end_preds,
+                    [len(text) for text, _ in callback_info])
+        ]):
+            batch_pred_entities[row][id2ent[start_preds[row, s]]].append(
+                (callback_info[row][0][s:e + 1], s))
+
+        for pred_entities, (text, gt_entities) in zip(batch_pred_entities,
+                                                      callback_info):
+            for idx, _type in enumerate(ENTITY_TYPES):
+                role_metric[idx] += calculate_metric(gt_entities[_type],
+                                                     pred_entities[_type])
+
+    assert collector.size == len(dev_callback_info)
+    collector.close()
 
     for idx, _type in enumerate(ENTITY_TYPES):
         temp_metric = get_p_r_f(role_metric[idx][0], role_metric[idx][1],
@@ -136,45 +204,59 @@ def span_evaluation(model, dev_info, device, ent2id):
     return metric_str, mirco_metrics[2]
 
 
-def mrc_evaluation(model, dev_info, device):
+def mrc_evaluation(model, dev_info, device, mmap_dir=None):
     dev_loader, (dev_callback_info, type_weight) = dev_info
 
-    start_logits, end_logits = None, None
-
     model.eval()
 
-    for tmp_pred in get_base_out(model, dev_loader, device):
-        tmp_start_logits = tmp_pred[0].cpu().numpy()
-        tmp_end_logits = tmp_pred[1].cpu().numpy()
-
-        if start_logits is None:
-            start_logits = tmp_start_logits
-            end_logits = tmp_end_logits
-        else:
-            start_logits = np.append(start_logits, tmp_start_logits, axis=0)
-            end_logits = np.append(end_logits, tmp_end_logits, axis=0)
-
-    assert len(start_logits) == len(end_logits) == len(dev_callback_info)
-
     role_metric = np.zeros([13, 3])
 
     mirco_metrics = np.zeros(3)
 
     id2ent = {x: i for i, x in enumerate(ENTITY_TYPES)}
 
-    for tmp_start_logits, tmp_end_logits, tmp_callback \
-            in zip(start_logits, end_logits, dev_callback_info):
-
-        text, text_offset, ent_type, gt_entities = tmp_callback
+    collector = EvalCollector.from_dataloader(
+        dev_loader,
+        max(x[1] + len(x[0]) for x in dev_callback_info) + 1,
+        mmap_dir=mmap_dir)
 
-        tmp_start_logits = tmp_start_logits[text_offset:text_offset +
-                                            len(text)]
-        tmp_end_logits = tmp_end_logits[text_offset:text_offset + len(text)]
-
-        pred_entities = mrc_decode(tmp_start_logits, tmp_end_logits, text)
-
-        role_metric[id2ent[ent_type]] += calculate_metric(
-            gt_entities, pred_entities)
+    for tmp_pred in get_base_out(model, dev_loader, device):
+        start, stop = collector.add(start_logits=tmp_pred[0],
+                                    end_logits=tmp_pred[1])
+
+        # 逐批解码，只取文本部分，与mrc_decode()一致
+        callback_info = dev_callback_info[start:stop]
+        text_offsets = np.array([x[1] for x in callback_info],
+                                dtype=np.int64)
+        # 超出本批序列长度的位置在缓冲区中为0，不会解码出实体
+        text_lens = np.array([len(x[0]) for x in callback_info],
+                             dtype=np.int64)
+        index = np.minimum(
+            text_offsets[:, None] +
+            np.arange(max(text_lens.max(), 1))[None, :],
+            collector.max_length - 1)
+        start_preds = np.take_along_axis(
+            np.argmax(collector['start_logits'][start:stop], -1), index, 1)
+        end_preds = np.take_along_axis(
+            np.argmax(collector['end_logits'][start:stop], -1), index, 1)
+
+        batch_pred_entities = [[] for _ in callback_info]
+        for row, s, e in zip(*[
+                x.tolist()
+                for x in batch_mrc_spans(start_preds, end_preds, text_lens)
+        ]):
+            batch_pred_entities[row].append(
+                (callback_info[row][0][s:e + 1], s))
+
+        for pred_entities, tmp_callback in zip(batch_pred_entities,
+                                               callback_info):
+            text, text_offset, ent_type, gt_entities = tmp_callback
+
+            role_metric[id2ent[ent_type]] += calculate_metric(
+                gt_entities, pred_entities)
+
+    assert collector.size == len(dev_callback_info)
+    collector.close()
 
     for idx, _type in enumerate(ENTITY_TYPES):
         temp_metric = get_p_r_f(role_metric[idx][0], role_metric[idx][1],
@@ -3,12 +3,20 @@
 
 import os
 import math
+import threading
+import time
+import numpy as np
 import torch
 import torch.nn as nn
 from torchcrf import CRF
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 from transformers import BertModel
-from .ner_decodes import crf_decode, span_decode
+from ...modules import (ConditionalLayerNorm, FocalLoss,
+                        LabelSmoothingCrossEntropy)
+from .ner_decodes import (batch_mrc_spans, crf_decode, crf_viterbi_decode,
+                          span_decode, unpad_tags)
 
 
 def vote(entities_list, threshold=0.9):
@@ -19,16 +27,16 @@ def vote(entities_list, threshold=0.9):
     :return:
     """
     threshold_nums = int(len(entities_list) * threshold)
-    entities_dict = defaultdict(int)
     entities = defaultdict(list)
 
-    for _entities in entities_list:
-        for _type in _entities:
-            for _ent in _entities[_type]:
-                entities_dict[(_type, _ent[0], _ent[1])] += 1
+    # 哈希聚合一次统计所有模型的实体
+    entities_counter = Counter((_type, _ent[0], _ent[1])
+                               for _entities in entities_list
+                               for _type in _entities
+                               for _ent in _entities[_type])
 
-    for key in entities_dict:
-        if entities_dict[key] >= threshold_nums:
+    for key, count in entities_counter.items():
+        if count >= threshold_nums:
             entities[key[0]].append((key[1], key[2]))
 
     return entities
@@ -40,17 +48,15 @@ def ensemble_vote(entities_list, threshold=0.9):
     实体级别的投票方式  (entity_type, entity_start, entity_end, entity_text)
     """
     threshold_nums = int(len(entities_list) * threshold)
-    entities_dict = defaultdict(int)
-
     entities = defaultdict(list)
 
-    for _entities in entities_list:
-        for _id in _entities:
-            for _ent in _entities[_id]:
-                entities_dict[(_id, ) + _ent] += 1
+    entities_counter = Counter((_id, ) + tuple(_ent)
+                               for _entities in entities_list
+                               for _id in _entities
+                               for _ent in _entities[_id])
 
-    for key in entities_dict:
-        if entities_dict[key] >= threshold_nums:
+    for key, count in entities_counter.items():
+        if count >= threshold_nums:
             entities[key[0]].append(key[1:])
 
     return entities
@@ -118,13 +124,10 @@ class CRFModel(BaseModel):
         self._init_weights(
             init_blocks, initializer_range=self.bert_config.initializer_range)
 
-    def forward(self,
-                token_ids,
-                attention_masks,
-                token_type_ids,
-                labels=None,
-                pseudo=None):
-
+    def emissions(self, token_ids, attention_masks, token_type_ids):
+        """
+        只计算发射分数，不做CRF解码
+        """
         bert_outputs = self.bert_module(input_ids=token_ids,
                                         attention_mask=attention_masks,
                                         token_type_ids=token_type_ids)
@@ -134,7 +137,16 @@ class CRFModel(BaseModel):
 
         seq_out = self.mid_linear(seq_out)
 
-        emissions = self.classifier(seq_out)
+        return self.classifier(seq_out)
+
+    def forward(self,
+                token_ids,
+                attention_masks,
+                token_type_ids,
+                labels=None,
+                pseudo=None):
+
+        emissions = self.emissions(token_ids, attention_masks, token_type_ids)
 
         if labels is not None:
             if pseudo is not None:
@@ -175,8 +187,8 @@ class CRFModel(BaseModel):
             out = (tokens_loss, )
 
         else:
-            tokens_out = self.crf_module.decode(emissions=emissions,
-                                                mask=attention_masks.byte())
+            tokens_out = unpad_tags(*crf_viterbi_decode(
+                self.crf_module, emissions, attention_masks))
 
             out = (tokens_out, emissions)
 
@@ -359,6 +371,47 @@ class MRCModel(BaseModel):
 
         self._init_weights(init_blocks)
 
+    def span_logits(self, seq_out, ent_type=None):
+        """
+        BERT输出 -> (start_logits, end_logits)
+        """
+        if self.use_type_embed:
+            assert ent_type is not None, \
+                'Using predicate embedding, predicate should be implemented'
+
+            predicate_feature = self.type_embedding(ent_type)
+            seq_out = self.conditional_layer_norm(seq_out, predicate_feature)
+
+        seq_out = self.mid_linear(seq_out)
+
+        return self.start_fc(seq_out), self.end_fc(seq_out)
+
+    def forward_types(self, token_ids, attention_masks, token_type_ids,
+                      ent_types):
+        """
+        共享上下文的多类型推理：上下文只经过一次BERT，再对ent_types中的
+        每个类型计算conditional layer norm及输出层。
+        只适用于use_type_embed，且输入中不含类型查询文本的模型。
+        ent_types: (num_types, )
+        返回 start_logits, end_logits，shape为(batch_size, num_types, seq_len, 2)
+        """
+        assert self.use_type_embed, \
+            'Shared context inference requires use_type_embed.'
+        seq_out = self.bert_module(input_ids=token_ids,
+                                   attention_mask=attention_masks,
+                                   token_type_ids=token_type_ids)[0]
+
+        batch_size, seq_len, hidden_size = seq_out.shape
+        num_types = len(ent_types)
+        seq_out = seq_out.unsqueeze(1).expand(batch_size, num_types, seq_len,
+                                              hidden_size).reshape(
+                                                  -1, seq_len, hidden_size)
+        start_logits, end_logits = self.span_logits(
+            seq_out, ent_types.repeat(batch_size))
+
+        return (start_logits.view(batch_size, num_types, seq_len, -1),
+                end_logits.view(batch_size, num_types, seq_len, -1))
+
     def forward(self,
                 token_ids,
                 attention_masks,
@@ -372,19 +425,7 @@ class MRCModel(BaseModel):
                                         attention_mask=attention_masks,
                                         token_type_ids=token_type_ids)
 
-        seq_out = bert_outputs[0]
-
-        if self.use_type_embed:
-            assert ent_type is not None, \
-                'Using predicate embedding, predicate should be implemented'
-
-            predicate_feature = self.type_embedding(ent_type)
-            seq_out = self.conditional_layer_norm(seq_out, predicate_feature)
-
-        seq_out = self.mid_linear(seq_out)
-
-        start_logits = self.start_fc(seq_out)
-        end_logits = self.end_fc(seq_out)
+        start_logits, end_logits = self.span_logits(bert_outputs[0], ent_type)
 
         out = (
             start_logits,
@@ -443,13 +484,358 @@ class MRCModel(BaseModel):
         return out
 
 
+class MRCMultiQueryPredictor:
+    """
+    MRC多类型查询推理
+
+    原方式每个(文本, 类型)一次前向，每个文本编码num_types次。
+    这里把每个文本的所有类型查询 [CLS] query [SEP] text [SEP] 放入同一个
+    padding后的batch；share_context=True时(模型use_type_embed，输入中不含
+    查询文本)，输入为 [CLS] text [SEP]，上下文只经过一次BERT，
+    再由MRCModel.forward_types()对所有类型展开。
+    start/end预测写入预分配的(num_texts, num_types, max_text_len)数组，
+    最后整体解码。
+
+    queries: {entity_type: query}，类型id为顺序编号，或由type2id指定
+    batch_size: 每次前向的行数，非共享上下文时每个文本占num_types行
+    """
+
+    def __init__(self,
+                 model,
+                 tokenizer,
+                 queries,
+                 type2id=None,
+                 max_length=512,
+                 batch_size=64,
+                 share_context=False,
+                 device=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.types = list(queries.keys())
+        if type2id is None:
+            type2id = {x: i for i, x in enumerate(self.types)}
+        self.ent_types = np.array([type2id[x] for x in self.types],
+                                  dtype=np.int64)
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.share_context = share_context
+        self.device = device if device is not None else next(
+            model.parameters()).device
+
+        # 查询只切分一次
+        self.query_ids = [
+            tokenizer.convert_tokens_to_ids(tokenizer.tokenize(queries[x]))
+            for x in self.types
+        ]
+        if share_context:
+            self.text_offsets = np.ones(len(self.types), dtype=np.int64)
+        else:
+            self.text_offsets = np.array([len(x) + 2 for x in self.query_ids],
+                                         dtype=np.int64)
+        # 所有类型查询对同一文本使用相同的截断长度
+        self.max_text_len = max_length - int(self.text_offsets.max()) - 1
+
+    def _build_inputs(self, texts_ids):
+        """
+        返回 token_ids, attention_masks, token_type_ids 三个(num_rows, seq_len)数组
+        """
+        tokenizer = self.tokenizer
+        if self.share_context:
+            rows = [([], text_ids) for text_ids in texts_ids]
+        else:
+            rows = [(query_ids, text_ids) for text_ids in texts_ids
+                    for query_ids in self.query_ids]
+        seq_len = max(
+            len(text_ids) + (len(query_ids) + 3 if query_ids else 2)
+            for query_ids, text_ids in rows)
+
+        token_ids = np.full((len(rows), seq_len),
+                            tokenizer.pad_token_id,
+                            dtype=np.int64)
+        attention_masks = np.zeros((len(rows), seq_len), dtype=np.int64)
+        token_type_ids = np.zeros((len(rows), seq_len), dtype=np.int64)
+        for i, (query_ids, text_ids) in enumerate(rows):
+            if query_ids:
+                ids = [tokenizer.cls_token_id] + query_ids + [
+                    tokenizer.sep_token_id
+                ] + text_ids + [tokenizer.sep_token_id]
+                token_type_ids[i, len(query_ids) + 2:len(ids)] = 1
+            else:
+                ids = [tokenizer.cls_token_id
+                       ] + text_ids + [tokenizer.sep_token_id]
+            token_ids[i, :len(ids)] = ids
+            attention_masks[i, :len(ids)] = 1
+        return token_ids, attention_masks, token_type_ids
+
+    def _forward(self, token_ids, attention_masks, token_type_ids):
+        """
+        返回 start_preds, end_preds，shape为(num_texts, num_types, seq_len)
+        """
+        num_types = len(self.types)
+        inputs = [
+            torch.from_numpy(x).to(self.device)
+            for x in (token_ids, attention_masks, token_type_ids)
+        ]
+        ent_types = torch.from_numpy(self.ent_types).to(self.device)
+        if self.share_context:
+            start_logits, end_logits = self.model.forward_types(
+                *inputs, ent_types)
+        else:
+            num_texts = len(token_ids) // num_types
+            start_logits, end_logits = self.model(
+                *inputs, ent_type=ent_types.repeat(num_texts))
+            start_logits = start_logits.view(num_texts, num_types,
+                                             *start_logits.shape[1:])
+            end_logits = end_logits.view(num_texts, num_types,
+                                         *end_logits.shape[1:])
+        return start_logits.argmax(-1), end_logits.argmax(-1)
+
+    def predict_preds(self, texts):
+        """
+        返回 start_preds, end_preds, text_lens
+            start_preds, end_preds: (num_texts, num_types, max_text_len)的int8数组
+            text_lens: 截断后的文本长度
+        """
+        num_types = len(self.types)
+        texts_ids = [
+            self.tokenizer.convert_tokens_to_ids(
+                list(text[:self.max_text_len])) for text in texts
+        ]
+        text_lens = np.array([len(x) for x in texts_ids], dtype=np.int64)
+        max_text_len = int(text_lens.max()) if len(texts) > 0 else 0
+        start_preds = np.zeros((len(texts), num_types, max_text_len),
+                               dtype=np.int8)
+        end_preds = np.zeros_like(start_preds)
+
+        texts_per_batch = self.batch_size if self.share_context else max(
+            self.batch_size // num_types, 1)
+        offsets = torch.from_numpy(self.text_offsets).to(self.device)
+        self.model.eval()
+        with torch.no_grad():
+            for i in range(0, len(texts), texts_per_batch):
+                batch_texts_ids = texts_ids[i:i + texts_per_batch]
+                batch_start, batch_end = self._forward(
+                    *self._build_inputs(batch_texts_ids))
+                # 取出每个类型查询中文本部分的预测
+                width = int(text_lens[i:i + texts_per_batch].max())
+                index = (offsets[:, None] + torch.arange(
+                    width, device=self.device)[None, :]).clamp(
+                        max=batch_start.shape[-1] - 1)
+                index = index.expand(len(batch_texts_ids), -1, -1)
+                start_preds[i:i + len(batch_texts_ids), :, :width] = \
+                    batch_start.gather(-1, index).cpu().numpy()
+                end_preds[i:i + len(batch_texts_ids), :, :width] = \
+                    batch_end.gather(-1, index).cpu().numpy()
+
+        return start_preds, end_preds, text_lens
+
+    def predict(self, texts):
+        """
+        返回每个文本的 {entity_type: [(mention, start), ...]}
+        """
+        num_types = len(self.types)
+        start_preds, end_preds, text_lens = self.predict_preds(texts)
+        rows, starts, ends = batch_mrc_spans(
+            start_preds.reshape(len(texts) * num_types, -1),
+            end_preds.reshape(len(texts) * num_types, -1),
+            np.repeat(text_lens, num_types))
+
+        batch_entities = [defaultdict(list) for _ in texts]
+        for row, s, e in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+            text_idx, type_idx = divmod(row, num_types)
+            batch_entities[text_idx][self.types[type_idx]].append(
+                (texts[text_idx][s:e + 1], s))
+        return batch_entities
+
+
+class EnsembleEngine:
+    """
+    集成模型推理引擎
+
+    所有成员共享同一份编码后的输入(每个设备只拷贝一次)，在线程池中并发推理，
+    PyTorch算子执行时释放GIL，每个线程的intra-op线程数限制为intra_op_threads，
+    避免多个成员争抢CPU核。成员输出用一次张量运算加权平均，
+    并记录每个成员的推理耗时。
+    """
+
+    def __init__(self,
+                 models,
+                 weights=None,
+                 max_workers=None,
+                 intra_op_threads=None):
+        """
+        weights: 各成员的融合权重，默认等权，会归一化
+        max_workers: 并发推理的线程数，默认为成员数，为1时顺序推理
+        intra_op_threads: 每个线程内算子的并行线程数，默认为CPU核数 / max_workers
+        """
+        self.models = models
+        if weights is None:
+            weights = [1.0] * len(models)
+        weights = torch.tensor(weights, dtype=torch.float32)
+        self.weights = weights / weights.sum()
+
+        if max_workers is None:
+            max_workers = len(models)
+        self.max_workers = max(1, min(max_workers, len(models)))
+        if intra_op_threads is None:
+            intra_op_threads = max(1,
+                                   (os.cpu_count() or 1) // self.max_workers)
+        self.intra_op_threads = intra_op_threads
+
+        self.executor = None
+        if self.max_workers > 1:
+            self.executor = ThreadPoolExecutor(
+                self.max_workers,
+                thread_name_prefix='ensemble',
+                initializer=torch.set_num_threads,
+                initargs=(intra_op_threads, ))
+
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @staticmethod
+    def _device(model):
+        return next(model.parameters()).device
+
+    def _share_inputs(self, model_inputs):
+        """
+        返回 {device: model_inputs}，同一设备上的成员共用一份输入
+        """
+        shared = {}
+        for model in self.models:
+            device = self._device(model)
+            if device not in shared:
+                shared[device] = {
+                    k: v.to(device) if isinstance(v, torch.Tensor) else v
+                    for k, v in model_inputs.items()
+                }
+        return shared
+
+    def _run_member(self, idx, inputs, member_fn):
+        model = self.models[idx]
+        device = self._device(model)
+        t0 = time.perf_counter()
+        # no_grad只对当前线程生效
+        with torch.no_grad():
+            outputs = member_fn(model, inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - t0
+        with self._stats_lock:
+            self._latencies[idx].append(elapsed)
+        return outputs
+
+    def run(self, model_inputs, member_fn=None):
+        """
+        所有成员并发推理，按成员顺序返回各自的输出
+        member_fn(model, inputs): 默认为model(**inputs)
+        """
+        if member_fn is None:
+            member_fn = lambda model, inputs: model(**inputs)
+        shared = self._share_inputs(model_inputs)
+
+        t0 = time.perf_counter()
+        if self.executor is None:
+            outputs = [
+                self._run_member(idx, shared[self._device(model)], member_fn)
+                for idx, model in enumerate(self.models)
+            ]
+        else:
+            futures = [
+                self.executor.submit(self._run_member, idx,
+                                     shared[self._device(model)], member_fn)
+                for idx, model in enumerate(self.models)
+            ]
+            outputs = [f.result() for f in futures]
+        with self._stats_lock:
+            self._run_latencies.append(time.perf_counter() - t0)
+        return outputs
+
+    def fuse(self, outputs):
+        """
+        outputs: 各成员的输出，每个为张量或张量元组
+        返回逐位置加权平均后的张量元组，结果在第一个成员的设备上
+        """
+        t0 = time.perf_counter()
+        outputs = [(x, ) if isinstance(x, torch.Tensor) else tuple(x)
+                   for x in outputs]
+        device = outputs[0][0].device
+        weights = self.weights.to(device)
+        fused = []
+        for k in range(len(outputs[0])):
+            # (num_models, ...) -> (...)
+            stacked = torch.stack(
+                [x[k].to(device=device, dtype=torch.float32) for x in outputs])
+            fused.append(torch.tensordot(weights, stacked, dims=1))
+        with self._stats_lock:
+            self._fuse_latencies.append(time.perf_counter() - t0)
+        return tuple(fused)
+
+    def __call__(self, model_inputs, member_fn=None):
+        return self.fuse(self.run(model_inputs, member_fn=member_fn))
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._latencies = [[] for _ in self.models]
+            self._run_latencies = []
+            self._fuse_latencies = []
+
+    def stats(self):
+        """
+        返回每个成员、整体并发推理和融合的耗时(毫秒)
+        """
+
+        def summary(latencies):
+            latencies = np.array(latencies) * 1000
+            if len(latencies) == 0:
+                return {
+                    'num_calls': 0,
+                    'mean_ms': 0.0,
+                    'p50_ms': 0.0,
+                    'p99_ms': 0.0
+                }
+            return {
+                'num_calls': len(latencies),
+                'mean_ms': float(latencies.mean()),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+            }
+
+        with self._stats_lock:
+            return {
+                'members': [summary(x) for x in self._latencies],
+                'run': summary(self._run_latencies),
+                'fuse': summary(self._fuse_latencies),
+            }
+
+    def show_stats(self):
+        stats = self.stats()
+        for idx, x in enumerate(stats['members']):
+            print(f"member {idx}: mean {x['mean_ms']:.2f} ms, "
+                  f"p50 {x['p50_ms']:.2f} ms, p99 {x['p99_ms']:.2f} ms")
+        print(f"ensemble run: mean {stats['run']['mean_ms']:.2f} ms, "
+              f"fuse: mean {stats['fuse']['mean_ms']:.2f} ms")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def _crf_emissions(model, inputs):
+    return model.emissions(inputs['token_ids'], inputs['attention_masks'],
+                           inputs['token_type_ids'])
+
+
 class EnsembleCRFModel:
     def __init__(self,
                  model_path_list,
                  bert_dir_list,
                  num_tags,
                  device,
-                 lamb=1 / 3):
+                 lamb=1 / 3,
+                 max_workers=None,
+                 intra_op_threads=None):
 
         self.models = []
         self.crf_module = CRF(num_tags=num_tags, batch_first=True)
@@ -473,6 +859,13 @@ class EnsembleCRFModel:
                 self.crf_module.load_state_dict(model.crf_module.state_dict())
                 self.crf_module.to(device)
 
+        # 使用牛顿冷却概率融合
+        self.engine = EnsembleEngine(
+            self.models,
+            weights=[self.weight(idx) for idx in range(len(self.models))],
+            max_workers=max_workers,
+            intra_op_threads=intra_op_threads)
+
     def weight(self, t):
         """
         牛顿冷却定律加权融合
@@ -480,36 +873,20 @@ class EnsembleCRFModel:
         return math.exp(-self.lamb * t)
 
     def predict(self, model_inputs):
-        weight_sum = 0.
-        logits = None
         attention_masks = model_inputs['attention_masks']
 
-        for idx, model in enumerate(self.models):
-            # 使用牛顿冷却概率融合
-            weight = self.weight(idx)
+        # 成员只计算发射分数，融合后解码一次
+        logits, = self.engine(model_inputs, member_fn=_crf_emissions)
 
-            # 使用概率平均融合
-            # weight = 1 / len(self.models)
-
-            tmp_logits = model(**model_inputs)[1] * weight
-            weight_sum += weight
-
-            if logits is None:
-                logits = tmp_logits
-            else:
-                logits += tmp_logits
-
-        logits = logits / weight_sum
-
-        tokens_out = self.crf_module.decode(emissions=logits,
-                                            mask=attention_masks.byte())
+        tokens_out = unpad_tags(
+            *crf_viterbi_decode(self.crf_module, logits, attention_masks))
 
         return tokens_out
 
     def vote_entities(self, model_inputs, sent, id2ent, threshold):
         entities_ls = []
-        for idx, model in enumerate(self.models):
-            tmp_tokens = model(**model_inputs)[0][0]
+        for outputs in self.engine.run(model_inputs):
+            tmp_tokens = outputs[0][0]
             tmp_entities = crf_decode(tmp_tokens, sent, id2ent)
             entities_ls.append(tmp_entities)
 
@@ -517,7 +894,13 @@ class EnsembleCRFModel:
 
 
 class EnsembleSpanModel:
-    def __init__(self, model_path_list, bert_dir_list, num_tags, device):
+    def __init__(self,
+                 model_path_list,
+                 bert_dir_list,
+                 num_tags,
+                 device,
+                 max_workers=None,
+                 intra_op_threads=None):
 
         self.models = []
 
@@ -535,39 +918,32 @@ class EnsembleSpanModel:
 
             self.models.append(model)
 
-    def predict(self, model_inputs):
-        start_logits, end_logits = None, None
-
-        for idx, model in enumerate(self.models):
-
-            # 使用概率平均融合
-            weight = 1 / len(self.models)
+        # 使用概率平均融合
+        self.engine = EnsembleEngine(self.models,
+                                     max_workers=max_workers,
+                                     intra_op_threads=intra_op_threads)
 
-            tmp_start_logits, tmp_end_logits = model(**model_inputs)
-
-            tmp_start_logits = tmp_start_logits * weight
-            tmp_end_logits = tmp_end_logits * weight
-
-            if start_logits is None:
-                start_logits = tmp_start_logits
-                end_logits = tmp_end_logits
-            else:
-                start_logits += tmp_start_logits
-                end_logits += tmp_end_logits
+    def predict(self, model_inputs):
+        start_logits, end_logits = self.engine(model_inputs)
 
         return start_logits, end_logits
 
     def vote_entities(self, model_inputs, sent, id2ent, threshold):
         entities_ls = []
 
-        for idx, model in enumerate(self.models):
-
-            start_logits, end_logits = model(**model_inputs)
-            start_logits = start_logits[0].cpu().numpy()[1:1 + len(sent)]
-            end_logits = end_logits[0].cpu().numpy()[1:1 + len(sent)]
-
-            decode_entities = span_decode(start_logits, end_logits, sent,
-                                          id2ent)
+        outputs = self.engine.run(model_inputs)
+        # 所有成员的logits只拷贝一次到CPU: (num_models, len(sent), num_tags)
+        device = outputs[0][0].device
+        start_logits = torch.stack([
+            x[0][0, 1:1 + len(sent)].to(device) for x in outputs
+        ]).cpu().numpy()
+        end_logits = torch.stack([
+            x[1][0, 1:1 + len(sent)].to(device) for x in outputs
+        ]).cpu().numpy()
+
+        for idx in range(len(outputs)):
+            decode_entities = span_decode(start_logits[idx], end_logits[idx],
+                                          sent, id2ent)
 
             entities_ls.append(decode_entities)
 
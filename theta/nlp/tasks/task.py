@@ -4,8 +4,10 @@
 import json
 import os
 import random
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime
+from multiprocessing import Pool
 from typing import Type, Union
 
 try:
@@ -37,9 +39,43 @@ from transformers.optimization import (
     get_linear_schedule_with_warmup)
 
 from ...utils import seed_everything
+from ...utils.weight_averaging import WeightAveragingCallback
+from ..data.dataset_cache import load_columnar_dataset, save_columnar_dataset
+from ..data.packing import PACKED_TOKEN_KEYS, PackedDataset
+from ..data.samplers import LengthGroupedBatchSampler
+from ..data.teacher_logits import DistillationDataset, load_teacher_logits
+from ..memory_planner import plan_batch_size, show_memory_plan
+from ..quantization import (benchmark_forward_latency, compare_quantization,
+                            file_size_mb, quantize_linear_layers,
+                            show_quantization_report)
+from ..tokenizers.token_cache import create_token_cache
+from .distillation import (compute_teacher_logits, distillation_loss,
+                           teacher_engine)
 
 os.environ['TOKENIZERS_PARALLELISM'] = "true"
 
+# 多进程批量编码时，每个工作进程持有的Dataset实例
+_encoding_dataset = None
+
+
+def _init_encoding_worker(dataset):
+    global _encoding_dataset
+    # 父进程已使用过fast tokenizer的线程池时，fork出的子进程继续并行会死锁
+    os.environ['TOKENIZERS_PARALLELISM'] = "false"
+    _encoding_dataset = dataset
+    if dataset.token_cache is not None:
+        dataset.token_cache.defer_writes()
+
+
+def _encode_batch_in_worker(batch):
+    guids = [x[0] for x in batch]
+    results = _encoding_dataset._encode_batch(batch)
+    # token_cache的新记录和命中统计交给父进程
+    cache_updates = None
+    if _encoding_dataset.token_cache is not None:
+        cache_updates = _encoding_dataset.token_cache.pop_updates()
+    return guids, results, cache_updates
+
 
 # ------------------------------ Dataset ------------------------------
 class BaseDataset(object):
@@ -55,22 +91,94 @@ class BaseDataset(object):
         self.tokenizer = tokenizer
         self.sids = []
         self.seg_spans = []
+        self.token_cache = create_token_cache(data_args)
 
         self.encoded_data_list = []
-        for x in tqdm(data_generator(), desc="Encoding"):
-            encoded = self._encode_item(x)
-            if encoded:
-                if isinstance(encoded, list):
-                    self.encoded_data_list.extend(encoded)
-                    sids = [f"{x[0]}-{i}" for i in range(len(encoded))]
-                    self.sids.extend(sids)
-                else:
-                    self.encoded_data_list.append(encoded)
-                    self.sids.append(x[0])
+        if self.data_args.encode_batch_size > 0:
+            self._encode_in_batches(data_generator)
+        else:
+            for x in tqdm(data_generator(), desc="Encoding"):
+                encoded = self._encode_item(x)
+                self._append_encoded(x[0], encoded)
+
+        if self.token_cache is not None:
+            self.token_cache.log_stats()
+            self.token_cache.close()
+            # 不随数据集缓存保存
+            self.token_cache = None
+
+    def _tokenize(self, texts, encode_fn=None, **kwargs):
+        """
+        texts: [text, ...] 或 [(text_a, text_b), ...]
+        encode_fn默认为tokenizer.batch_encode_plus，启用token_cache时只编码未命中的文本
+        """
+        if encode_fn is None:
+            encode_fn = self.tokenizer.batch_encode_plus
+        if self.token_cache is None:
+            return encode_fn(texts, **kwargs)
+        return self.token_cache.batch_encode(self.tokenizer,
+                                             texts,
+                                             encode_fn=encode_fn,
+                                             **kwargs)
+
+    def _append_encoded(self, guid, encoded):
+        if encoded:
+            if isinstance(encoded, list):
+                self.encoded_data_list.extend(encoded)
+                sids = [f"{guid}-{i}" for i in range(len(encoded))]
+                self.sids.extend(sids)
+            else:
+                self.encoded_data_list.append(encoded)
+                self.sids.append(guid)
+
+    def _encode_in_batches(self, data_generator):
+        """
+        按encode_batch_size将样本分批编码，encode_num_workers > 1时使用进程池。
+        进程池按提交顺序返回结果，sids、seg_spans的顺序与逐条编码一致。
+        """
+        batch_size = self.data_args.encode_batch_size
+        num_workers = self.data_args.encode_num_workers
+
+        def batch_generator():
+            batch = []
+            for x in data_generator():
+                batch.append(x)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def append_batch(guids, batch_results):
+            for guid, (encoded, seg_spans) in zip(guids, batch_results):
+                self._append_encoded(guid, encoded)
+                self.seg_spans.extend(seg_spans)
+
+        if num_workers > 1:
+            with Pool(num_workers,
+                      initializer=_init_encoding_worker,
+                      initargs=(self, )) as pool:
+                for guids, batch_results, cache_updates in tqdm(
+                        pool.imap(_encode_batch_in_worker,
+                                  batch_generator()),
+                        desc="Encoding"):
+                    append_batch(guids, batch_results)
+                    if cache_updates is not None:
+                        self.token_cache.merge_updates(cache_updates)
+        else:
+            for batch in tqdm(batch_generator(), desc="Encoding"):
+                append_batch([x[0] for x in batch], self._encode_batch(batch))
 
     def _encode_item(self, x):
         raise NotImplementedError
 
+    def _encode_batch(self, batch):
+        """
+        批量编码，返回与batch一一对应的(encoded, seg_spans)列表。
+        子类可重载，合并成一次tokenizer调用。
+        """
+        return [(self._encode_item(x), []) for x in batch]
+
     def __iter__(self):
         for x in self.encoded_data_list:
             yield x
@@ -78,6 +186,12 @@ class BaseDataset(object):
     def __getitem__(self, idx):
         return self.encoded_data_list[idx]
 
+    def get_lengths(self):
+        """
+        各样本的有效token数，用于按长度分组
+        """
+        return [int(x['attention_mask'].sum()) for x in self.encoded_data_list]
+
     def __len__(self):
         return len(self.encoded_data_list)
 
@@ -136,6 +250,9 @@ class TaskData:
         logger.info(f"test samples: {len(self.test_samples)}")
 
     def cache_dataset(self, mode, build_dataset_fn):
+        if self.data_args.cache_format == 'mmap':
+            return self.cache_columnar_dataset(mode, build_dataset_fn)
+
         cache_file = f"{self.data_args.cache_dir}/{mode}_dataset.cache"
         if not self.data_args.overwrite_cache and os.path.exists(cache_file):
             logger.info(f"Load cached {mode} dataset from {cache_file}")
@@ -149,6 +266,21 @@ class TaskData:
             )
         return dataset
 
+    def cache_columnar_dataset(self, mode, build_dataset_fn):
+        """
+        列式缓存，各字段以连续数组保存并通过mmap打开，
+        DataLoader的worker之间共享内存页。
+        """
+        cache_path = f"{self.data_args.cache_dir}/{mode}_dataset.mmap"
+        if self.data_args.overwrite_cache or not os.path.exists(
+                f"{cache_path}/meta.pkl"):
+            dataset = build_dataset_fn()
+            save_columnar_dataset(dataset, cache_path)
+            logger.info(
+                f"Save columnar {mode} dataset {len(dataset)} lines to {cache_path}"
+            )
+        return load_columnar_dataset(cache_path)
+
     @property
     def train_dataset(self):
         if self._train_dataset is None:
@@ -216,6 +348,8 @@ class TransformerModel(nn.Module):
         self.tokenizer = tokenizer
 
         self.model_name_or_path = model_name_or_path
+        # 动态量化参数，如 {'dtype': 'qint8'}，未量化时为None
+        self.quantization = None
         #  self.transformer = self.automodel_cls.from_config(self.config)
         self.load_from_config()
 
@@ -284,6 +418,53 @@ class TransformerModel(nn.Module):
     #      device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     #      self.transformer.to(device)
 
+    def quantize_dynamic(self, dtype=torch.qint8):
+        """
+        动态量化transformer主干中的nn.Linear，任务层保持fp32，量化后只能在CPU上推理
+        """
+        quantize_linear_layers(self.transformer.base_model, dtype=dtype)
+        self.quantization = {'dtype': str(dtype).split('.')[-1]}
+        logger.info(f"Quantized transformer linear layers to {dtype}.")
+        return self
+
+    def prepare_for_checkpoint(self, checkpoint):
+        """
+        checkpoint保存的是量化模型时，先量化再载入参数
+        """
+        quantization = checkpoint.get('quantization', None)
+        if quantization is not None and self.quantization is None:
+            self.quantize_dynamic(dtype=getattr(torch, quantization['dtype']))
+
+    def load_from_runner_checkpoint(self, model_path, prefix="model."):
+        """
+        载入TaskRunner.save_model()保存的pl_model.ckpt中本模型的参数，
+        用于脱离TaskRunner单独使用模型(推理服务、导出等)
+        """
+        if os.path.isdir(model_path):
+            pl_model_checkpoint_file = f"{model_path}/pl_model.ckpt"
+        else:
+            pl_model_checkpoint_file = model_path
+        if os.path.exists(pl_model_checkpoint_file):
+            logger.info(f"Load model from {pl_model_checkpoint_file}.")
+            checkpoint = dill.load(open(pl_model_checkpoint_file, 'rb'))
+            self.prepare_for_checkpoint(checkpoint)
+            state_dict = OrderedDict(
+                (k[len(prefix):], v)
+                for k, v in checkpoint['state_dict'].items()
+                if k.startswith(prefix))
+            # 量化层按_metadata中的版本号解析参数
+            metadata = getattr(checkpoint['state_dict'], '_metadata', None)
+            if metadata is not None:
+                state_dict._metadata = OrderedDict(
+                    (k[len(prefix):], v) for k, v in metadata.items()
+                    if k.startswith(prefix))
+                if prefix.rstrip('.') in metadata:
+                    state_dict._metadata[''] = metadata[prefix.rstrip('.')]
+            self.load_state_dict(state_dict)
+        else:
+            logger.error(
+                f"Checkpoint file {pl_model_checkpoint_file} does not exists.")
+
     def save_model(self, model_path):
         os.makedirs(model_path, exist_ok=True)
         #  model_to_save = (self.transformer.module if hasattr(
@@ -311,6 +492,11 @@ class TransformerModel(nn.Module):
 # ------------------------------ TaskRunner ------------------------------
 class TaskRunner(pl.LightningModule):
 
+    # 知识蒸馏时保存的教师模型输出名称，与模型推理输出一一对应
+    kd_output_names = ()
+    # pack_sequences时按token拼接的字段
+    packed_token_keys = PACKED_TOKEN_KEYS
+
     def __init__(self, *args, **kwargs):
         super(TaskRunner, self).__init__()
         self.save_hyperparameters()
@@ -327,6 +513,8 @@ class TaskRunner(pl.LightningModule):
         self.warmup_steps = None
         self.total_steps = None
         self.wait_count = 0
+        # 只评估(如evaluate_on_cpu)时不保存最优模型
+        self.skip_save_best = False
 
         self.best_score = 0.0 if self.hparams.greater_is_better else float(
             'inf')
@@ -368,6 +556,7 @@ class TaskRunner(pl.LightningModule):
         if os.path.exists(pl_model_checkpoint_file):
             logger.info(f"Load PL module from {pl_model_checkpoint_file}.")
             checkpoint = dill.load(open(pl_model_checkpoint_file, 'rb'))
+            self.model.prepare_for_checkpoint(checkpoint)
             self.load_state_dict(checkpoint['state_dict'])
         else:
             logger.error(
@@ -389,13 +578,50 @@ class TaskRunner(pl.LightningModule):
         pl_model_checkpoint_file = f"{model_path}/pl_model.ckpt"
 
         # FIXME
-        dill.dump({'state_dict': self.state_dict()},
-                  open(pl_model_checkpoint_file, 'wb'))
+        checkpoint = {'state_dict': self.state_dict()}
+        if self.model.quantization is not None:
+            checkpoint['quantization'] = self.model.quantization
+        dill.dump(checkpoint, open(pl_model_checkpoint_file, 'wb'))
         logger.warning(f"Save PL module in {pl_model_checkpoint_file}")
 
         self.model.save_model(model_path)
         logger.warning(f"Save transformer model in {model_path}")
 
+    def load_teacher_model(self, model_path):
+        """
+        与self.model同结构的教师模型，参数载入自model_path中的pl_model.ckpt
+        """
+        teacher = self.model.__class__(model_name_or_path=model_path,
+                                       num_labels=self.num_labels)
+        teacher.load_from_runner_checkpoint(model_path)
+        teacher.eval()
+        return teacher
+
+    def kd_loss(self,
+                loss,
+                student_outputs,
+                teacher_outputs,
+                mask=None,
+                multi_label=False):
+        """
+        batch中有教师输出时，loss = (1 - kd_alpha) * loss + kd_alpha * kd_loss
+        student_outputs, teacher_outputs: {name: logits}
+        """
+        if not teacher_outputs:
+            return loss
+        soft_loss = sum(
+            distillation_loss(student_outputs[name],
+                              teacher_logits,
+                              temperature=self.hparams.kd_temperature,
+                              mask=mask,
+                              multi_label=multi_label)
+            for name, teacher_logits in teacher_outputs.items()) / len(
+                teacher_outputs)
+        self.log('train_kd_loss', soft_loss, on_step=True)
+
+        alpha = self.hparams.kd_alpha
+        return (1.0 - alpha) * loss + alpha * soft_loss
+
     def configure_optimizers(self):
         #  param_optimizer = list(self.transformer_model.model.named_parameters())
         param_optimizer = list(self.model.named_parameters())
@@ -480,7 +706,19 @@ class TaskRunner(pl.LightningModule):
     #  def on_test_end(self, model):
     #      self.model.train()
 
+    def restore_test_order(self, test_items):
+        """
+        按长度分组的测试batch顺序与数据集不同，将拼接后的结果还原为数据集顺序
+        """
+        batch_sampler = self.test_dataloader.dataloader.batch_sampler
+        if isinstance(batch_sampler, LengthGroupedBatchSampler):
+            return batch_sampler.restore_order(test_items)
+        return test_items
+
     def save_best_model(self, eval_outputs: dict):
+        if self.skip_save_best:
+            return
+
         epoch_str = f"Epoch {self.current_epoch}/{self.max_epochs}"
         assert 'val_loss' in eval_outputs
         if 'val_loss' in eval_outputs:
@@ -580,6 +818,15 @@ class BaseTask():
     def checkpoint_path(self):
         return self.model_args.checkpoint_path
 
+    @property
+    def checkpoint_model_path(self):
+        """
+        do_eval/do_predict载入的模型目录，model_args.quantized时为量化模型
+        """
+        if self.model_args.quantized:
+            return os.path.join(self.checkpoint_path, "checkpoint_int8")
+        return os.path.join(self.checkpoint_path, "checkpoint")
+
     @classmethod
     def get_data_class(cls):
         raise NotImplementedError
@@ -608,9 +855,60 @@ class BaseTask():
 
         return test_results_file
 
+    def create_dataloader(self, dataset, batch_size, shuffle=False):
+        """
+        group_by_length时使用LengthGroupedBatchSampler，
+        长度相近的样本组成batch，由collate_fn补齐到batch内最长长度。
+        """
+        if self.training_args.group_by_length:
+            if self.data_args.padding == 'max_length':
+                logger.warning(
+                    f"group_by_length has no effect on samples padded to max_length, "
+                    f"set padding='longest' to pad each batch dynamically.")
+            batch_sampler = LengthGroupedBatchSampler(
+                dataset.get_lengths(),
+                batch_size,
+                shuffle=shuffle,
+                seed=self.training_args.seed)
+            return DataLoader(dataset,
+                              batch_sampler=batch_sampler,
+                              collate_fn=dataset.collate_fn,
+                              pin_memory=True,
+                              num_workers=8)
+
+        return DataLoader(dataset,
+                          batch_size=batch_size,
+                          collate_fn=dataset.collate_fn,
+                          pin_memory=True,
+                          num_workers=8)
+
     @property
-    def train_dataloader(self):
+    def teacher_logits_path(self):
+        if self.training_args.kd_logits_path:
+            return self.training_args.kd_logits_path
+        return f"{self.data_args.cache_dir}/train_teacher_logits.mmap"
+
+    def prepare_train_dataset(self):
+        """
+        按enable_kd、pack_sequences包装训练集
+        """
         train_dataset = self.data.train_dataset
+        if self.training_args.enable_kd:
+            if self.training_args.pack_sequences:
+                raise ValueError(
+                    f"pack_sequences can not be used with enable_kd.")
+            train_dataset = DistillationDataset(
+                train_dataset, load_teacher_logits(self.teacher_logits_path))
+        if self.training_args.pack_sequences:
+            train_dataset = PackedDataset(
+                train_dataset,
+                self.data_args.max_length,
+                token_keys=self.runner.packed_token_keys)
+        return train_dataset
+
+    @property
+    def train_dataloader(self):
+        train_dataset = self.prepare_train_dataset()
         if self.training_args.show_dataloader_samples > 0:
             for index in random.sample(
                     range(len(train_dataset)),
@@ -619,12 +917,10 @@ class BaseTask():
                     f"Sample {index} of the training set: {train_dataset[index]}."
                 )
 
-        train_dataloader = DataLoader(
+        train_dataloader = self.create_dataloader(
             train_dataset,
             batch_size=self.training_args.per_device_train_batch_size,
-            collate_fn=train_dataset.collate_fn,
-            pin_memory=True,
-            num_workers=8)
+            shuffle=True)
         return train_dataloader
 
     @property
@@ -637,12 +933,10 @@ class BaseTask():
                 logger.info(
                     f"Sample {index} of the val set: {val_dataset[index]}.")
 
-        val_dataloader = DataLoader(
+        val_dataloader = self.create_dataloader(
             val_dataset,
             batch_size=self.training_args.per_device_eval_batch_size,
-            collate_fn=val_dataset.collate_fn,
-            pin_memory=True,
-            num_workers=8)
+            shuffle=False)
         return val_dataloader
 
     @property
@@ -655,12 +949,10 @@ class BaseTask():
                 logger.info(
                     f"Sample {index} of the test set: {test_dataset[index]}.")
 
-        test_dataloader = DataLoader(
+        test_dataloader = self.create_dataloader(
             test_dataset,
             batch_size=self.training_args.per_device_test_batch_size,
-            collate_fn=test_dataset.collate_fn,
-            pin_memory=True,
-            num_workers=8)
+            shuffle=False)
         return test_dataloader
 
     def get_latest_submission_file(self, ext="json", prefix="submission"):
@@ -675,6 +967,136 @@ class BaseTask():
         logger.warning(
             f"Call generate_submission() implemented in base class Task.")
 
+    def evaluate_on_cpu(self, val_dataloader, num_latency_batches=20):
+        """
+        在CPU上用runner.validation_step()评估验证集，并测量模型推理延迟
+        """
+        self.runner.cpu()
+        trainer = pl.Trainer(gpus=0,
+                             precision=32,
+                             logger=False,
+                             checkpoint_callback=False)
+        self.runner.skip_save_best = True
+        try:
+            eval_results = trainer.validate(self.runner,
+                                            val_dataloader,
+                                            verbose=False)[0]
+        finally:
+            self.runner.skip_save_best = False
+        eval_results = {
+            k: float(v)
+            for k, v in eval_results.items() if not k.endswith("_step")
+        }
+        eval_results['latency_ms'] = benchmark_forward_latency(
+            self.runner.model, val_dataloader, num_batches=num_latency_batches)
+        return eval_results
+
+    def quantize_checkpoint(self):
+        """
+        动态int8量化checkpoint中的模型，保存在checkpoint_int8，
+        返回量化前后模型大小、推理延迟和验证集指标的对比
+        """
+        fp32_path = os.path.join(self.checkpoint_path, "checkpoint")
+        int8_path = os.path.join(self.checkpoint_path, "checkpoint_int8")
+
+        self.runner.load_from_checkpoint(fp32_path)
+        self.data.tokenizer = self.runner.model.tokenizer
+        self.data.load_train_data()
+        val_dataloader = self.val_dataloader
+
+        fp32_results = self.evaluate_on_cpu(val_dataloader)
+        fp32_results['size_mb'] = file_size_mb(f"{fp32_path}/pl_model.ckpt")
+
+        self.runner.model.quantize_dynamic()
+        self.runner.save_model(int8_path)
+
+        int8_results = self.evaluate_on_cpu(val_dataloader)
+        int8_results['size_mb'] = file_size_mb(f"{int8_path}/pl_model.ckpt")
+
+        report = compare_quantization(fp32_results, int8_results)
+        show_quantization_report(report)
+
+        report_file = os.path.join(int8_path, "quantization_report.json")
+        json.dump(report, open(report_file, 'w'), ensure_ascii=False, indent=2)
+        logger.info(f"Saved quantization report to {report_file}")
+
+        return report
+
+    def save_teacher_logits(self):
+        """
+        kd_teacher_paths中的教师模型在训练集上推理一次，logits保存到teacher_logits_path
+        训练集用学生模型的tokenizer编码，教师与学生的词表需一致
+        """
+        teacher_paths = [
+            x for x in (self.training_args.kd_teacher_paths or '').split(',')
+            if x
+        ]
+        if not teacher_paths:
+            raise ValueError(
+                f"kd_teacher_paths is required for do_teacher_logits.")
+        device = torch.device('cuda' if torch.cuda.is_available()
+                              and self.training_args.gpus != 0 else 'cpu')
+        teachers = [
+            self.runner.load_teacher_model(x).to(device) for x in teacher_paths
+        ]
+        if teachers[0].tokenizer.get_vocab(
+        ) != self.runner.model.tokenizer.get_vocab():
+            logger.warning(
+                f"The vocabulary of teacher {teacher_paths[0]} is different from the student's."
+            )
+
+        self.data.tokenizer = self.runner.model.tokenizer
+        self.data.load_train_data()
+        compute_teacher_logits(
+            teacher_engine(teachers),
+            self.data.train_dataset,
+            self.teacher_logits_path,
+            output_names=self.runner.kd_output_names,
+            batch_size=self.training_args.per_device_eval_batch_size,
+            device=device)
+
+        return self.teacher_logits_path
+
+    def plan_memory(self):
+        """
+        探测训练步的显存/内存占用，per_device_train_batch_size设为
+        memory_budget_mb内能放下的最大值，结果保存在memory_plan.json
+        """
+        training_args = self.training_args
+        use_cuda = torch.cuda.is_available() and training_args.gpus != 0
+        memory_budget_mb = training_args.memory_budget_mb
+        if memory_budget_mb is None:
+            if not use_cuda:
+                logger.warning(
+                    f"auto_batch_size on CPU needs memory_budget_mb, keep per_device_train_batch_size: {training_args.per_device_train_batch_size}"
+                )
+                return None
+            memory_budget_mb = torch.cuda.get_device_properties(
+                0).total_memory / 2**20 * 0.9
+
+        plan = plan_batch_size(
+            self.runner,
+            self.prepare_train_dataset(),
+            memory_budget_mb,
+            self.data_args.max_length,
+            max_batch_size=training_args.max_auto_batch_size,
+            try_checkpointing=training_args.auto_activation_checkpointing,
+            device='cuda' if use_cuda else 'cpu')
+        show_memory_plan(plan)
+
+        if plan['batch_size'] is None:
+            logger.warning(
+                f"No batch size fits memory_budget_mb: {memory_budget_mb:.0f}, keep per_device_train_batch_size: {training_args.per_device_train_batch_size}"
+            )
+        else:
+            training_args.per_device_train_batch_size = plan['batch_size']
+
+        plan_file = os.path.join(training_args.task_dir, "memory_plan.json")
+        json.dump(plan, open(plan_file, 'w'), ensure_ascii=False, indent=2)
+        logger.info(f"Saved memory plan to {plan_file}")
+
+        return plan
+
     def execute(self, *args, **kwargs):
 
         model_args = self.model_args
@@ -684,17 +1106,30 @@ class BaseTask():
 
         return_dict = {}
 
+        # ------------------------------ do_teacher_logits ------------------------------
+        if training_args.do_teacher_logits:
+            teacher_logits_path = self.save_teacher_logits()
+
+            return_dict.update({'teacher_logits_path': teacher_logits_path})
+
         # ------------------------------ do_train ------------------------------
         if training_args.do_train:
             model_path = model_args.model_name_or_path
             self.runner.load_from_pretrained(model_path)
             self.data.tokenizer = self.runner.model.tokenizer
             self.data.load_train_data()
+            if training_args.auto_batch_size:
+                memory_plan = self.plan_memory()
+
+                return_dict.update({'memory_plan': memory_plan})
+
+            # pack_sequences时每个epoch的行数少于样本数
+            train_dataloader = self.train_dataloader
+            num_train_rows = len(train_dataloader.dataset)
 
             def setup_warmup_steps():
-                epoch_steps = int(
-                    len(self.data.train_dataset) /
-                    training_args.per_device_train_batch_size)
+                epoch_steps = int(num_train_rows /
+                                  training_args.per_device_train_batch_size)
 
                 warmup_method = training_args.warmup_method
                 if warmup_method == 'auto':
@@ -725,9 +1160,8 @@ class BaseTask():
 
             max_epochs = self.training_args.max_epochs
             if max_epochs:
-                total_steps = int(
-                    len(self.data.train_dataset) / self.training_args.
-                    per_device_train_batch_size) * max_epochs
+                total_steps = int(num_train_rows / self.training_args.
+                                  per_device_train_batch_size) * max_epochs
             else:
                 total_steps = self.training_args.max_steps
 
@@ -787,24 +1221,37 @@ class BaseTask():
             #
             logger.warning(f"trainer_kwargs: {trainer_kwargs}")
 
-            trainer = pl.Trainer(**trainer_kwargs)
-            trainer.fit(self.runner, self.train_dataloader,
+            callbacks = []
+            if training_args.weight_averaging:
+                callbacks.append(
+                    WeightAveragingCallback(
+                        mode=training_args.weight_averaging,
+                        start_step=training_args.weight_averaging_start,
+                        update_steps=training_args.weight_averaging_steps,
+                        decay=training_args.ema_decay))
+
+            trainer = pl.Trainer(callbacks=callbacks, **trainer_kwargs)
+            trainer.fit(self.runner, train_dataloader,
                         self.val_dataloader)
 
         # ------------------------------ do_eval ------------------------------
         if training_args.do_eval:
-            self.runner.load_from_checkpoint(
-                os.path.join(self.checkpoint_path, "checkpoint"))
+            self.runner.load_from_checkpoint(self.checkpoint_model_path)
             self.data.tokenizer = self.runner.model.tokenizer
             self.data.load_train_data()
 
             val_dataloader = self.val_dataloader
             #  eval_results = do_eval(trainer, val_dataset, data_args)
 
+        # ------------------------------ do_quantize ------------------------------
+        if training_args.do_quantize:
+            quantization_report = self.quantize_checkpoint()
+
+            return_dict.update({'quantization_report': quantization_report})
+
         # ------------------------------ do_predict ------------------------------
         if training_args.do_predict:
-            self.runner.load_from_checkpoint(
-                os.path.join(self.checkpoint_path, "checkpoint"))
+            self.runner.load_from_checkpoint(self.checkpoint_model_path)
             self.data.tokenizer = self.runner.model.tokenizer
             self.data.load_test_data()
 
@@ -816,6 +1263,10 @@ class BaseTask():
                 args=self.training_args.to_dict())
 
             trainer_kwargs['precision'] = 16 if self.training_args.fp16 else 32
+            if self.runner.model.quantization is not None:
+                # 量化模型只能在CPU上推理
+                trainer_kwargs['gpus'] = 0
+                trainer_kwargs['precision'] = 32
 
             trainer = pl.Trainer(**trainer_kwargs)
 
@@ -843,6 +1294,7 @@ def run_task_from_checkpoint(task_cls,
                              do_eval=False,
                              do_predict=False,
                              do_submit=False,
+                             do_quantize=False,
                              train_data_generator=None,
                              test_data_generator=None):
     samples_cls = task_cls.get_samples_class()
@@ -852,6 +1304,7 @@ def run_task_from_checkpoint(task_cls,
     task_args.training_args.do_eval = do_eval
     task_args.training_args.do_predict = do_predict
     task_args.training_args.do_submit = do_submit
+    task_args.training_args.do_quantize = do_quantize
     task_args.model_args.checkpoint_path = checkpoint_path
 
     train_samples = None
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import inspect
 import json
 import os
 from collections import OrderedDict
@@ -14,11 +15,15 @@ import torch.nn as nn
 from loguru import logger
 from sklearn.metrics import f1_score
 from torch.nn import CrossEntropyLoss, MSELoss
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
 from tqdm import tqdm
 
 from theta.nlp.arguments import (DataArguments, ModelArguments, TaskArguments,
                                  TrainingArguments)
 from theta.nlp.data.samples import GlueSamples
+from theta.nlp.data.packing import segment_attention_mask
+from theta.nlp.data.samplers import stack_with_padding
+from theta.nlp.data.teacher_logits import pop_teacher_outputs
 from transformers import AutoModelForSequenceClassification
 
 from .task import BaseDataset, BaseTask, TaskData, TaskRunner, TransformerModel
@@ -72,14 +77,35 @@ class GlueDataset(BaseDataset):
     def __init__(self, *args, **kwargs):
         super(GlueDataset, self).__init__(*args, **kwargs)
 
+    def _encode_labels(self, labels):
+        if labels is not None:
+            if isinstance(labels, list):
+                encoded_labels = [0] * len(self.label2id)
+                for x in labels:
+                    encoded_labels[self.label2id[x]] = 1
+                labels = torch.from_numpy(
+                    np.array(encoded_labels, dtype=np.float32))
+            else:
+                if labels:
+                    encoded_labels = self.label2id[labels]
+                else:
+                    encoded_labels = 0
+                labels = torch.from_numpy(
+                    np.array(encoded_labels, dtype=np.int64))
+        return labels
+
     def _encode_item(self, x):
         guid, text_a, text_b, labels = x
 
         # -------- input_ids, attention_mask, token_type_ids --------
         text_pair = [(text_a, text_b)] if text_b is not None else [text_a]
-        encodings = self.tokenizer.batch_encode_plus(
+        # 单条编码时'longest'等价于不padding，与批量编码共用缓存
+        padding = self.data_args.padding
+        if padding != 'max_length':
+            padding = False
+        encodings = self._tokenize(
             text_pair,
-            padding=self.data_args.padding,
+            padding=padding,
             max_length=self.data_args.max_length,
             add_special_tokens=True,
             truncation=True,
@@ -92,20 +118,7 @@ class GlueDataset(BaseDataset):
             np.array(encodings.token_type_ids, dtype=np.int64))[0]
 
         # -------- labels --------
-        if labels is not None:
-            if isinstance(labels, list):
-                encoded_labels = [0] * len(self.label2id)
-                for x in labels:
-                    encoded_labels[self.label2id[x]] = 1
-                labels = torch.from_numpy(
-                    np.array(encoded_labels, dtype=np.float32))
-            else:
-                if labels:
-                    encoded_labels = self.label2id[labels]
-                else:
-                    encoded_labels = 0
-                labels = torch.from_numpy(
-                    np.array(encoded_labels, dtype=np.int64))
+        labels = self._encode_labels(labels)
 
         return {
             'input_ids': input_ids,
@@ -114,6 +127,41 @@ class GlueDataset(BaseDataset):
             'labels': labels
         }
 
+    def _encode_batch(self, batch):
+        """
+        一次tokenizer调用编码整个batch
+        """
+        text_pairs = [(text_a, text_b) if text_b is not None else text_a
+                      for _, text_a, text_b, _ in batch]
+        # 逐条编码时'longest'等价于不padding，批量编码保持一致
+        padding = self.data_args.padding
+        if padding != 'max_length':
+            padding = False
+        encodings = self._tokenize(
+            text_pairs,
+            padding=padding,
+            max_length=self.data_args.max_length,
+            add_special_tokens=True,
+            truncation=True)
+
+        results = []
+        for i, (_, _, _, labels) in enumerate(batch):
+            encoded = {
+                'input_ids':
+                torch.from_numpy(
+                    np.array(encodings.input_ids[i], dtype=np.int64)),
+                'attention_mask':
+                torch.from_numpy(
+                    np.array(encodings.attention_mask[i], dtype=np.int64)),
+                'token_type_ids':
+                torch.from_numpy(
+                    np.array(encodings.token_type_ids[i], dtype=np.int64)),
+                'labels':
+                self._encode_labels(labels)
+            }
+            results.append((encoded, []))
+        return results
+
     @classmethod
     def collate_fn(cls, batch):
         stacked_batch = {}
@@ -136,7 +184,7 @@ class GlueDataset(BaseDataset):
         for key in not_none_tensor_keys:
             key_batch = [e[key] for e in batch if e[key] is not None]
             #  logger.info(f"key: {key} key_batch: {key_batch}")
-            batch_values = torch.stack(key_batch)
+            batch_values = stack_with_padding(key_batch)
             stacked_batch[key] = batch_values
         # maybe None tensors
         for key in maybe_none_tensor_keys:
@@ -408,6 +456,56 @@ class MyGlueBaseModel(TransformerModel):
         else:
             return logits
 
+    def segment_logits(self, sequence_output, segment_starts):
+        """
+        打包的序列中每个样本在自己的[CLS]上pooling后分类
+        sequence_output: (batch_size, seq_len, hidden_size)
+        segment_starts: (num_samples, 2)，每个样本[CLS]的(行, 列)
+        返回 (num_samples, num_labels)
+        """
+        cls_output = sequence_output[segment_starts[:, 0],
+                                     segment_starts[:, 1]].unsqueeze(1)
+        transformer = self.transformer
+        if isinstance(transformer.classifier, nn.Linear):
+            # BERT: pooler(取第一个token) -> dropout -> classifier
+            pooler = getattr(transformer.base_model, 'pooler', None)
+            pooled_output = pooler(
+                cls_output) if pooler is not None else cls_output[:, 0]
+            return transformer.classifier(transformer.dropout(pooled_output))
+        # RoBERTa、ELECTRA等的分类头直接取第一个token
+        return transformer.classifier(cls_output)
+
+    def packed_forward(self,
+                       input_ids,
+                       token_type_ids=None,
+                       position_ids=None,
+                       segment_ids=None,
+                       segment_starts=None,
+                       labels=None):
+        """
+        PackedDataset打包的输入，块对角attention_mask，
+        logits与labels均为(num_samples, ...)，loss与AutoModelForSequenceClassification一致
+        """
+        outputs = self.transformer.base_model(
+            input_ids,
+            attention_mask=segment_attention_mask(segment_ids),
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            return_dict=True)
+        logits = self.segment_logits(outputs.last_hidden_state,
+                                     segment_starts)
+        if labels is None:
+            return logits
+
+        if self.num_labels == 1:
+            loss = MSELoss()(logits.view(-1), labels.view(-1).float())
+        elif labels.dtype in (torch.long, torch.int):
+            loss = CrossEntropyLoss()(logits.view(-1, self.num_labels),
+                                      labels.view(-1))
+        else:
+            loss = nn.BCEWithLogitsLoss()(logits, labels.to(logits.dtype))
+        return (loss, logits)
+
 
 class MyGlueModel(MyGlueBaseModel):
 
@@ -439,7 +537,18 @@ class MyGlueModel(MyGlueBaseModel):
                 input_ids=None,
                 attention_mask=None,
                 token_type_ids=None,
-                labels=None):
+                labels=None,
+                position_ids=None,
+                segment_ids=None,
+                segment_starts=None):
+
+        if segment_starts is not None:
+            return self.packed_forward(input_ids,
+                                       token_type_ids=token_type_ids,
+                                       position_ids=position_ids,
+                                       segment_ids=segment_ids,
+                                       segment_starts=segment_starts,
+                                       labels=labels)
 
         outputs = self.transformer(input_ids,
                                    attention_mask=attention_mask,
@@ -454,6 +563,9 @@ class MyGlueModel(MyGlueBaseModel):
             return logits
 
 
+CL_FORWARD_MODES = ('fused', 'checkpoint', 'loop')
+
+
 class ContrastiveLearningGlueModel(MyGlueBaseModel):
 
     def __init__(
@@ -468,11 +580,21 @@ class ContrastiveLearningGlueModel(MyGlueBaseModel):
             #  loss_type='LabelSmoothingCrossEntropy',
             #  loss_type='DiceLoss',
             cl_alpha=4.0,
+            cl_forward_mode='fused',
             **kwargs):
 
         # for TransformerModel.load_from_config()
         self.num_labels = num_labels
         self.cl_alpha = cl_alpha
+        assert cl_forward_mode in CL_FORWARD_MODES, \
+            f"cl_forward_mode must be one of {CL_FORWARD_MODES}"
+        # 非reentrant的checkpoint(use_reentrant=False)需要torch >= 1.11
+        if cl_forward_mode == 'checkpoint' and 'use_reentrant' not in \
+                inspect.signature(torch_checkpoint).parameters:
+            raise ValueError(
+                f"cl_forward_mode='checkpoint' requires torch >= 1.11, got {torch.__version__}."
+            )
+        self.cl_forward_mode = cl_forward_mode
         super(ContrastiveLearningGlueModel, self).__init__(
             model_name_or_path,
             num_labels,
@@ -482,6 +604,46 @@ class ContrastiveLearningGlueModel(MyGlueBaseModel):
             loss_type=loss_type,
             **kwargs)
 
+    def _logits(self, input_ids, attention_mask=None, token_type_ids=None):
+        return self.transformer(input_ids,
+                                attention_mask=attention_mask,
+                                token_type_ids=token_type_ids,
+                                return_dict=True).logits
+
+    def dropout_logits(self,
+                       input_ids,
+                       attention_mask=None,
+                       token_type_ids=None):
+        """
+        同一输入两次dropout采样的logits [logits1, logits2]
+        fused: 两份输入沿batch维拼接，一次前向后再拆分，
+               两半的dropout掩码相互独立
+        checkpoint: 第二份不保存激活值，反向时重新计算，
+                    dropout随机状态随checkpoint保存，重算结果一致
+        loop: 原实现，两次独立前向
+        """
+        if self.cl_forward_mode == 'fused':
+            inputs = [
+                torch.cat([x, x], dim=0) if x is not None else None
+                for x in (input_ids, attention_mask, token_type_ids)
+            ]
+            return list(self._logits(*inputs).chunk(2, dim=0))
+
+        logits1 = self._logits(input_ids,
+                               attention_mask=attention_mask,
+                               token_type_ids=token_type_ids)
+        if self.cl_forward_mode == 'checkpoint':
+            logits2 = torch_checkpoint(self._logits,
+                                       input_ids,
+                                       attention_mask,
+                                       token_type_ids,
+                                       use_reentrant=False)
+        else:
+            logits2 = self._logits(input_ids,
+                                   attention_mask=attention_mask,
+                                   token_type_ids=token_type_ids)
+        return [logits1, logits2]
+
     def forward(self,
                 input_ids=None,
                 attention_mask=None,
@@ -489,16 +651,9 @@ class ContrastiveLearningGlueModel(MyGlueBaseModel):
                 labels=None):
 
         if labels is not None:
-            logits_list = []
-            for i in range(2):
-                outputs = self.transformer(input_ids,
-                                           attention_mask=attention_mask,
-                                           token_type_ids=token_type_ids,
-                                           labels=labels,
-                                           return_dict=True)
-                loss = outputs.loss
-                logits = outputs.logits
-                logits_list.append(logits)
+            logits_list = self.dropout_logits(input_ids,
+                                              attention_mask=attention_mask,
+                                              token_type_ids=token_type_ids)
 
             alpha = self.cl_alpha
             loss_fct = CrossEntropyLoss()
@@ -518,6 +673,85 @@ class ContrastiveLearningGlueModel(MyGlueBaseModel):
             return logits
 
 
+def benchmark_cl_forward_modes(model_name_or_path,
+                               num_labels=2,
+                               batch_size=16,
+                               max_length=128,
+                               steps=10,
+                               modes=CL_FORWARD_MODES,
+                               device=None):
+    """
+    比较ContrastiveLearningGlueModel各cl_forward_mode的训练步耗时和显存/内存。
+    内存以反向传播保存的激活值字节数计，CUDA上另记录峰值显存。
+    返回 {mode: {'step_ms', 'saved_mb', 'peak_mb'}}
+    """
+    import time
+    from torch.autograd.graph import saved_tensors_hooks
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = ContrastiveLearningGlueModel(model_name_or_path,
+                                         num_labels=num_labels).to(device)
+    model.train()
+    vocab_size = model.config.vocab_size
+    input_ids = torch.randint(1000 if vocab_size > 1000 else 1,
+                              vocab_size, (batch_size, max_length),
+                              device=device)
+    attention_mask = torch.ones_like(input_ids)
+    token_type_ids = torch.zeros_like(input_ids)
+    labels = torch.randint(0, num_labels, (batch_size, ), device=device)
+
+    def train_step():
+        loss, _ = model(input_ids,
+                        attention_mask=attention_mask,
+                        token_type_ids=token_type_ids,
+                        labels=labels)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    results = {}
+    for mode in modes:
+        model.cl_forward_mode = mode
+        train_step()
+
+        saved_bytes = [0]
+
+        def pack_hook(x):
+            saved_bytes[0] += x.numel() * x.element_size()
+            return x
+
+        with saved_tensors_hooks(pack_hook, lambda x: x):
+            loss, _ = model(input_ids,
+                            attention_mask=attention_mask,
+                            token_type_ids=token_type_ids,
+                            labels=labels)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        del loss
+
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            train_step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        step_ms = (time.perf_counter() - t0) / steps * 1000
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20 \
+            if device == 'cuda' else None
+
+        results[mode] = {
+            'step_ms': step_ms,
+            'saved_mb': saved_bytes[0] / 2**20,
+            'peak_mb': peak_mb
+        }
+        logger.info(f"{mode}: {step_ms:.1f} ms/step, "
+                    f"saved activations: {saved_bytes[0] / 2**20:.1f} MB, "
+                    f"peak memory: {peak_mb} MB")
+    return results
+
+
 # ------------------------------ TaskRunner ------------------------------
 
 
@@ -526,6 +760,8 @@ class GlueRunner(TaskRunner):
     任务专属模型定义
     """
 
+    kd_output_names = ('logits', )
+
     def __init__(self, task_args, glue_labels):
         super(GlueRunner, self).__init__(**task_args.to_dict())
         logger.warning(f"glue_labels: {glue_labels}")
@@ -539,6 +775,10 @@ class GlueRunner(TaskRunner):
         attention_probs_dropout_prob = model_args.attention_probs_dropout_prob
 
         logger.warning(f"num_labels: {self.num_labels}")
+        if model_args.cl_alpha and task_args.training_args.pack_sequences:
+            raise ValueError(
+                f"pack_sequences is not supported by ContrastiveLearningGlueModel (cl_alpha: {model_args.cl_alpha})."
+            )
         if model_args.cl_alpha:
             self.model = ContrastiveLearningGlueModel(
                 model_name_or_path=model_args.model_name_or_path
@@ -547,7 +787,8 @@ class GlueRunner(TaskRunner):
                 dropout_prob=model_args.dropout_prob,
                 attention_probs_dropout_prob=attention_probs_dropout_prob,
                 num_labels=self.num_labels,
-                cl_alpha=model_args.cl_alpha)
+                cl_alpha=model_args.cl_alpha,
+                cl_forward_mode=model_args.cl_forward_mode)
         else:
             self.model = MyGlueModel(
                 model_name_or_path=model_args.model_name_or_path
@@ -617,8 +858,12 @@ class GlueRunner(TaskRunner):
 #              return logits
 
     def training_step(self, batch, batch_idx):
+        teacher_outputs = pop_teacher_outputs(batch)
         outputs = self.forward(**batch)
         loss = outputs[0]
+        loss = self.kd_loss(loss, {'logits': outputs[1]},
+                            teacher_outputs,
+                            multi_label=batch['labels'].dim() > 1)
 
         self.log('train_loss', loss, on_step=True)
         #  self.log('lr', self.hparams.lr, on_step=True)
@@ -727,10 +972,12 @@ class GlueRunner(TaskRunner):
     def test_epoch_end(self, outputs):
 
         final_preds = torch.cat([out['preds'] for out in outputs])
+        final_preds = self.restore_test_order(final_preds)
         logger.info(f"preds: {final_preds.shape}")
         final_preds = final_preds.detach().cpu().numpy().tolist()
 
         final_logits = torch.cat([out['logits'] for out in outputs])
+        final_logits = self.restore_test_order(final_logits)
         logger.info(f"logits: {final_logits.shape}")
         final_logits = final_logits.detach().cpu().numpy().tolist()
 
@@ -789,3 +1036,20 @@ class GlueTask(BaseTask):
             do_submit=do_submit,
             train_data_generator=train_data_generator,
             test_data_generator=test_data_generator)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--num_labels", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    benchmark_cl_forward_modes(args.model_name_or_path,
+                               num_labels=args.num_labels,
+                               batch_size=args.batch_size,
+                               max_length=args.max_length,
+                               steps=args.steps)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
 import json
 import os
 import re
@@ -23,8 +24,16 @@ from ..arguments import (DataArguments, ModelArguments, TaskArguments,
                          TrainingArguments,
                          generate_method_kwargs_from_arguments)
 from ..data.samples import GlueSamples
+from ..data.packing import PACKED_TOKEN_KEYS, segment_attention_mask
+from ..data.samplers import stack_with_padding
+from ..data.teacher_logits import pop_teacher_outputs
+from ..tokenizers.alignment import (batch_offsets_to_char2token,
+                                    offsets_to_char2token,
+                                    offsets_to_token2char,
+                                    offsets_to_token_spans)
 #  from ...losses import DiceLoss, FocalLoss
 #  from .ner_decodes import crf_decode, mrc_decode, span_decode
+from .ner_decodes import batch_span_decode
 from .task import BaseDataset, BaseTask, TaskData, TaskRunner, TransformerModel
 
 #  def softmax(x):
@@ -39,30 +48,148 @@ def get_p_r_f1(tp, fp, fn):
     return np.array([p, r, f1])
 
 
-def generate_char2token(offset_mapping, num_text_len):
-    char2token = [-1] * num_text_len
+def get_p_r_f1_array(counters):
+    """
+    counters.shape: (num_categories, 3)，每行为(tp, fp, fn)
+    返回每个类别的(p, r, f1)，shape: (num_categories, 3)
+    """
+    counters = np.asarray(counters, dtype=np.float64)
+    tp, fp, fn = counters[:, 0], counters[:, 1], counters[:, 2]
 
-    for i, (start, end) in enumerate(offset_mapping):
-        if start == 0 and end == 0:
+    def safe_divide(a, b):
+        return np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+
+    p = safe_divide(tp, tp + fp)
+    r = safe_divide(tp, tp + fn)
+    f1 = safe_divide(2 * p * r, p + r)
+    return np.stack([p, r, f1], axis=-1)
+
+
+def resolve_overlap_entities(entities):
+    """
+    解决相互重叠的实体，按(预测窗口数多，长度长，位置靠前)的优先级保留，
+    保留的实体维持原有顺序。
+    entities: {(c, s, e): votes}
+    """
+    ranked = sorted(entities.items(),
+                    key=lambda x: (-x[1], -(x[0][2] - x[0][1]), x[0][1]))
+    # 已保留实体的区间互不重叠，按起点排序后终点也有序
+    kept_starts = []
+    kept_ends = []
+    kept = set()
+    for (c, s, e), _ in ranked:
+        idx = bisect.bisect_right(kept_starts, e)
+        if idx > 0 and kept_ends[idx - 1] >= s:
             continue
-        #  token2char[i] = start
-        for j in range(start, end):
-            char2token[j] = i
+        kept_starts.insert(idx, s)
+        kept_ends.insert(idx, e)
+        kept.add((c, s, e))
+    return [x for x in entities.keys() if x in kept]
+
+
+def merge_segment_entities(seg_spans, seg_preds, resolve_overlap=False):
+    """
+    流式合并滑动窗口的预测结果，以(category, start, end)哈希去重。
+    同一guid的窗口在seg_spans中是连续的，处理完一个文档的最后一个窗口后
+    立即输出该文档的结果。
 
-    return char2token
+    seg_spans: [(guid, s_seg, e_seg), ...]
+    seg_preds: [{category: [(start, end), ...]}, ...]，位置相对于窗口
+    yield: (guid, [[category, start, end], ...])
+    """
+
+    def finish(entities):
+        if resolve_overlap:
+            keys = resolve_overlap_entities(entities)
+        else:
+            keys = entities.keys()
+        return [list(x) for x in keys]
+
+    current_guid = None
+    # dict保持插入顺序，与按首次出现去重的顺序一致
+    entities = {}
+    for (guid, s_seg, _), dict_ents in zip(seg_spans, seg_preds):
+        if guid != current_guid:
+            if current_guid is not None:
+                yield current_guid, finish(entities)
+            current_guid = guid
+            entities = {}
+        for c, ents in dict_ents.items():
+            for s, e in ents:
+                if s >= 0 and e >= 0:
+                    key = (int(c), int(s + s_seg), int(e + s_seg))
+                    entities[key] = entities.get(key, 0) + 1
+    if current_guid is not None:
+        yield current_guid, finish(entities)
+
+
+def generate_char2token(offset_mapping, num_text_len):
+    return offsets_to_char2token(offset_mapping, num_text_len).tolist()
 
 
 def generate_token2chars(offset_mapping):
-    token2char = [-1] * (len(offset_mapping) + 1)
+    return offsets_to_token2char(offset_mapping).tolist()
+
+
+def split_text_segments(text, seg_len, seg_stride):
+    """
+    滑动窗口切分文本
+    返回 [(s_seg, e_seg, seg_text), ...]
+    """
+    segments = []
+    seg_offset = 0
+    while seg_offset < len(text):
+        s_seg = seg_offset
+        e_seg = seg_offset + seg_len - 1
+        seg_text = text[s_seg:e_seg + 1]
+        e_seg = s_seg + len(seg_text) - 1
+        segments.append((s_seg, e_seg, seg_text))
+        seg_offset += seg_stride
+    return segments
+
+
+# 句子分隔符，token级滑动窗口优先在句末截断
+SENTENCE_DELIMITERS = set("。！？!?；;\n")
 
+
+def find_sentence_ends(text, offset_mapping):
+    """
+    返回句末token的下一个token下标(递增)。
+    token的最后一个字符或其后到下一个token之间的字符为句子分隔符时，该token为句末。
+    """
+    sentence_ends = []
+    num_tokens = len(offset_mapping)
     for i, (start, end) in enumerate(offset_mapping):
-        if start == 0 and end == 0:
-            token2char[i] = -1
-            continue
-        token2char[i] = start
-        token2char[i + 1] = end
+        next_start = offset_mapping[i +
+                                    1][0] if i + 1 < num_tokens else len(text)
+        if any(ch in SENTENCE_DELIMITERS for ch in text[end - 1:next_start]):
+            sentence_ends.append(i + 1)
+    return np.array(sentence_ends, dtype=np.int64)
+
 
-    return token2char
+def split_token_windows(num_tokens, window_len, stride, sentence_ends=None):
+    """
+    在token序列上切分滑动窗口，返回 [(s_tok, e_tok), ...]，不包含e_tok。
+    提供sentence_ends时，窗口在(s_tok + stride, s_tok + window_len]内的最后一个句末截断，
+    下一个窗口从句末开始，不再重叠；找不到句末时按stride滑动。
+    """
+    assert 0 < stride <= window_len
+    windows = []
+    s_tok = 0
+    while s_tok < num_tokens:
+        e_tok = min(s_tok + window_len, num_tokens)
+        next_s_tok = s_tok + stride
+        if e_tok < num_tokens and sentence_ends is not None and len(
+                sentence_ends) > 0:
+            i = np.searchsorted(sentence_ends, e_tok, side='right') - 1
+            if i >= 0 and sentence_ends[i] >= next_s_tok:
+                e_tok = int(sentence_ends[i])
+                next_s_tok = e_tok
+        windows.append((s_tok, e_tok))
+        if e_tok >= num_tokens:
+            break
+        s_tok = next_s_tok
+    return windows
 
 
 # ------------------------------ Dataset ------------------------------
@@ -74,59 +201,93 @@ class NerDataset(BaseDataset):
     def __init__(self, *args, **kwargs):
         super(NerDataset, self).__init__(*args, **kwargs)
 
-    def _encode_item(self, x):
+    def _split_item(self, x):
+        """
+        按max_length将文本切分成滑动窗口片段
+        返回需要编码的片段列表 [((guid, s_seg, e_seg), seg_text, seg_tags), ...]
+        """
         guid, text, _, tags = x
 
-        #  logger.info(f"{guid}, {text}, tags: {tags}")
-
-        def seg_encode(text, tags):
-            batch_texts = [text]
-            batch_tags = [tags]
-            # -------- input_ids, attention_mask, token_type_ids --------
-            encodings = self.tokenizer.batch_encode_plus(
-                batch_texts,
-                padding=self.data_args.padding,
-                max_length=self.data_args.max_length,
-                add_special_tokens=True,
-                truncation=True,
-                return_offsets_mapping=True)
-
-            batch_input_ids = torch.from_numpy(
-                np.array(encodings.input_ids, dtype=np.int64))
-            batch_attention_mask = torch.from_numpy(
-                np.array(encodings.attention_mask, dtype=np.int64))
-            batch_token_type_ids = torch.from_numpy(
-                np.array(encodings.token_type_ids, dtype=np.int64))
-
-            batch_offset_mapping = encodings.offset_mapping
-            batch_tokens = [
-                #
-                [text[b:e] for b, e in offset_mapping if b > 0 or e > 0]
-                #
-                for text, offset_mapping in zip(batch_texts,
-                                                batch_offset_mapping)
-            ]
-            batch_char2tokens = [
-                generate_char2token(offset_mapping,
-                                    len(text)) for offset_mapping, text in zip(
-                                        batch_offset_mapping, batch_texts)
-            ]
-            batch_token2chars = [
-                generate_token2chars(offset_mapping)
-                for offset_mapping in batch_offset_mapping
-            ]
+        segments = []
+        seg_len = self.data_args.max_length - 2
+        seg_stride = int(seg_len / 2)
+        for s_seg, e_seg, seg_text in split_text_segments(
+                text, seg_len, seg_stride):
+            seg_offset = s_seg
+            seg_span = (guid, s_seg, e_seg)
+
+            if tags is not None:
+                seg_tags = []
+                if tags:
+                    for tag in tags:
+                        s = tag['start']
+                        e = s + len(tag['mention']) - 1
+                        if s >= s_seg and e <= e_seg:
+                            seg_tag = deepcopy(tag)
+                            seg_tag['start'] -= seg_offset
+                            seg_tags.append(seg_tag)
+                            #  logger.info(
+                            #      f"text: {text}\n"
+                            #      f"tag: {tag}\n"
+                            #      f"seg_len: {seg_len}, seg_stride: {seg_stride}\n"
+                            #      f"seg_offset: {seg_offset}\n"
+                            #      f"seg_tag: {seg_tag}\n")
+                            assert (
+                                seg_text[s:e + 1] == tag['mention'],
+                                f"text: {text}\n"
+                                f"tag: {tag}\n"
+                                f"seg_len: {seg_len}, seg_stride: {seg_stride}\n"
+                                f"seg_offset: {seg_offset}\n"
+                                f"seg_tag: {seg_tag}\n")
+
+                if seg_tags:
+                    segments.append((seg_span, seg_text, seg_tags))
+                else:
+                    if self.data_args.preserve_no_entity:
+                        segments.append((seg_span, seg_text, []))
+            else:
+                segments.append((seg_span, seg_text, None))
+
+        return segments
 
-            #  for text, offset_mapping in zip(batch_texts, batch_offset_mapping):
-            #      tokens = [
-            #          text[b:e] for b, e in offset_mapping if b > 0 or e > 0
-            #      ]
+    def _encode_segments(self, segments):
+        """
+        一次tokenizer调用编码所有片段
+        segments: [((guid, s_seg, e_seg), seg_text, seg_tags), ...]
+        """
+        if not segments:
+            return []
+
+        batch_texts = [seg_text for _, seg_text, _ in segments]
+        # 逐条编码时'longest'等价于不padding，批量编码保持一致
+        padding = self.data_args.padding
+        if padding != 'max_length':
+            padding = False
+        # -------- input_ids, attention_mask, token_type_ids --------
+        encodings = self._tokenize(
+            batch_texts,
+            padding=padding,
+            max_length=self.data_args.max_length,
+            add_special_tokens=True,
+            truncation=True,
+            return_offsets_mapping=True)
+
+        all_char2token = batch_offsets_to_char2token(
+            encodings.offset_mapping, [len(text) for text in batch_texts])
 
-            input_ids = batch_input_ids[0]
-            attention_mask = batch_attention_mask[0]
-            token_type_ids = batch_token_type_ids[0]
-            tokens = batch_tokens[0]
-            char2token = batch_char2tokens[0]
-            token2char = batch_token2chars[0]
+        all_encoded = []
+        for i, ((guid, _, _), text, tags) in enumerate(segments):
+            input_ids = torch.from_numpy(
+                np.array(encodings.input_ids[i], dtype=np.int64))
+            attention_mask = torch.from_numpy(
+                np.array(encodings.attention_mask[i], dtype=np.int64))
+            token_type_ids = torch.from_numpy(
+                np.array(encodings.token_type_ids[i], dtype=np.int64))
+
+            offset_mapping = encodings.offset_mapping[i]
+            tokens = [text[b:e] for b, e in offset_mapping if b > 0 or e > 0]
+            char2token = all_char2token[i].tolist()
+            token2char = generate_token2chars(offset_mapping)
 
             # -------- labels --------
             if tags is not None:
@@ -139,10 +300,6 @@ class NerDataset(BaseDataset):
                     m = tag['mention']
                     e = s + len(m) - 1
 
-                    #  logger.info(f"text: {text}")
-                    #  logger.info(f"tokens: {tokens}")
-                    #  logger.info(f"tag: {tag}")
-                    #  logger.info(f"s: {s}, e: {e}, char2token: {char2token}")
                     s = char2token[s]
                     if s < 1:
                         logger.warning(f"{guid}, {text}, tags: {tags}")
@@ -151,12 +308,7 @@ class NerDataset(BaseDataset):
                     if e < 1:
                         logger.warning(f"{guid}, {text}, tags: {tags}")
                     assert e >= 1
-                    #  logger.debug(
-                    #      f"num_tokens: {num_tokens}, s: {s}, e: {e}, c: {c}, m: {m}, text: {text}"
-                    #  )
                     c_id = self.label2id[c]
-                    #  assert c_id < 10, f"c_id: {c_id}"
-                    #  logger.info(f"c_id: {c_id}")
                     start_ids[s] = c_id
                     end_ids[e] = c_id
 
@@ -168,7 +320,7 @@ class NerDataset(BaseDataset):
                 start_ids = None
                 end_ids = None
 
-            return {
+            all_encoded.append({
                 'tokens': tokens,
                 'char2token': char2token,
                 'token2char': token2char,
@@ -177,60 +329,175 @@ class NerDataset(BaseDataset):
                 'token_type_ids': token_type_ids,
                 'start_ids': start_ids,
                 'end_ids': end_ids,
-                'tags': tags
-            }
+                'tags': tags,
+                'token_spans': offsets_to_token_spans(offset_mapping)
+            })
 
-        all_encoded = []
-        seg_len = self.data_args.max_length - 2
-        seg_stride = int(seg_len / 2)
-        seg_offset = 0
-        while seg_offset < len(text):
-            s_seg = seg_offset
-            e_seg = seg_offset + seg_len - 1
+        return all_encoded
+
+    def _tokenize_documents(self, texts):
+        """
+        整篇文档只tokenize一次，不添加特殊token
+        返回 input_ids: [[id, ...], ...], offset_mapping: [[(start, end), ...], ...]
+        """
+        encodings = self._tokenize(texts,
+                                   encode_fn=self.tokenizer,
+                                   add_special_tokens=False,
+                                   return_offsets_mapping=True)
+        return encodings.input_ids, encodings.offset_mapping
+
+    def _encode_token_windows(self, x, doc_input_ids, doc_offsets):
+        """
+        在整篇文档的token序列上切分滑动窗口并编码
+        返回 [(seg_span, encoded), ...]，seg_span为(guid, s_seg, e_seg)，
+        token_spans[i]为第i个token在窗口文本中的字符区间[start, end)，特殊token为-1
+        """
+        guid, text, _, tags = x
+        tokenizer = self.tokenizer
+        window_len = self.data_args.max_length - 2
+        stride = self.data_args.segment_stride or max(window_len // 2, 1)
+
+        doc_input_ids = np.asarray(doc_input_ids, dtype=np.int64)
+        doc_offsets = np.asarray(doc_offsets, dtype=np.int64).reshape(-1, 2)
+        num_tokens = len(doc_input_ids)
+
+        sentence_ends = None
+        if self.data_args.segment_by_sentence:
+            sentence_ends = find_sentence_ends(text, doc_offsets.tolist())
+        windows = split_token_windows(num_tokens, window_len, stride,
+                                      sentence_ends)
+
+        doc_char2token = offsets_to_char2token(doc_offsets, len(text))
+
+        # 实体的token位置只计算一次
+        tag_tokens = []
+        if tags:
+            for tag in tags:
+                s = tag['start']
+                e = s + len(tag['mention']) - 1
+                s_tok = doc_char2token[s] if 0 <= s < len(text) else -1
+                e_tok = doc_char2token[e] if 0 <= e < len(text) else -1
+                if s_tok < 0 or e_tok < 0:
+                    logger.warning(
+                        f"{guid}, tag {tag} is not aligned to tokens.")
+                    continue
+                tag_tokens.append((tag, s_tok, e_tok))
+
+        pad_to = 0
+        if self.data_args.padding == 'max_length':
+            pad_to = self.data_args.max_length
+        results = []
+        for s_tok, e_tok in windows:
+            n = e_tok - s_tok
+            s_seg = int(doc_offsets[s_tok, 0])
+            e_seg = int(doc_offsets[e_tok - 1, 1]) - 1
             seg_text = text[s_seg:e_seg + 1]
-            if len(seg_text) == 0:
-                continue
-            e_seg = min(e_seg, len(seg_text) - 1)
-            self.seg_spans.append((guid, s_seg, e_seg))
 
             if tags is not None:
-                seg_tags = []
-                if tags:
-                    for tag in tags:
-                        s = tag['start']
-                        e = s + len(tag['mention']) - 1
-                        if s >= s_seg and e <= e_seg:
-                            seg_tag = deepcopy(tag)
-                            seg_tag['start'] -= seg_offset
-                            seg_tags.append(seg_tag)
-                            #  logger.info(
-                            #      f"text: {text}\n"
-                            #      f"tag: {tag}\n"
-                            #      f"seg_len: {seg_len}, seg_stride: {seg_stride}\n"
-                            #      f"seg_offset: {seg_offset}\n"
-                            #      f"seg_tag: {seg_tag}\n")
-                            assert (
-                                seg_text[s:e + 1] == tag['mention'],
-                                f"text: {text}\n"
-                                f"tag: {tag}\n"
-                                f"seg_len: {seg_len}, seg_stride: {seg_stride}\n"
-                                f"seg_offset: {seg_offset}\n"
-                                f"seg_tag: {seg_tag}\n")
-
-                if seg_tags:
-                    encoded = seg_encode(seg_text, seg_tags)
-                    all_encoded.append(encoded)
-                else:
-                    if self.data_args.preserve_no_entity:
-                        encoded = seg_encode(seg_text, [])
-                        all_encoded.append(encoded)
+                seg_tags = [(dict(tag, start=tag['start'] - s_seg),
+                             s - s_tok + 1, e - s_tok + 1)
+                            for tag, s, e in tag_tokens
+                            if s >= s_tok and e < e_tok]
+                if not seg_tags and not self.data_args.preserve_no_entity:
+                    continue
+            else:
+                seg_tags = None
+
+            seq_len = max(n + 2, pad_to)
+            input_ids = np.full(seq_len,
+                                tokenizer.pad_token_id,
+                                dtype=np.int64)
+            input_ids[0] = tokenizer.cls_token_id
+            input_ids[1:n + 1] = doc_input_ids[s_tok:e_tok]
+            input_ids[n + 1] = tokenizer.sep_token_id
+            attention_mask = np.zeros(seq_len, dtype=np.int64)
+            attention_mask[:n + 2] = 1
+            token_type_ids = np.zeros(seq_len, dtype=np.int64)
+
+            token_spans = np.full((seq_len, 2), -1, dtype=np.int64)
+            token_spans[1:n + 1] = doc_offsets[s_tok:e_tok] - s_seg
+            offset_mapping = np.where(token_spans >= 0, token_spans, 0)
+            token2char = generate_token2chars(offset_mapping)
+            tokens = [seg_text[b:e] for b, e in token_spans[1:n + 1]]
+
+            char2token = doc_char2token[s_seg:e_seg + 1]
+            char2token = np.where(char2token >= 0, char2token - s_tok + 1,
+                                  -1).tolist()
+
+            if seg_tags is not None:
+                start_ids = np.zeros(seq_len, dtype=np.int64)
+                end_ids = np.zeros(seq_len, dtype=np.int64)
+                for tag, s, e in seg_tags:
+                    c_id = self.label2id[tag['category']]
+                    start_ids[s] = c_id
+                    end_ids[e] = c_id
+                start_ids = torch.from_numpy(start_ids)
+                end_ids = torch.from_numpy(end_ids)
+                seg_tags = [tag for tag, _, _ in seg_tags]
             else:
-                encoded = seg_encode(seg_text, None)
-                all_encoded.append(encoded)
+                start_ids = None
+                end_ids = None
 
-            seg_offset += seg_stride
+            results.append(((guid, s_seg, e_seg), {
+                'tokens': tokens,
+                'char2token': char2token,
+                'token2char': token2char,
+                'input_ids': torch.from_numpy(input_ids),
+                'attention_mask': torch.from_numpy(attention_mask),
+                'token_type_ids': torch.from_numpy(token_type_ids),
+                'start_ids': start_ids,
+                'end_ids': end_ids,
+                'tags': seg_tags,
+                'token_spans': token_spans
+            }))
+        return results
 
-        return all_encoded
+    def _encode_item(self, x):
+        if self.data_args.segment_mode == 'token':
+            input_ids, offset_mapping = self._tokenize_documents([x[1]])
+            windows = self._encode_token_windows(x, input_ids[0],
+                                                 offset_mapping[0])
+            self.seg_spans.extend([seg_span for seg_span, _ in windows])
+            return [encoded for _, encoded in windows]
+
+        segments = self._split_item(x)
+        self.seg_spans.extend([seg_span for seg_span, _, _ in segments])
+        return self._encode_segments(segments)
+
+    def _encode_batch(self, batch):
+        """
+        合并batch内所有样本的片段，只调用一次tokenizer
+        """
+        if self.data_args.segment_mode == 'token':
+            all_input_ids, all_offset_mapping = self._tokenize_documents(
+                [x[1] for x in batch])
+            results = []
+            for x, input_ids, offset_mapping in zip(batch, all_input_ids,
+                                                    all_offset_mapping):
+                windows = self._encode_token_windows(x, input_ids,
+                                                     offset_mapping)
+                results.append(([encoded for _, encoded in windows],
+                                [seg_span for seg_span, _ in windows]))
+            return results
+
+        all_segments = []
+        num_segments = []
+        for x in batch:
+            segments = self._split_item(x)
+            all_segments.extend(segments)
+            num_segments.append(len(segments))
+
+        all_encoded = self._encode_segments(all_segments)
+
+        results = []
+        offset = 0
+        for n in num_segments:
+            seg_spans = [
+                seg_span for seg_span, _, _ in all_segments[offset:offset + n]
+            ]
+            results.append((all_encoded[offset:offset + n], seg_spans))
+            offset += n
+        return results
 
     @classmethod
     def collate_fn(cls, batch):
@@ -255,24 +522,26 @@ class NerDataset(BaseDataset):
             'input_ids', 'attention_mask', 'token_type_ids'
         ]
         maybe_none_tensor_keys = ['start_ids', 'end_ids']
-        not_tensor_keys = ['tokens', 'char2token', 'token2char', 'tags']
+        not_tensor_keys = [
+            'tokens', 'char2token', 'token2char', 'tags', 'token_spans'
+        ]
 
         # not None tensors
         for key in not_none_tensor_keys:
             key_batch = [e[key] for e in batch if e[key] is not None]
-            batch_values = torch.stack(key_batch)
+            batch_values = stack_with_padding(key_batch)
             stacked_batch[key] = batch_values
         # maybe None tensors
         for key in maybe_none_tensor_keys:
             key_batch = [e[key] for e in batch if e[key] is not None]
             if key_batch:
-                batch_values = torch.stack(key_batch)
+                batch_values = stack_with_padding(key_batch)
                 stacked_batch[key] = batch_values
             else:
                 stacked_batch[key] = None
         # not tensors
         for key in not_tensor_keys:
-            key_batch = [e[key] for e in batch if e[key] is not None]
+            key_batch = [e[key] for e in batch if e.get(key) is not None]
             stacked_batch[key] = key_batch
 
         return stacked_batch
@@ -375,11 +644,18 @@ class BertSpanForNer(BertPreTrainedModel):
                 token_type_ids=None,
                 start_ids=None,
                 end_ids=None,
+                position_ids=None,
+                segment_ids=None,
                 **kwargs):
         #  subjects_ids=None):
+        # 打包的样本之间互不可见，loss仍按attention_mask统计所有样本的token
+        bert_attention_mask = attention_mask
+        if segment_ids is not None:
+            bert_attention_mask = segment_attention_mask(segment_ids)
         outputs = self.bert(input_ids=input_ids,
-                            attention_mask=attention_mask,
-                            token_type_ids=token_type_ids)
+                            attention_mask=bert_attention_mask,
+                            token_type_ids=token_type_ids,
+                            position_ids=position_ids)
         sequence_output = outputs[0]
         sequence_output = self.dropout(sequence_output)
         start_logits = self.start_fc(sequence_output)
@@ -484,14 +760,18 @@ class BertSpanModel(TransformerModel):
                 start_ids=None,
                 end_ids=None,
                 pseudo=None,
-                tags=None):
+                tags=None,
+                position_ids=None,
+                segment_ids=None):
 
         outputs = self.transformer(input_ids,
                                    attention_mask=attention_mask,
                                    token_type_ids=token_type_ids,
                                    start_ids=start_ids,
                                    end_ids=end_ids,
-                                   tags=tags)
+                                   tags=tags,
+                                   position_ids=position_ids,
+                                   segment_ids=segment_ids)
         if tags is not None:
             loss, start_logits, end_logits = outputs
             return loss, start_logits, end_logits
@@ -596,62 +876,12 @@ class BertSpanModel(TransformerModel):
         """
         start_probs.shape: (batch_size, max_length, num_labels)
         end_probs.shape: (batch_size, max_length, num_labels)
+        整个batch向量化解码，原逐token循环实现见ner_decodes.batch_span_decode_loop
         """
-        #  logger.info(f"start_probs.shape: {start_probs.shape}")
-        #  logger.info(f"end_probs.shape: {end_probs.shape}")
-
-        #  start_probs = start_probs[:, 1:-1]
-        #  end_probs = end_probs[:, 1:-1]
-
-        #  logger.info(f"start_probs: {start_probs}")
-        #  logger.info(f"end_probs: {end_probs}")
-        """
-        start_preds.shape: (batch_size, max_length -2)
-        end_preds.shape: (batch_size, max_length -2)
-        """
-        start_preds = np.argmax(start_probs, -1)
-        end_preds = np.argmax(end_probs, -1)
-        #  logger.info(f"start_preds: {start_preds.shape} {start_preds[:3,:]}")
-        #  logger.info(f"end_preds: {end_preds.shape} {end_preds[:3,:]}")
-
-        if confidence > 0.0:
-            for i, x in enumerate(start_preds):
-                start_preds[i] = [
-                    category if start_probs[i][j][category] > confidence else 0
-                    for j, category in enumerate(start_preds[i])
-                ]
-            for i, x in enumerate(end_preds):
-                end_preds[i] = [
-                    category if end_probs[i][j][category] > confidence else 0
-                    for j, category in enumerate(end_preds[i])
-                ]
-
-        final_predict_ents = []
-        for start_pred, end_pred, text_len in zip(start_preds, end_preds,
-                                                  batch_lens):
-            start_pred = start_pred[:text_len]
-            end_pred = end_pred[:text_len]
-            predict_ents = defaultdict(list)
-            last_j = -1
-            for i, s_type in enumerate(start_pred):
-                if s_type == 0:
-                    continue
-                if i <= last_j:
-                    continue
-                for j, e_type in enumerate(end_pred[i:]):
-                    if s_type == e_type:
-                        last_j = j
-                        s = i
-                        e = j + i
-                        predict_ents[s_type].append((s, e))
-                        break
-                    if i + j < len(start_pred) - 1 and start_pred[i + j +
-                                                                  1] != 0:
-                        break
-            final_predict_ents.append(predict_ents)
-        #  logger.warning(f"final_predict_ents: {final_predict_ents}")
-
-        return final_predict_ents
+        return batch_span_decode(start_probs,
+                                 end_probs,
+                                 batch_lens,
+                                 confidence=confidence)
 
 
 class ___BertSpanModel(TransformerModel):
@@ -1096,6 +1326,9 @@ class NerRunner(TaskRunner):
     任务专属模型定义
     """
 
+    kd_output_names = ('start_logits', 'end_logits')
+    packed_token_keys = PACKED_TOKEN_KEYS + ('start_ids', 'end_ids')
+
     def __init__(self, task_args, ner_labels):
         super(NerRunner, self).__init__(**task_args.to_dict())
         logger.warning(f"ner_labels: {ner_labels}")
@@ -1113,7 +1346,8 @@ class NerRunner(TaskRunner):
                 model_args.checkpoint_path, "checkpoint"),
             num_labels=self.num_labels)
 
-        self.all_ccm_list = []
+        # 验证集各类别累计的(tp, fp, fn)，下标为类别id，0不使用
+        self.val_counters = np.zeros((self.num_labels, 3), dtype=np.int64)
 
     def forward(self, *args, **kwargs):
         kwargs = generate_method_kwargs_from_arguments(self.model.__class__,
@@ -1122,8 +1356,17 @@ class NerRunner(TaskRunner):
         return self.model(*args, **kwargs)
 
     def training_step(self, batch, batch_idx):
+        teacher_outputs = pop_teacher_outputs(batch)
         outputs = self.forward(**batch)
         loss, start_logits, end_logits = outputs
+        student_outputs = {
+            'start_logits': start_logits,
+            'end_logits': end_logits
+        }
+        loss = self.kd_loss(loss,
+                            student_outputs,
+                            teacher_outputs,
+                            mask=batch['attention_mask'])
 
         self.log('train_loss', loss, on_step=True)
         #  self.log('lr', self.hparams.lr, on_step=True)
@@ -1153,6 +1396,30 @@ class NerRunner(TaskRunner):
 
         return np.array([tp, fp, fn])
 
+    def update_counters(self, counters, golden_tags, pred_tags):
+        """
+        按类别累加(tp, fp, fn)到counters
+        golden_tags, pred_tags: {category_id: [(start, end), ...]}
+        """
+        for c_id in set(golden_tags.keys()) | set(pred_tags.keys()):
+            golden = golden_tags.get(c_id, [])
+            golden_set = set(golden)
+            preds = pred_tags.get(c_id, [])
+            tp = sum(1 for x in preds if tuple(x) in golden_set)
+            counters[c_id, 0] += tp
+            counters[c_id, 1] += len(preds) - tp
+            counters[c_id, 2] += len(golden) - tp
+
+    def weighted_metrics(self, p_r_f1, num_categories):
+        """
+        各类别(p, r, f1)按type_weights加权平均
+        """
+        weights = self.type_weights[:self.num_labels - 1, None]
+        return (p_r_f1[1:] * weights).sum(axis=0) / num_categories
+
+    def on_validation_epoch_start(self):
+        self.val_counters[:] = 0
+
     def category_confuse_matrix(self, golden_tags, pred_tags):
         """
         {category_id: [(start, end), ...]}
@@ -1199,28 +1466,12 @@ class NerRunner(TaskRunner):
                 golden_tags[self.label2id[c]].append(item)
             batch_golden_tags.append(golden_tags)
 
-        all_ccm = []
         for golden_tags, pred_tags in zip(batch_golden_tags, batch_pred_tags):
-            ccm = self.category_confuse_matrix(golden_tags, pred_tags)
-            all_ccm.append(ccm)
+            self.update_counters(self.val_counters, golden_tags, pred_tags)
 
-        self.all_ccm_list.append(all_ccm)
-        category_confuse_matrix = {
-            c_id: np.array([0, 0, 0])
-            for c_id in self.id2label.keys()
-        }
-        for all_ccm in self.all_ccm_list:
-            for ccm in all_ccm:
-                for c_id, x in ccm.items():
-                    category_confuse_matrix[c_id] += x
-        micro_metrics = np.zeros(3)
-        category_p_r_f1 = {}
-        for c_id, (tp, fp, fn) in category_confuse_matrix.items():
-            p_r_f1 = get_p_r_f1(tp, fp, fn)
-            category_p_r_f1[self.id2label[c_id]] = (p_r_f1, (tp, fp, fn))
-            micro_metrics += p_r_f1 * self.type_weights[c_id - 1]
-        micro_metrics /= self.num_labels
-        val_precision, val_recall, val_f1 = micro_metrics
+        p_r_f1 = get_p_r_f1_array(self.val_counters)
+        val_precision, val_recall, val_f1 = self.weighted_metrics(
+            p_r_f1, self.num_labels)
         self.log("val_precision", val_precision, on_step=True)
         self.log("val_recall", val_recall, on_step=True)
         self.log("val_f1", val_f1, on_step=True)
@@ -1231,7 +1482,6 @@ class NerRunner(TaskRunner):
             'val_precision': val_precision,
             'val_recall': val_recall,
             'val_f1': val_f1,
-            'category_confuse_matrix': all_ccm
         })
 
     def show_val_results(self, category_p_r_f1):
@@ -1304,24 +1554,21 @@ class NerRunner(TaskRunner):
         max_batch_idx = max([out["batch_idx"] for out in outputs])
         self.log('val_loss', val_loss, on_epoch=True)
 
-        category_confuse_matrix = {
-            c_id: np.array([0, 0, 0])
-            for c_id in self.id2label.keys()
+        # 各进程的计数只在epoch结束时合并一次
+        counters = self.val_counters
+        if torch.distributed.is_available(
+        ) and torch.distributed.is_initialized():
+            counters = torch.from_numpy(counters).to(self.device)
+            torch.distributed.all_reduce(counters,
+                                         op=torch.distributed.ReduceOp.SUM)
+            counters = counters.cpu().numpy()
+
+        p_r_f1 = get_p_r_f1_array(counters)
+        category_p_r_f1 = {
+            c: (p_r_f1[c_id], tuple(counters[c_id]))
+            for c_id, c in self.id2label.items()
         }
-        for out in outputs:
-            all_ccm = out['category_confuse_matrix']
-            for ccm in all_ccm:
-                for c_id, x in ccm.items():
-                    category_confuse_matrix[c_id] += x
-
-        micro_metrics = np.zeros(3)
-        category_p_r_f1 = {}
-        for c_id, (tp, fp, fn) in category_confuse_matrix.items():
-            p_r_f1 = get_p_r_f1(tp, fp, fn)
-            category_p_r_f1[self.id2label[c_id]] = (p_r_f1, (tp, fp, fn))
-            micro_metrics += p_r_f1 * self.type_weights[c_id - 1]
-
-        micro_metrics /= self.num_labels - 1
+        micro_metrics = self.weighted_metrics(p_r_f1, self.num_labels - 1)
 
         val_precision, val_recall, val_f1 = micro_metrics
         #  logger.info(f"category_p_r_f1: {category_p_r_f1}")
@@ -1365,11 +1612,21 @@ class NerRunner(TaskRunner):
                                                  end_probs,
                                                  batch_lens=batch_lens)
 
-        batch_token2chars = batch['token2char']
-        for pred_tags, token2char in zip(batch_pred_tags, batch_token2chars):
-            for c, tags in pred_tags.items():
-                pred_tags[c] = [(token2char[s], token2char[e + 1] - 1)
-                                for s, e in tags]
+        batch_token_spans = batch.get('token_spans', None)
+        if batch_token_spans:
+            # 直接使用每个token的字符区间，旧缓存中没有token_spans时使用token2char
+            for pred_tags, token_spans in zip(batch_pred_tags,
+                                              batch_token_spans):
+                for c, tags in pred_tags.items():
+                    pred_tags[c] = [(token_spans[s][0], token_spans[e][1] - 1)
+                                    for s, e in tags]
+        else:
+            batch_token2chars = batch['token2char']
+            for pred_tags, token2char in zip(batch_pred_tags,
+                                             batch_token2chars):
+                for c, tags in pred_tags.items():
+                    pred_tags[c] = [(token2char[s], token2char[e + 1] - 1)
+                                    for s, e in tags]
 
         return OrderedDict({
             'preds': batch_pred_tags,
@@ -1380,6 +1637,7 @@ class NerRunner(TaskRunner):
     def test_epoch_end(self, outputs):
 
         test_preds = np.concatenate([out['preds'] for out in outputs])
+        test_preds = self.restore_test_order(test_preds)
         logger.info(f"test_preds: {test_preds.shape}")
 
         test_dataset = self.test_dataloader.dataloader.dataset
@@ -1389,46 +1647,18 @@ class NerRunner(TaskRunner):
             0], f"len(seg_spans): {len(seg_spans)} == test_preds.shape[0]: {test_preds.shape[0]}"
 
         test_ents = defaultdict(list)
-        for (guid, s_seg, e_seg), dict_ents in zip(seg_spans, test_preds):
-            shift_ents = []
-            for c, ents in dict_ents.items():
-                ents = [(c, s + s_seg, e + s_seg) for s, e in ents
-                        if s >= 0 and e >= 0]
-
-                if ents:
-                    shift_ents.extend(ents)
-
-            test_ents[guid].append(shift_ents)
-
-        # 合并去重
-        for guid, ents in test_ents.items():
-            ents = [x for x in ents if x]
-            unique_ents = []
-            ent_keys = []
-            if len(ents) > 0:
-                ents = np.concatenate(ents).tolist()
-                for ent in ents:
-                    key = str(ent)
-                    if key not in ent_keys:
-                        ent_keys.append(key)
-                        unique_ents.append(ent)
-            test_ents[guid] = unique_ents
-        #  for guid, ents in test_ents.items():
-        #      unique_ents = []
-        #      ent_keys = []
-        #      for ent in ents:
-        #          key = str(ent)
-        #          logger.info(f"key: {key}")
-        #          if key not in ent_keys:
-        #              ent_keys.append(key)
-        #              unique_ents.append(ent)
-        #          else:
-        #              logger.warning(f"Duplicate {key}")
-        #      test_ents[guid] = unique_ents
-
-        #  assert len(test_ents) == len(
-        #      test_dataset
-        #  ), f"len(test_ents): {len(test_ents)}, len(test_dataset): {len(test_dataset)}"
+        for guid, ents in merge_segment_entities(
+                seg_spans,
+                test_preds,
+                resolve_overlap=self.hparams.resolve_overlap_entities):
+            if guid in test_ents:
+                # 同一文档的窗口不连续时，合并后再次去重
+                logger.warning(f"Segments of {guid} are not contiguous.")
+                ents = list(
+                    dict.fromkeys(
+                        tuple(x) for x in test_ents[guid] + ents).keys())
+                ents = [list(x) for x in ents]
+            test_ents[guid] = ents
 
         final_preds = test_ents
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+基于offset数组的字符/token对齐
+
+offsets: tokenizer返回的offset_mapping，形如[(start, end), ...]，
+特殊token和padding为(0, 0)。所有函数只使用NumPy数组运算，不逐字符循环。
+
+    offsets    : [(0, 0), (0, 1), (1, 2), (2, 7), (0, 0)]
+    char2token : [1, 2, 3, 3, 3, 3, 3]
+    token2char : [-1, 0, 1, 2, -1]
+    token_spans: [[-1, -1], [0, 1], [1, 2], [2, 7], [-1, -1]]
+"""
+
+from itertools import chain
+
+import numpy as np
+
+
+def _as_offsets(offsets):
+    if isinstance(offsets, (list, tuple)):
+        # 比np.asarray转换由tuple组成的list快数倍
+        return np.fromiter(chain.from_iterable(offsets),
+                           dtype=np.int64,
+                           count=2 * len(offsets)).reshape(-1, 2)
+    return np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+
+
+def offsets_to_char2token(offsets, text_len):
+    """
+    返回长度为text_len的数组，每个字符所在的token下标，不属于任何token的字符为-1。
+    多个token覆盖同一字符时取后一个token。
+    """
+    offsets = _as_offsets(offsets)
+    char2token = np.full(text_len, -1, dtype=np.int64)
+    starts = np.minimum(offsets[:, 0], text_len)
+    ends = np.minimum(offsets[:, 1], text_len)
+    lengths = np.maximum(ends - starts, 0)
+    total = int(lengths.sum())
+    if total == 0:
+        return char2token
+
+    token_ids = np.repeat(np.arange(len(offsets)), lengths)
+    # 每个字符相对于所在token起点的位置
+    first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    chars = np.repeat(starts, lengths) + np.arange(total) - first
+    char2token[chars] = token_ids
+    return char2token
+
+
+def offsets_to_token2char(offsets):
+    """
+    与task_ner.generate_token2chars()相同的结果：长度为len(offsets) + 1，
+    token2char[i]为第i个token的起始字符，特殊token为-1，
+    token2char[-1]为最后一个token的结束字符(最后一个token为特殊token时为-1)。
+    """
+    offsets = _as_offsets(offsets)
+    num_tokens = len(offsets)
+    token2char = np.full(num_tokens + 1, -1, dtype=np.int64)
+    if num_tokens == 0:
+        return token2char
+    special = (offsets[:, 0] == 0) & (offsets[:, 1] == 0)
+    token2char[:num_tokens] = np.where(special, -1, offsets[:, 0])
+    if not special[-1]:
+        token2char[num_tokens] = offsets[-1, 1]
+    return token2char
+
+
+def offsets_to_token_spans(offsets):
+    """
+    每个token的字符区间[start, end)，特殊token为[-1, -1]
+    """
+    offsets = _as_offsets(offsets)
+    special = (offsets[:, 0] == 0) & (offsets[:, 1] == 0)
+    token_spans = offsets.copy()
+    token_spans[special] = -1
+    return token_spans
+
+
+def batch_offsets_to_char2token(batch_offsets, text_lens):
+    """
+    批量计算char2token，所有样本拼接后只做一次数组运算
+    返回与batch_offsets一一对应的数组列表
+    """
+    text_lens = np.asarray(text_lens, dtype=np.int64)
+    if len(text_lens) == 0:
+        return []
+    num_tokens = np.array([len(x) for x in batch_offsets], dtype=np.int64)
+    offsets = _as_offsets([x for offsets in batch_offsets for x in offsets])
+
+    # 样本在拼接后字符序列、token序列中的起点
+    char_base = np.cumsum(text_lens) - text_lens
+    token_base = np.cumsum(num_tokens) - num_tokens
+    sample_ids = np.repeat(np.arange(len(num_tokens)), num_tokens)
+
+    sample_lens = text_lens[sample_ids]
+    starts = np.minimum(offsets[:, 0], sample_lens)
+    ends = np.minimum(offsets[:, 1], sample_lens)
+    lengths = np.maximum(ends - starts, 0)
+
+    char2token = np.full(int(text_lens.sum()), -1, dtype=np.int64)
+    total = int(lengths.sum())
+    if total > 0:
+        local_token_ids = np.arange(len(offsets)) - token_base[sample_ids]
+        token_ids = np.repeat(local_token_ids, lengths)
+        first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        chars = np.repeat(starts + char_base[sample_ids],
+                          lengths) + np.arange(total) - first
+        char2token[chars] = token_ids
+    return np.split(char2token, np.cumsum(text_lens)[:-1])
+
+
+def batch_offsets_to_token2char(batch_offsets):
+    return [offsets_to_token2char(x) for x in batch_offsets]
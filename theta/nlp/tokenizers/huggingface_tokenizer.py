@@ -22,6 +22,19 @@ from loguru import logger
 
 from transformers import BertTokenizer
 
+from .alignment import (batch_offsets_to_char2token, offsets_to_char2token,
+                        offsets_to_token2char)
+
+EMPTY_ENCODES = {
+    'tokens': None,
+    'offsets': None,
+    'token2char': None,
+    'char2token': None,
+    'ids': None,
+    'attention_mask': None,
+    'type_ids': None
+}
+
 
 # Hugging Face Tokenizer
 class HFTokenizer:
@@ -30,8 +43,14 @@ class HFTokenizer:
                  lowercase=True,
                  strip_accents=False,
                  clean_text=True,
-                 cc=None):
+                 cc=None,
+                 cache=None):
+        """
+        cache: TokenizationCache，缓存ids、offsets等编码结果
+        """
         self.vocab_file = vocab_file
+        self.cache = cache
+        self.cc_config = cc
         self.cc = None
         if cc is not None:
             # pip install opencc-python-reimplemented
@@ -50,21 +69,23 @@ class HFTokenizer:
 
     def encode(self, text, text_b=None, add_special_tokens=True):
         if not text:
-            return {
-                'tokens': None,
-                'offsets': None,
-                'token2char': None,
-                'char2token': None,
-                'ids': None,
-                'attention_mask': None,
-                'type_ids': None
-            }
+            return dict(EMPTY_ENCODES)
 
         if self.cc is not None:
             text = self.cc.convert(text)
             if text_b:
                 text_b = self.cc.convert(text_b)
 
+        if self.cache is not None:
+            key = self._cache_key(text, add_special_tokens)
+            cached = self.cache.get(key)
+            if cached is None:
+                cached = self._to_cached(
+                    self._tokenizer.encode(
+                        text, add_special_tokens=add_special_tokens))
+                self.cache.put(key, cached)
+            return self._from_cached(text, cached, text_b=text_b)
+
         text_tokens = self._tokenizer.encode(
             text, add_special_tokens=add_special_tokens)
         tokens = text_tokens.tokens
@@ -76,12 +97,8 @@ class HFTokenizer:
         char2token = [-1] * len(text)
 
         if text_b is None:
-            for i, (start, end) in enumerate(offsets):
-                if start == 0 and end == 0:
-                    continue
-                token2char[i] = start
-                for j in range(start, end):
-                    char2token[j] = i
+            token2char = offsets_to_token2char(offsets)[:-1].tolist()
+            char2token = offsets_to_char2token(offsets, len(text)).tolist()
 
             #  ids = text_tokens.ids
             #  attention_mask = text_tokens.attention_mask
@@ -97,6 +114,44 @@ class HFTokenizer:
             'type_ids': text_tokens.type_ids,
         }
 
+    def _cache_key(self, text, add_special_tokens):
+        # 键使用cc转换后的文本，opencc配置作为编码参数
+        namespace = self.cache.namespace(self._tokenizer,
+                                         cc=self.cc_config,
+                                         add_special_tokens=add_special_tokens)
+        return self.cache.make_key(namespace, text)
+
+    @staticmethod
+    def _to_cached(text_tokens):
+        return {
+            'input_ids': text_tokens.ids,
+            'token_type_ids': text_tokens.type_ids,
+            'attention_mask': text_tokens.attention_mask,
+            'offset_mapping': text_tokens.offsets,
+        }
+
+    def _from_cached(self, text, cached, text_b=None):
+        """
+        由缓存的ids、offsets还原encode()的结果，tokens由词表查得
+        """
+        offsets = cached['offset_mapping']
+        if text_b is None:
+            token2char = offsets_to_token2char(offsets)[:-1].tolist()
+            char2token = offsets_to_char2token(offsets, len(text)).tolist()
+        else:
+            token2char = [-1] * len(offsets)
+            char2token = [-1] * len(text)
+        return {
+            'tokens':
+            [self._tokenizer.id_to_token(x) for x in cached['input_ids']],
+            'offsets': offsets,
+            'token2char': token2char,
+            'char2token': char2token,
+            'ids': cached['input_ids'],
+            'attention_mask': cached['attention_mask'],
+            'type_ids': cached['token_type_ids'],
+        }
+
     """
     texts = [
         "中国的英文是China，成立于1949年。",
@@ -126,9 +181,63 @@ class HFTokenizer:
     """
 
     def batch_encode(self, texts, add_special_tokens=True):
+        """
+        使用tokenizers的encode_batch并行编码，char2token对整个batch做一次数组运算
+        """
+        if self.cc is not None:
+            texts = [self.cc.convert(text) if text else text for text in texts]
+
+        # 空文本与encode()一样返回None
+        indices = [i for i, text in enumerate(texts) if text]
+        if self.cache is not None:
+            return self._batch_encode_cached(texts, indices,
+                                             add_special_tokens)
+        batch_tokens = self._tokenizer.encode_batch(
+            [texts[i] for i in indices], add_special_tokens=add_special_tokens)
+        batch_offsets = [x.offsets for x in batch_tokens]
+        batch_char2token = batch_offsets_to_char2token(
+            batch_offsets, [len(texts[i]) for i in indices])
+
+        encodes_list = [None] * len(texts)
+        for i, text_tokens, char2token in zip(indices, batch_tokens,
+                                              batch_char2token):
+            encodes_list[i] = {
+                'tokens': text_tokens.tokens,
+                'offsets': text_tokens.offsets,
+                'token2char':
+                offsets_to_token2char(text_tokens.offsets)[:-1].tolist(),
+                'char2token': char2token.tolist(),
+                'ids': text_tokens.ids,
+                'attention_mask': text_tokens.attention_mask,
+                'type_ids': text_tokens.type_ids,
+            }
+
+        return self._collect_batch_encodes(encodes_list)
+
+    def _batch_encode_cached(self, texts, indices, add_special_tokens):
+        keys = [self._cache_key(texts[i], add_special_tokens) for i in indices]
+        cached_list = [self.cache.get(key) for key in keys]
+        missed = [j for j, x in enumerate(cached_list) if x is None]
+        if missed:
+            batch_tokens = self._tokenizer.encode_batch(
+                [texts[indices[j]] for j in missed],
+                add_special_tokens=add_special_tokens)
+            for j, text_tokens in zip(missed, batch_tokens):
+                cached_list[j] = self._to_cached(text_tokens)
+                self.cache.put(keys[j], cached_list[j])
+            self.cache.flush()
+
+        encodes_list = [None] * len(texts)
+        for i, cached in zip(indices, cached_list):
+            encodes_list[i] = self._from_cached(texts[i], cached)
+        return self._collect_batch_encodes(encodes_list)
+
+    @staticmethod
+    def _collect_batch_encodes(encodes_list):
         batch_encodes = defaultdict(list)
-        for text in texts:
-            encodes = self.encode(text, add_special_tokens=add_special_tokens)
+        for encodes in encodes_list:
+            if encodes is None:
+                encodes = EMPTY_ENCODES
             for k, v in encodes.items():
                 batch_encodes[k].append(v)
         return batch_encodes
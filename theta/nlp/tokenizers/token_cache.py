@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+按内容寻址的tokenize结果缓存
+
+键为 hash(文本, tokenizer指纹, max_length/padding/truncation等编码参数)，
+进程内为LRU，其后为磁盘上mmap打开的分段存储，重复运行、不同fold、
+在线服务的重复请求都不再重新tokenize。修改某个编码参数只会产生新的键，
+其它参数对应的缓存仍然有效。
+
+    cache = TokenizationCache("outputs/token_cache")
+    encodings = cache.batch_encode(tokenizer, texts,
+                                   max_length=256,
+                                   truncation=True,
+                                   return_offsets_mapping=True)
+    cache.stats()
+
+磁盘目录结构:
+    {cache_dir}/{segment:08d}.data      追加写入的int32记录
+    {cache_dir}/{segment:08d}.index     定长索引记录(key, offset, length)
+    {cache_dir}/LOCK                    写进程持有的文件锁
+
+总大小超过max_disk_mb时整段删除最早的分段，从旧分段命中的记录会重新写入当前分段，
+近似LRU淘汰。同一时间只有一个进程写入，其它进程只读。
+"""
+
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+import numpy as np
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+KEY_SIZE = 20
+
+# 可缓存的字段，记录中以下标表示
+CACHED_FIELDS = [
+    'input_ids', 'token_type_ids', 'attention_mask', 'offset_mapping',
+    'special_tokens_mask'
+]
+PAIR_FIELDS = {'offset_mapping'}
+
+INDEX_DTYPE = np.dtype([('key', f'S{KEY_SIZE}'), ('offset', '<i8'),
+                        ('length', '<i8')])
+
+
+def _text_bytes(text):
+    return text.encode('utf-8', errors='surrogatepass')
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    tokenizer词表和规范化设置的hash，词表或lowercase等设置变化时缓存失效
+    """
+    h = blake2b(digest_size=KEY_SIZE)
+    h.update(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is None:
+        backend = getattr(tokenizer, '_tokenizer', None)
+    if backend is not None and hasattr(backend, 'to_str'):
+        # fast tokenizer的完整序列化，包含词表、normalizer和特殊token，
+        # truncation、padding是调用时设置的状态，由编码参数区分
+        config = json.loads(backend.to_str())
+        config.pop('truncation', None)
+        config.pop('padding', None)
+        h.update(_text_bytes(json.dumps(config, sort_keys=True)))
+    else:
+        vocab = tokenizer.get_vocab()
+        for token, idx in sorted(vocab.items(), key=lambda x: x[1]):
+            h.update(_text_bytes(f"{idx}\t{token}\n"))
+        init_kwargs = getattr(tokenizer, 'init_kwargs', {})
+        h.update(
+            json.dumps(
+                {
+                    k: v
+                    for k, v in init_kwargs.items()
+                    if isinstance(v, (bool, int, float, str))
+                },
+                sort_keys=True).encode())
+    return h.digest()
+
+
+def encode_record(value):
+    """
+    {field: [int, ...] 或 [(start, end), ...]} -> int32数组
+    布局: [字段数, (字段下标, 长度) * 字段数, 字段数据...]
+    """
+    header = [len(value)]
+    arrays = []
+    for k, v in value.items():
+        a = np.asarray(v, dtype=np.int32).reshape(-1)
+        header.extend([CACHED_FIELDS.index(k), len(a)])
+        arrays.append(a)
+    return np.concatenate([np.asarray(header, dtype=np.int32)] + arrays)
+
+
+def decode_record(record):
+    num_fields = int(record[0])
+    header = record[1:1 + 2 * num_fields].tolist()
+    pos = 1 + 2 * num_fields
+    value = {}
+    for i in range(num_fields):
+        field, length = CACHED_FIELDS[header[2 * i]], header[2 * i + 1]
+        a = record[pos:pos + length]
+        if field in PAIR_FIELDS:
+            value[field] = list(zip(a[0::2].tolist(), a[1::2].tolist()))
+        else:
+            value[field] = a.tolist()
+        pos += length
+    return value
+
+
+class MmapTokenStore:
+    """
+    磁盘上的分段存储，读取时以mmap打开各分段
+    """
+
+    def __init__(self,
+                 cache_dir,
+                 max_disk_mb=1024,
+                 num_segments=8,
+                 read_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_disk_mb * 1024 * 1024)
+        self.segment_bytes = max(self.max_bytes // num_segments, 1)
+        self.read_only = read_only
+        self.evictions = 0
+
+        # key -> (segment, offset, length)
+        self.index = {}
+        self.segment_sizes = OrderedDict()
+        self._mmaps = {}
+        self._lock_fp = None
+        self._data_fp = None
+        self._index_fp = None
+        self.active = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if not self.read_only:
+            self.read_only = not self._acquire_lock()
+        self._load_index()
+        if not self.read_only:
+            self._open_active()
+
+    def _path(self, segment, suffix):
+        return os.path.join(self.cache_dir, f"{segment:08d}.{suffix}")
+
+    def _acquire_lock(self):
+        if fcntl is None:
+            return True
+        self._lock_fp = open(os.path.join(self.cache_dir, "LOCK"), 'a')
+        try:
+            fcntl.flock(self._lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.warning(
+                f"{self.cache_dir} is locked by another process, open read-only."
+            )
+            self._lock_fp.close()
+            self._lock_fp = None
+            return False
+        return True
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.cache_dir):
+            stem, ext = os.path.splitext(name)
+            if ext == '.index' and stem.isdigit():
+                segments.append(int(stem))
+        return sorted(segments)
+
+    def _load_index(self):
+        for segment in self._list_segments():
+            data_file = self._path(segment, 'data')
+            if not os.path.exists(data_file):
+                continue
+            data_size = os.path.getsize(data_file)
+            index_file = self._path(segment, 'index')
+            # 中断写入时最后一条索引可能不完整
+            count = os.path.getsize(index_file) // INDEX_DTYPE.itemsize
+            entries = np.fromfile(index_file, dtype=INDEX_DTYPE, count=count)
+            valid = entries['offset'] + entries['length'] * 4 <= data_size
+            for key, offset, length in entries[valid].tolist():
+                # numpy去掉了bytes末尾的0
+                self.index[key.ljust(KEY_SIZE, b'\x00')] = (segment, offset,
+                                                            length)
+            self.segment_sizes[segment] = data_size
+
+    def _open_active(self):
+        segments = list(self.segment_sizes.keys())
+        if segments and self.segment_sizes[
+                segments[-1]] < self.segment_bytes:
+            self.active = segments[-1]
+            index_file = self._path(self.active, 'index')
+            size = os.path.getsize(index_file)
+            with open(index_file, 'ab') as f:
+                f.truncate(size - size % INDEX_DTYPE.itemsize)
+        else:
+            self.active = segments[-1] + 1 if segments else 0
+            self.segment_sizes[self.active] = 0
+        self._data_fp = open(self._path(self.active, 'data'), 'ab')
+        self._index_fp = open(self._path(self.active, 'index'), 'ab')
+        self.segment_sizes[self.active] = self._data_fp.tell()
+
+    def _mmap(self, segment, end):
+        mm = self._mmaps.get(segment, None)
+        if mm is None or len(mm) < end:
+            if segment == self.active:
+                self._data_fp.flush()
+            if mm is not None:
+                mm.close()
+            with open(self._path(segment, 'data'), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps[segment] = mm
+        return mm
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        """
+        返回记录(int32数组)，不存在时返回None
+        """
+        entry = self.index.get(key, None)
+        if entry is None:
+            return None
+        segment, offset, length = entry
+        mm = self._mmap(segment, offset + length * 4)
+        record = np.frombuffer(mm, dtype=np.int32, count=length,
+                               offset=offset).copy()
+        if not self.read_only and segment != self.active:
+            # 重新写入当前分段，避免常用记录随旧分段一起被删除
+            self.put(key, record)
+        return record
+
+    def put(self, key, record):
+        if self.read_only:
+            return
+        offset = self._data_fp.tell()
+        self._data_fp.write(record.tobytes())
+        entry = np.array([(key, offset, len(record))], dtype=INDEX_DTYPE)
+        self._index_fp.write(entry.tobytes())
+        self.index[key] = (self.active, offset, len(record))
+        self.segment_sizes[self.active] = offset + record.nbytes
+
+        if self.segment_sizes[self.active] >= self.segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._data_fp.close()
+        self._index_fp.close()
+        self.active += 1
+        self.segment_sizes[self.active] = 0
+        self._data_fp = open(self._path(self.active, 'data'), 'ab')
+        self._index_fp = open(self._path(self.active, 'index'), 'ab')
+
+        while len(self.segment_sizes) > 1 and self.total_bytes(
+        ) > self.max_bytes:
+            self._evict(next(iter(self.segment_sizes)))
+
+    def _evict(self, segment):
+        self.segment_sizes.pop(segment)
+        mm = self._mmaps.pop(segment, None)
+        if mm is not None:
+            mm.close()
+        for suffix in ('data', 'index'):
+            try:
+                os.remove(self._path(segment, suffix))
+            except OSError:
+                pass
+        num_keys = len(self.index)
+        self.index = {k: v for k, v in self.index.items() if v[0] != segment}
+        self.evictions += num_keys - len(self.index)
+
+    def total_bytes(self):
+        return sum(self.segment_sizes.values())
+
+    def flush(self):
+        if self._data_fp is not None:
+            self._data_fp.flush()
+            self._index_fp.flush()
+
+    def close(self):
+        for mm in self._mmaps.values():
+            mm.close()
+        self._mmaps = {}
+        for fp in (self._data_fp, self._index_fp, self._lock_fp):
+            if fp is not None:
+                fp.close()
+        self._data_fp = self._index_fp = self._lock_fp = None
+
+
+class TokenizationCache:
+    """
+    进程内LRU + 磁盘mmap存储的tokenize结果缓存
+
+    cache_dir: 磁盘存储目录，为None时只使用进程内LRU
+    max_entries: LRU中最多保存的记录数
+    max_disk_mb: 磁盘存储的大小上限
+    """
+
+    def __init__(self,
+                 cache_dir=None,
+                 max_entries=100000,
+                 max_disk_mb=1024,
+                 read_only=False):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_mb = max_disk_mb
+        self.read_only = read_only
+
+        self._memory = OrderedDict()
+        self._store = None
+        self._store_pid = None
+        self._fingerprints = {}
+        self._lock = threading.RLock()
+        # defer_writes()之后未写入的(key, value)
+        self._pending = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+
+    @property
+    def store(self):
+        # 延迟打开，fork出的子进程不使用父进程的文件句柄，以只读方式重新打开
+        if self._store is not None and self._store_pid != os.getpid():
+            self._store = None
+            self.read_only = True
+        if self._store is None and self.cache_dir is not None:
+            self._store = MmapTokenStore(self.cache_dir,
+                                         max_disk_mb=self.max_disk_mb,
+                                         read_only=self.read_only)
+            self._store_pid = os.getpid()
+        return self._store
+
+    def namespace(self, tokenizer, **settings):
+        """
+        tokenizer指纹与编码参数的hash，作为键的前缀
+        """
+        tokenizer_id = id(tokenizer)
+        if tokenizer_id not in self._fingerprints:
+            self._fingerprints[tokenizer_id] = (
+                tokenizer, tokenizer_fingerprint(tokenizer))
+        h = blake2b(self._fingerprints[tokenizer_id][1],
+                    digest_size=KEY_SIZE)
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.digest()
+
+    def make_key(self, namespace, text):
+        """
+        text: 字符串或(text_a, text_b)
+        """
+        h = blake2b(namespace, digest_size=KEY_SIZE)
+        if isinstance(text, (tuple, list)):
+            text_a, text_b = text
+            h.update(b'\x01' + _text_bytes(text_a))
+            if text_b is not None:
+                h.update(b'\x02' + _text_bytes(text_b))
+        else:
+            h.update(b'\x01' + _text_bytes(text))
+        return h.digest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key, None)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            record = self.store.get(key) if self.store is not None else None
+            if record is not None:
+                value = decode_record(record)
+                self._remember(key, value)
+                self.disk_hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        value: {field: list}，field为CACHED_FIELDS之一
+        """
+        with self._lock:
+            self._remember(key, value)
+            if self._pending is not None:
+                self._pending.append((key, value))
+            elif self.store is not None:
+                self.store.put(key, encode_record(value))
+
+    def _remember(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.memory_evictions += 1
+
+    def batch_encode(self, tokenizer, texts, encode_fn=None, **kwargs):
+        """
+        与tokenizer.batch_encode_plus(texts, **kwargs)结果相同，
+        只对未命中的文本调用一次encode_fn(默认为tokenizer)。
+        texts: [text, ...] 或 [(text_a, text_b), ...]
+        """
+        from transformers import BatchEncoding
+
+        padding = kwargs.get('padding', False)
+        if padding is True or padding == 'longest':
+            raise ValueError(
+                "padding='longest' depends on the batch and can not be cached, "
+                "use padding=False and pad the batch afterwards.")
+        if kwargs.get('return_tensors', None) is not None or kwargs.get(
+                'return_overflowing_tokens', False):
+            raise ValueError(
+                "return_tensors and return_overflowing_tokens are not supported."
+            )
+        if encode_fn is None:
+            encode_fn = tokenizer
+
+        namespace = self.namespace(tokenizer, **kwargs)
+        keys = [self.make_key(namespace, text) for text in texts]
+        values = [self.get(key) for key in keys]
+
+        missed = [i for i, value in enumerate(values) if value is None]
+        if missed:
+            encodings = encode_fn([texts[i] for i in missed], **kwargs)
+            fields = [k for k in CACHED_FIELDS if k in encodings]
+            for j, i in enumerate(missed):
+                values[i] = {k: encodings[k][j] for k in fields}
+                self.put(keys[i], values[i])
+            self.flush()
+
+        fields = list(values[0].keys()) if values else []
+        return BatchEncoding({k: [x[k] for x in values] for k in fields})
+
+    def defer_writes(self):
+        """
+        多进程编码的工作进程中调用：磁盘存储只读，新记录和统计由pop_updates()取出，
+        交给父进程merge_updates()写入，避免各进程争抢写锁而丢弃记录
+        """
+        with self._lock:
+            self.read_only = True
+            self._pending = []
+            self.reset_stats()
+
+    def pop_updates(self):
+        with self._lock:
+            updates = {
+                'puts': self._pending or [],
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_evictions': self.memory_evictions
+            }
+            if self._pending is not None:
+                self._pending = []
+            self.reset_stats()
+            return updates
+
+    def merge_updates(self, updates):
+        """
+        写入工作进程pop_updates()返回的记录，并累加其命中统计
+        """
+        with self._lock:
+            for key, value in updates['puts']:
+                # 不同工作进程可能编码了相同的文本
+                if self.store is not None and key in self.store:
+                    continue
+                self.put(key, value)
+            for name in ('memory_hits', 'disk_hits', 'misses',
+                         'memory_evictions'):
+                setattr(self, name, getattr(self, name) + updates[name])
+            self.flush()
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        stats = {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total > 0 else 0.0,
+            'memory_entries': len(self._memory),
+            'memory_evictions': self.memory_evictions,
+        }
+        if self._store is not None:
+            stats.update({
+                'disk_entries': len(self._store),
+                'disk_mb': self._store.total_bytes() / (1024 * 1024),
+                'disk_evictions': self._store.evictions,
+            })
+        return stats
+
+    def log_stats(self, desc="token cache"):
+        s = self.stats()
+        logger.info(
+            f"{desc}: hit_rate {s['hit_rate']:.2%}, "
+            f"memory_hits {s['memory_hits']}, disk_hits {s['disk_hits']}, "
+            f"misses {s['misses']}, memory_entries {s['memory_entries']}, "
+            f"disk_entries {s.get('disk_entries', 0)}, "
+            f"disk_mb {s.get('disk_mb', 0.0):.1f}")
+
+    def flush(self):
+        with self._lock:
+            if self._store is not None:
+                self._store.flush()
+
+    def close(self):
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def __getstate__(self):
+        # 子进程中只读打开磁盘存储，不复制进程内LRU
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        state['_store'] = None
+        state['_fingerprints'] = {}
+        state['_lock'] = None
+        state['read_only'] = True
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+def create_token_cache(data_args):
+    """
+    由DataArguments创建TokenizationCache，use_token_cache为False时返回None
+    """
+    if not data_args.use_token_cache:
+        return None
+    cache_dir = data_args.token_cache_dir
+    if cache_dir is None and data_args.cache_dir is not None:
+        cache_dir = os.path.join(data_args.cache_dir, "token_cache")
+    return TokenizationCache(cache_dir,
+                             max_entries=data_args.token_cache_entries,
+                             max_disk_mb=data_args.token_cache_max_mb)
@@ -1,75 +1,163 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+对抗训练，扰动施加在word_embeddings参数上
+
+embedding、梯度的备份在第一次使用时按参数预分配，之后每步原地拷贝，不再每步重建dict。
+
+    FGM:    每步多一次前向+反向
+    PGD:    每步多k次前向+反向
+    FreeAT: 扰动在minibatch之间保留并累积，
+            'free'模式每个minibatch重复训练m次，每次前向+反向同时更新参数和扰动；
+            'amortized'模式用正常训练的梯度更新扰动，每步只多一次前向+反向
+"""
 
 import torch
 import torch.nn as nn
 
 
-# FGM
-class FGM:
+class EmbeddingAttack:
+    """
+    word_embeddings参数及其预分配的备份
+    """
+
     def __init__(self, model: nn.Module, eps=1.):
         self.model = (model.module if hasattr(model, "module") else model)
         self.eps = eps
-        self.backup = {}
+        self.emb_name = None
+        self.emb_params = []
+        self.emb_backup = []
 
-    # only attack word embedding
-    def attack(self, emb_name='word_embeddings'):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and emb_name in name:
-                self.backup[name] = param.data.clone()
-                norm = torch.norm(param.grad)
-                if norm and not torch.isnan(norm):
-                    r_at = self.eps * param.grad / norm
-                    param.data.add_(r_at)
+    def _allocate(self):
+        self.emb_backup = [torch.empty_like(p) for p in self.emb_params]
+
+    def _select(self, emb_name):
+        # emb_name变化或模型移动到其他设备时重新分配
+        if emb_name != self.emb_name or any(
+                b.device != p.device
+                for b, p in zip(self.emb_backup, self.emb_params)):
+            self.emb_name = emb_name
+            self.emb_params = [
+                param for name, param in self.model.named_parameters()
+                if param.requires_grad and emb_name in name
+            ]
+            self._allocate()
+        return self.emb_params
+
+    def backup_emb(self, emb_name='word_embeddings'):
+        for param, backup in zip(self._select(emb_name), self.emb_backup):
+            backup.copy_(param.data)
 
     def restore(self, emb_name='word_embeddings'):
-        for name, para in self.model.named_parameters():
-            if para.requires_grad and emb_name in name:
-                assert name in self.backup
-                para.data = self.backup[name]
+        for param, backup in zip(self._select(emb_name), self.emb_backup):
+            param.data.copy_(backup)
 
-        self.backup = {}
+
+# FGM
+class FGM(EmbeddingAttack):
+
+    def __init__(self, model: nn.Module, eps=1.):
+        super(FGM, self).__init__(model, eps=eps)
+
+    # only attack word embedding
+    def attack(self, emb_name='word_embeddings'):
+        self.backup_emb(emb_name)
+        for param in self.emb_params:
+            norm = torch.norm(param.grad)
+            if norm and not torch.isnan(norm):
+                # r_at = eps * grad / norm
+                param.data.addcdiv_(param.grad, norm, value=self.eps)
 
 
 # PGD
-class PGD:
+class PGD(EmbeddingAttack):
+
     def __init__(self, model, eps=1., alpha=0.3):
-        self.model = (model.module if hasattr(model, "module") else model)
-        self.eps = eps
+        super(PGD, self).__init__(model, eps=eps)
         self.alpha = alpha
-        self.emb_backup = {}
-        self.grad_backup = {}
+        self.grad_params = []
+        self.grad_backup = []
 
     def attack(self, emb_name='word_embeddings', is_first_attack=False):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and emb_name in name:
-                if is_first_attack:
-                    self.emb_backup[name] = param.data.clone()
-                norm = torch.norm(param.grad)
-                if norm != 0 and not torch.isnan(norm):
-                    r_at = self.alpha * param.grad / norm
-                    param.data.add_(r_at)
-                    param.data = self.project(name, param.data)
+        if is_first_attack:
+            self.backup_emb(emb_name)
+        for param, backup in zip(self._select(emb_name), self.emb_backup):
+            norm = torch.norm(param.grad)
+            if norm != 0 and not torch.isnan(norm):
+                param.data.addcdiv_(param.grad, norm, value=self.alpha)
+                self.project(param.data, backup)
 
-    def restore(self, emb_name='word_embeddings'):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and emb_name in name:
-                assert name in self.emb_backup
-                param.data = self.emb_backup[name]
-        self.emb_backup = {}
-
-    def project(self, param_name, param_data):
-        r = param_data - self.emb_backup[param_name]
-        if torch.norm(r) > self.eps:
-            r = self.eps * r / torch.norm(r)
-        return self.emb_backup[param_name] + r
+    def project(self, param_data, backup):
+        """
+        原地将param_data投影到以backup为中心、半径eps的球内
+        """
+        r = param_data.sub_(backup)
+        r_norm = torch.norm(r)
+        if r_norm > self.eps:
+            r.mul_(self.eps / r_norm)
+        return param_data.add_(backup)
 
     def backup_grad(self):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and param.grad is not None:
-                self.grad_backup[name] = param.grad.clone()
+        params = [
+            p for p in self.model.parameters()
+            if p.requires_grad and p.grad is not None
+        ]
+        if len(params) != len(self.grad_params) or any(
+                p is not q or b.device != p.device
+                for p, q, b in zip(params, self.grad_params,
+                                   self.grad_backup)):
+            self.grad_params = params
+            self.grad_backup = [torch.empty_like(p.grad) for p in params]
+        for param, backup in zip(self.grad_params, self.grad_backup):
+            backup.copy_(param.grad)
 
     def restore_grad(self):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and param.grad is not None:
-                param.grad = self.grad_backup[name]
+        for param, backup in zip(self.grad_params, self.grad_backup):
+            if param.grad is None:
+                # zero_grad(set_to_none=True)之后只能重新分配
+                param.grad = backup.clone()
+            else:
+                param.grad.copy_(backup)
+
+
+# Free Adversarial Training
+class FreeAT(EmbeddingAttack):
+    """
+    扰动delta(与word_embeddings同样大小，预分配)在minibatch之间保留，
+    每次反向传播后按embedding的梯度更新，投影到半径eps的球内。
+
+        free_at.attack()        # 参数加上delta
+        loss.backward()
+        free_at.update_delta()  # 用这次反向的梯度更新delta
+        free_at.restore()       # 恢复参数后再optimizer.step()
+    """
+
+    def __init__(self, model, eps=1., alpha=0.3):
+        super(FreeAT, self).__init__(model, eps=eps)
+        self.alpha = alpha
+        self.delta = []
+
+    def _allocate(self):
+        super(FreeAT, self)._allocate()
+        self.delta = [torch.zeros_like(p) for p in self.emb_params]
+
+    def attack(self, emb_name='word_embeddings'):
+        self.backup_emb(emb_name)
+        for param, delta in zip(self.emb_params, self.delta):
+            param.data.add_(delta)
+
+    def update_delta(self, emb_name='word_embeddings'):
+        for param, delta in zip(self._select(emb_name), self.delta):
+            if param.grad is None:
+                continue
+            norm = torch.norm(param.grad)
+            # delta跨batch保留，fp16溢出(inf)的梯度会使其永久变为nan
+            if norm != 0 and torch.isfinite(norm):
+                delta.addcdiv_(param.grad, norm, value=self.alpha)
+                delta_norm = torch.norm(delta)
+                if delta_norm > self.eps:
+                    delta.mul_(self.eps / delta_norm)
+
+    def reset(self):
+        for delta in self.delta:
+            delta.zero_()
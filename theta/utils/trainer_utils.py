@@ -3,16 +3,27 @@
 
 import os
 import copy
+import math
 import torch
 import logging
 from torch.cuda.amp import autocast as ac
 from torch.utils.data import DataLoader, RandomSampler
 from transformers import AdamW, get_linear_schedule_with_warmup
-from attack_utils import FGM, PGD
+from attack_utils import FGM, FreeAT, PGD
+from weight_averaging import WeightAverager
 
 logger = logging.getLogger(__name__)
 
 
+def replay_batches(dataloader, num_replays=1):
+    """
+    每个batch连续返回num_replays次(free对抗训练)
+    """
+    for batch_data in dataloader:
+        for _ in range(num_replays):
+            yield batch_data
+
+
 def save_model(opt, model, global_step):
     output_dir = os.path.join(opt.output_dir,
                               'checkpoint-{}'.format(global_step))
@@ -189,7 +200,16 @@ def swa(model, model_dir, swa_start=1):
 
 
 def train(opt, model, train_dataset):
-    swa_raw_model = copy.deepcopy(model)
+    """
+    opt.weight_averaging为'swa'或'ema'时，训练中在内存里平均权重，
+    否则训练结束后按opt.swa_start重新载入保存的checkpoint做swa
+    opt.attack_train: 'fgm'、'pgd'、'free'(每个batch重复opt.free_replays次)或'amortized'
+    返回平均后的模型
+    """
+    weight_averaging = getattr(opt, 'weight_averaging', None)
+    swa_raw_model = None
+    if not weight_averaging:
+        swa_raw_model = copy.deepcopy(model)
 
     train_sampler = RandomSampler(train_dataset)
 
@@ -208,14 +228,34 @@ def train(opt, model, train_dataset):
     if hasattr(model, "module"):
         use_n_gpus = True
 
+    attack_train_mode = opt.attack_train.lower()
+
+    # free模式每个batch重复训练num_replays次，epoch数按重复次数折算，
+    # 总步数与opt.train_epochs相同，不能整除时最后一个epoch只训练部分batch
+    num_replays = 1
+    if attack_train_mode == 'free':
+        num_replays = max(1, getattr(opt, 'free_replays', 3))
+    train_epochs = math.ceil(opt.train_epochs / num_replays)
+
     t_total = len(train_loader) * opt.train_epochs
 
     optimizer, scheduler = build_optimizer_and_scheduler(opt, model, t_total)
 
+    averager = None
+    if weight_averaging:
+        averager = WeightAverager(
+            model,
+            mode=weight_averaging,
+            start_step=getattr(opt, 'weight_averaging_start', 0),
+            update_steps=getattr(opt, 'weight_averaging_steps', 1),
+            decay=getattr(opt, 'ema_decay', 0.999))
+
     # Train
     logger.info("***** Running training *****")
     logger.info(f"  Num Examples = {len(train_dataset)}")
-    logger.info(f"  Num Epochs = {opt.train_epochs}")
+    logger.info(f"  Num Epochs = {train_epochs}")
+    if num_replays > 1:
+        logger.info(f"  Num Replays = {num_replays}")
     logger.info(f"  Total training batch size = {opt.train_batch_size}")
     logger.info(f"  Total optimization steps = {t_total}")
 
@@ -223,17 +263,18 @@ def train(opt, model, train_dataset):
 
     model.zero_grad()
 
-    fgm, pgd = None, None
+    fgm, pgd, free_at = None, None, None
 
-    attack_train_mode = opt.attack_train.lower()
     if attack_train_mode == 'fgm':
         fgm = FGM(model=model)
     elif attack_train_mode == 'pgd':
         pgd = PGD(model=model)
+    elif attack_train_mode in ('free', 'amortized'):
+        free_at = FreeAT(model=model)
 
     pgd_k = 3
 
-    save_steps = t_total // opt.train_epochs
+    save_steps = len(train_loader) * num_replays
     eval_steps = save_steps
 
     logger.info(
@@ -243,15 +284,19 @@ def train(opt, model, train_dataset):
 
     avg_loss = 0.
 
-    for epoch in range(opt.train_epochs):
+    for epoch in range(train_epochs):
 
-        for step, batch_data in enumerate(train_loader):
+        for step, batch_data in enumerate(
+                replay_batches(train_loader, num_replays)):
 
             model.train()
 
             for key in batch_data.keys():
                 batch_data[key] = batch_data[key].to(device)
 
+            if free_at is not None and attack_train_mode == 'free':
+                free_at.attack()
+
             if opt.use_fp16:
                 with ac():
                     loss = model(**batch_data)[0]
@@ -292,7 +337,8 @@ def train(opt, model, train_dataset):
                     pgd.attack(is_first_attack=(_t == 0))
 
                     if _t != pgd_k - 1:
-                        model.zero_grad()
+                        # 保留梯度的存储，restore_grad()原地拷贝
+                        model.zero_grad(set_to_none=False)
                     else:
                         pgd.restore_grad()
 
@@ -312,6 +358,29 @@ def train(opt, model, train_dataset):
 
                 pgd.restore()
 
+            elif free_at is not None:
+                # 用这次反向的embedding梯度更新扰动，供下一次前向使用
+                free_at.update_delta()
+
+                if attack_train_mode == 'amortized':
+                    free_at.attack()
+
+                    if opt.use_fp16:
+                        with ac():
+                            loss_adv = model(**batch_data)[0]
+                    else:
+                        loss_adv = model(**batch_data)[0]
+
+                    if use_n_gpus:
+                        loss_adv = loss_adv.mean()
+
+                    if opt.use_fp16:
+                        scaler.scale(loss_adv).backward()
+                    else:
+                        loss_adv.backward()
+
+                free_at.restore()
+
             if opt.use_fp16:
                 scaler.unscale_(optimizer)
 
@@ -330,6 +399,9 @@ def train(opt, model, train_dataset):
 
             global_step += 1
 
+            if averager is not None:
+                averager.update(global_step)
+
             if global_step % log_loss_steps == 0:
                 avg_loss /= log_loss_steps
                 logger.info('Step: %d / %d ----> total loss: %.5f' %
@@ -338,11 +410,19 @@ def train(opt, model, train_dataset):
             else:
                 avg_loss += loss.item()
 
-            if global_step % save_steps == 0:
+            if global_step % save_steps == 0 or global_step == t_total:
                 save_model(opt, model, global_step)
 
-    swa(swa_raw_model, opt.output_dir, swa_start=opt.swa_start)
+            if global_step >= t_total:
+                break
+
+    if averager is not None:
+        swa_model = averager.copy_to()
+    else:
+        swa_model = swa(swa_raw_model, opt.output_dir, swa_start=opt.swa_start)
 
     # clear cuda cache to avoid OOM
     torch.cuda.empty_cache()
     logger.info('Train done')
+
+    return swa_model
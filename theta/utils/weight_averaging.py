@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+训练中的权重平均(SWA、EMA)
+
+训练过程中每隔update_steps步原地更新一份影子权重，训练结束时平均权重已在内存中，
+不需要保存、再逐个torch.load所有checkpoint。
+    SWA: shadow += (param - shadow) / (n + 1)，n为已平均的次数
+    EMA: shadow = decay * shadow + (1 - decay) * param
+"""
+
+from contextlib import contextmanager
+
+import pytorch_lightning as pl
+import torch
+import torch.nn as nn
+from loguru import logger
+
+WEIGHT_AVERAGING_MODES = ('swa', 'ema')
+
+
+class WeightAverager:
+
+    def __init__(self,
+                 model: nn.Module,
+                 mode='swa',
+                 start_step=0,
+                 update_steps=1,
+                 decay=0.999):
+        """
+        start_step: 从第start_step步开始平均，之前的权重不计入
+        update_steps: 每隔多少步更新一次影子权重
+        decay: EMA的衰减系数
+        """
+        assert mode in WEIGHT_AVERAGING_MODES, \
+            f"mode should be one of {WEIGHT_AVERAGING_MODES}, got {mode}."
+        self.model = (model.module if hasattr(model, "module") else model)
+        self.mode = mode
+        self.start_step = start_step
+        self.update_steps = max(1, update_steps)
+        self.decay = decay
+
+        self.params = [
+            p for p in self.model.parameters()
+            if p.requires_grad and p.is_floating_point()
+        ]
+        # 第一次更新时按参数所在设备分配
+        self.shadow = None
+        self.num_updates = 0
+        self.last_step = None
+
+    @torch.no_grad()
+    def update(self, step):
+        """
+        优化器更新后调用，step为已完成的优化步数。同一步多次调用只更新一次。
+        """
+        if step < self.start_step or step == self.last_step or (
+                step - self.start_step) % self.update_steps != 0:
+            return False
+        self.last_step = step
+
+        if self.shadow is None:
+            self.shadow = [p.detach().clone() for p in self.params]
+        elif self.mode == 'swa':
+            weight = 1.0 / (self.num_updates + 1)
+            for s, p in zip(self.shadow, self.params):
+                s.lerp_(p.detach(), weight)
+        else:
+            for s, p in zip(self.shadow, self.params):
+                s.lerp_(p.detach(), 1.0 - self.decay)
+        self.num_updates += 1
+        return True
+
+    @torch.no_grad()
+    def swap(self):
+        """
+        交换模型参数与影子权重的存储，不拷贝数据，调用两次恢复原状
+        """
+        for s, p in zip(self.shadow, self.params):
+            p.data, s.data = s.data, p.data
+
+    @contextmanager
+    def averaged(self):
+        """
+        with averager.averaged(): 期间模型使用平均后的权重
+        """
+        if self.shadow is None:
+            yield self.model
+            return
+        self.swap()
+        try:
+            yield self.model
+        finally:
+            self.swap()
+
+    @torch.no_grad()
+    def copy_to(self):
+        """
+        将平均后的权重写入模型
+        """
+        if self.shadow is None:
+            logger.warning(
+                f"No weights have been averaged (start_step: {self.start_step}), keep the model weights."
+            )
+            return self.model
+        for s, p in zip(self.shadow, self.params):
+            p.copy_(s)
+        logger.info(
+            f"Loaded {self.mode} weights averaged over {self.num_updates} updates."
+        )
+        return self.model
+
+
+class WeightAveragingCallback(pl.Callback):
+    """
+    TaskRunner训练时的权重平均，验证时使用平均后的权重(保存的最优模型也是平均后的权重)，
+    训练结束时平均权重写入模型
+    """
+
+    def __init__(self,
+                 mode='swa',
+                 start_step=0,
+                 update_steps=1,
+                 decay=0.999,
+                 eval_averaged=True):
+        self.mode = mode
+        self.start_step = start_step
+        self.update_steps = update_steps
+        self.decay = decay
+        self.eval_averaged = eval_averaged
+
+        self.averager = None
+        self._swapped = False
+
+    def on_train_start(self, trainer, pl_module):
+        self.averager = WeightAverager(pl_module.model,
+                                       mode=self.mode,
+                                       start_step=self.start_step,
+                                       update_steps=self.update_steps,
+                                       decay=self.decay)
+
+    def on_train_batch_end(self, trainer, pl_module, *args, **kwargs):
+        # 梯度累积时global_step不变，只更新一次
+        self.averager.update(trainer.global_step)
+
+    def on_validation_start(self, trainer, pl_module):
+        if self.eval_averaged and self.averager is not None \
+                and self.averager.shadow is not None:
+            self.averager.swap()
+            self._swapped = True
+
+    def on_validation_end(self, trainer, pl_module):
+        if self._swapped:
+            self.averager.swap()
+            self._swapped = False
+
+    def on_train_end(self, trainer, pl_module):
+        self.averager.copy_to()